@@ -1,39 +1,114 @@
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.schema import PrimaryKeyConstraint
-from sqlalchemy.orm import relationship
-from flask_sqlalchemy import SQLAlchemy
-from flask import Flask, jsonify, abort, request, make_response
+from sqlalchemy.dialects.postgresql import UUID, insert
+from sqlalchemy.orm import joinedload, selectinload
+from flask import Flask, Blueprint, current_app, jsonify, abort, request, make_response, url_for
 from flask_migrate import Migrate
+import logging
+from werkzeug.local import LocalProxy
 import uuid
-import secrets
-import hashlib
-from werkzeug.exceptions import HTTPException, BadRequest
+import hmac
+from werkzeug.exceptions import HTTPException, BadRequest, Forbidden, Locked, NotFound
 import json
-import requests
-from datetime import datetime
+from datetime import date, datetime
 from datetime import timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from config import get_config
+from models import db, Customers, Accounts, AccountTypes, Portfolios, Positions, PositionLots, Tickers, Transactions, AccountsCustomers, LedgerEvents, Orders, uuid7
+from pagination import list_response
+from prices import make_price_service
+from credentials import make_password_hasher
+from cache import make_lookup_cache
+import bulk
+import events
+import exports
+import ratelimit
+import replicas
+import search
+import serializers
+import metrics
+import orders
+import partitions
+import snapshots
+import idempotency
+import interest
+import valuation
+from valuation import stored_closes, store_closes, valuation_day
+from idempotency import idempotent
+from ratelimit import AccountLocked, rate_limited, make_rate_limiter
+from replicas import replica_reads
+
+migrate = Migrate()
+
+# every route lives on this blueprint; create_app() registers it on the app it builds
+bp = Blueprint('bank', __name__)
+
+# services are built per app in create_app(); these proxies resolve to the current app's instance
+# close prices for tickers (cached, pooled connections, concurrent fetches) -- see prices.py
+prices = LocalProxy(lambda: current_app.extensions['prices'])
+# salted, tunable KDF run on a bounded worker pool -- see credentials.py
+passwords = LocalProxy(lambda: current_app.extensions['passwords'])
+# read-through cache for hot lookups -- see cache.py
+lookups = LocalProxy(lambda: current_app.extensions['lookups'])
+
+
+##### APP FACTORY #####
+
+def create_app(config_name: str = None):
+    """ build and configure an app for a config profile (default: $BANK_CONFIG, see config.py)"""
+    app = Flask(__name__, instance_relative_config=True)
+    app.config.from_object(get_config(config_name))
+    # no-op when gunicorn or the embedding process has already configured logging
+    logging.basicConfig(level=app.config['LOG_LEVEL'], format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    db.init_app(app)
+    migrate.init_app(app, db)
+
+    app.extensions['prices'] = make_price_service(app.config)
+    app.extensions['passwords'] = make_password_hasher(app.config)
+    app.extensions['lookups'] = make_lookup_cache(app.config)
+    # token buckets per IP/customer/account and the PIN lockout -- see ratelimit.py
+    app.extensions['ratelimit'] = make_rate_limiter(app.config)
+    # read replicas for the @replica_reads views, when DATABASE_REPLICA_URLS names any -- see replicas.py
+    replicas.init_app(app, db)
+    # keeps the next few months of transactions partitions created -- see partitions.py
+    partitions.init_app(app)
+
+    # per-route latency, SQL statements/time per request and slow-request logging -- see metrics.py
+    metrics.init_app(app)
+
+    # flask snapshots take|reconcile
+    app.cli.add_command(snapshots.cli)
+    # flask idempotency purge
+    app.cli.add_command(idempotency.cli)
+    # flask interest accrue
+    app.cli.add_command(interest.cli)
+    # flask prices revalue
+    app.cli.add_command(valuation.cli)
+    # flask bulk load|export
+    app.cli.add_command(bulk.cli)
+    # flask ratelimit release
+    app.cli.add_command(ratelimit.cli)
+    # flask events relay|purge
+    app.cli.add_command(events.cli)
+    # flask partitions create|list|archive
+    app.cli.add_command(partitions.cli)
+    # flask orders work
+    app.cli.add_command(orders.cli)
+
+    app.register_blueprint(bp)
+    return app
 
-# configure an instance and connect to db. This would otherwise be in __init__.py
-app = Flask(__name__, instance_relative_config=True)
-app.config.from_mapping(
-    SECRET_KEY='dev',
-    SQLALCHEMY_DATABASE_URI='postgresql://postgres@localhost:5432/bank',
-    SQLALCHEMY_TRACK_MODIFICATIONS=False,
-    SQLALCHEMY_ECHO=True
-)
 
 ##### SCRAMBLE PASSWORD #####
 def scramble(password: str):
     """ hash and salt the given password"""
-    salt = secrets.token_hex(16)
-    return hashlib.sha512((password + salt).encode('utf-8')).hexdigest()
+    return passwords.hash(password)
 
 
 
 
 ######## ERROR HANDLING #########
 
-@app.errorhandler(HTTPException)
+@bp.app_errorhandler(HTTPException)
 def handle_exception(e):
     """Return JSON instead of HTML for HTTP errors."""
     # start with the correct headers and status code from the error
@@ -44,11 +119,11 @@ def handle_exception(e):
         "name": e.name,
         "description": e.description,
     })
-    print("Something went wrong: ", e)
+    current_app.logger.info("%s %s failed: %s", request.method, request.path, e)
     response.content_type = "application/json"
     return response
 
-@app.errorhandler(BadRequest)
+@bp.app_errorhandler(BadRequest)
 def handle_bad_request(e):
     response = e.get_response()
     response.data = json.dumps({
@@ -56,223 +131,415 @@ def handle_bad_request(e):
         "name": e.name,
         "description": e.description,
     })
-    print("Something went wrong: ", e)
+    current_app.logger.info("%s %s rejected: %s", request.method, request.path, e)
     response.content_type = "application/json"
     return response
 
 
 
-###### MODELS: #######
+###### LEDGER ######
+# Every money movement goes through here so the balance change and its Transactions row land in
+# the same commit. Balances are changed with a single conditional
+#   UPDATE accounts SET balance = balance + :delta WHERE id = :id [AND balance + :delta >= 0] RETURNING ...
+# so Postgres does the arithmetic under the row lock and two concurrent writers can't both read the
+# old balance and overwrite each other (the lost update we used to get with read-in-python-then-write).
 
-##If you change anything in these classes in these models you need to do an upgrade and migrate-- 
-# BC this is all in one file now
+CENTS = Decimal('0.01')
 
-db = SQLAlchemy()
-db.init_app(app)
-migrate = Migrate(app, db)
 
-class Customers(db.Model):
-    __tablename__ = "customers"
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    first_name = db.Column(db.String(128), nullable=False)
-    last_name = db.Column(db.String(128), nullable=False)
-    pin = db.Column(db.Integer, nullable=False)
-    password = db.Column(db.String(128), nullable=False)
-    portfolio_id = db.Column(UUID(as_uuid=True), db.ForeignKey('portfolios.id'), nullable=True)
+class InsufficientFunds(BadRequest):
+    description = "Insufficient Funds"
 
-    # serialize tells us what each table should return, telling what columns to return and giving us
-    # a chance in python to optimize the data types we want to returnflask 
-    def serialize(self):
-        return {
-            'id': str(self.id),
-            'first_name': self.first_name,
-            'last_name': self.last_name,
-            'pin': self.pin,
-            'password': self.password,
-            'portfolio_id': str(self.portfolio_id)
-        }
 
+class AccountOnHold(Locked):
+    description = "Account is on hold"
 
-class Accounts(db.Model):
-    __tablename__ = "accounts"
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    balance = db.Column(db.Numeric, nullable=False, default=0.00)
-    hold = db.Column(db.Boolean, nullable=False, default=False)
-    acct_type_id = db.Column(db.Integer, db.ForeignKey('account_types.id'), nullable=False)
-    customer_id = db.Column(UUID(as_uuid=True), db.ForeignKey('customers.id'), nullable=False)
-
-    def serialize(self):
-        return {
-            'id': str(self.id),
-            'balance': float(self.balance),
-            'acct_type_id': self.acct_type_id,
-            'hold': self.hold
-        }
 
+def to_amount(value) -> Decimal:
+    """ parse a client supplied amount into a positive Decimal rounded to cents"""
+    try:
+        # go through str() so a JSON float like 0.1 becomes Decimal('0.1'), not 0.1000000000000000055...
+        amount = Decimal(str(value)).quantize(CENTS, rounding=ROUND_HALF_UP)
+    except (InvalidOperation, ValueError):
+        raise BadRequest("amount must be a number")
+    if not amount.is_finite() or amount <= 0:
+        raise BadRequest("amount must be greater than zero")
+    return amount
+
+
+def to_pin(value) -> int:
+    """ parse a client supplied PIN: a JSON number, or a string of digits ("1234" is the same PIN as 1234)"""
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    raise BadRequest("pin must be a number")
+
+
+def to_uuid(value, name: str = 'id'):
+    """ parse an id from the url or body, 400 instead of a DataError from postgres"""
+    try:
+        return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+    except ValueError:
+        raise BadRequest(f"{name} is not a valid id")
 
-class AccountTypes(db.Model):
-    __tablename__ = "account_types"
-    id = db.Column(db.Integer, autoincrement = True, primary_key=True)
-    type = db.Column(db.String(128), nullable=False)
-    interest_rate = db.Column(db.Numeric, nullable=False, default=0.0)
-    min_balance = db.Column(db.Numeric, nullable=False, default=0.0)
-    # accounts = db.relationship('Accounts', backref='account_types', lazy=True)
-
-    def serialize(self):
-        return {
-            'id': self.id,
-            'type': self.type,
-            'interest_rate': float(self.interest_rate),
-            'min_balance': float(self.min_balance)
-        }
 
-class Portfolios(db.Model):
-    __tablename__ = "portfolios"
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    customer_id = db.Column(UUID(as_uuid=True), db.ForeignKey('customers.id'), nullable=False)
-    # customer = db.relationship('Customers', back_populates='portfolio')
-    # positions = db.relationship('Positions', back_populates='portfolio')
-
-    def serialize(self):
-        return {
-            'id': str(self.id),
-            'customer_id': str(self.customer_id)
-        }
+def adjust_balance(account_id, delta: Decimal, customer_id=None, acct_type_id=None) -> Accounts:
+    """ atomically add `delta` to an account balance without committing.
 
-class Positions(db.Model):
-    __tablename__ = "positions"
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    ticker_id = db.Column(UUID(as_uuid=True), db.ForeignKey('tickers.id'), nullable=True)
-    portfolio_id = db.Column(UUID(as_uuid=True), db.ForeignKey('portfolios.id'), nullable=False)
-    # tickers = db.relationship('Tickers', back_populates='positions')
-
-    def serialize(self):
-        return {
-            'id': str(self.id),
-            'ticker_id': str(self.ticker_id),
-            'portfolio_id': str(self.portfolio_id)
-        }
+    Debits (negative delta) only apply when they leave the balance >= 0. The optional
+    customer_id / acct_type_id are checked in the same statement. Returns a detached Accounts
+    built from the RETURNING row, so callers can serialize it without another SELECT.
+    """
+    account_id = to_uuid(account_id, 'account_id')
+    stmt = db.update(Accounts).where(Accounts.id == account_id)
+    if customer_id is not None:
+        stmt = stmt.where(Accounts.customer_id == customer_id)
+    if acct_type_id is not None:
+        stmt = stmt.where(Accounts.acct_type_id == acct_type_id)
+    if delta < 0:
+        # a held account (see ratelimit.py) pays nothing out; the ledger still credits it (batch
+        # credits, sale proceeds), though the PIN endpoints turn it away first (see check_pin)
+        stmt = stmt.where(Accounts.balance + delta >= 0, Accounts.hold.is_(False))
+    stmt = stmt.values(balance=Accounts.balance + delta).returning(
+        Accounts.id, Accounts.balance, Accounts.hold, Accounts.acct_type_id, Accounts.customer_id)
+    row = db.session.execute(stmt.execution_options(synchronize_session=False)).first()
+    if row is not None:
+        return Accounts(**row._mapping)
+
+    # nothing matched: work out which condition failed so the client gets a useful error
+    account = db.session.get(Accounts, account_id)
+    if account is None:
+        raise NotFound("Account not found")
+    if customer_id is not None and account.customer_id != customer_id:
+        raise BadRequest("Account does not belong to this customer")
+    if acct_type_id is not None and account.acct_type_id != acct_type_id:
+        raise BadRequest("Funding account must be a checking account")
+    if account.hold:
+        raise AccountOnHold()
+    raise InsufficientFunds()
+
+
+def record_transaction(**transaction_data) -> Transactions:
+    """ add a Transactions row, and its outbox event (see events.py), to the current unit of work.
+
+    id and created_at are set here rather than by the column defaults so the row can be
+    serialized before the commit, and the commit doesn't have to be followed by a refresh.
+    """
+    transaction_data.setdefault('id', uuid7())
+    transaction_data.setdefault('created_at', datetime.utcnow())
+    transaction = Transactions(**transaction_data)
+    db.session.add(transaction)
+    db.session.add(LedgerEvents(transaction_id=transaction.id, created_at=transaction.created_at))
+    return transaction
 
-class Tickers(db.Model):
-    __tablename__ = "tickers"
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    ticker = db.Column(db.String(128), nullable=False)
-    price = db.Column(db.Numeric, nullable=False)
-    quantity = db.Column(db.Integer, nullable=False)
-    # positions = db.relationship('Positions', back_populates='tickers')
-
-    def serialize(self):
-        return {
-            'id': str(self.id),
-            'ticker': self.ticker,
-            'price': float(self.price),
-            'quantity': self.quantity,
-        }
 
-class Transactions(db.Model):
-    __tablename__ = "transactions"
-    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    amount = db.Column(db.Numeric, nullable=False)
-    note = db.Column(db.String(128), nullable=False)
-    debit_id = db.Column(UUID(as_uuid=True), nullable=True)
-    credit_id = db.Column(UUID(as_uuid=True), nullable=True)
-    customer_id = db.Column(UUID(as_uuid=True), db.ForeignKey('customers.id'), nullable=False)
-
-    def serialize(self):
-        return {
-            'id': str(self.id),
-            'amount': float(self.amount),
-            'note': self.note,
-            'debit_id': str(self.debit_id),
-            'credit_id': str(self.credit_id),
-            'customer_id': str(self.customer_id)
-        }
+def post_movement(account_id, delta: Decimal, note: str, customer_id):
+    """ apply a single deposit (delta > 0) or withdrawal (delta < 0) and its ledger row in one commit"""
+    customer_id = to_uuid(customer_id, 'customer_id')
+    try:
+        account = adjust_balance(account_id, delta, customer_id=customer_id)
+        transaction = record_transaction(
+            customer_id=customer_id,
+            amount=abs(delta),
+            note=note,
+            debit_id=account.id if delta < 0 else None,
+            credit_id=account.id if delta > 0 else None)
+        result = {"account": account.serialize(), "transaction": transaction.serialize()}
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_accounts([(account.id, account.customer_id)])
+    return result
+
+
+##### bulk postings (transfers and batches) #####
+# A posting moves `amount` out of debit_id and/or into credit_id. Big files are applied a chunk at
+# a time: every account the chunk touches is locked up front in id order (so two batches touching
+# the same accounts always queue behind each other instead of deadlocking), balances are checked in
+# python against the locked values, and then the whole chunk is written with one UPDATE ... FROM
+# (VALUES ...) and one multi-row INSERT before it commits. A bad line is reported and skipped, it
+# doesn't fail the rest of the file.
+
+BATCH_CHUNK_SIZE = 1000
+
+
+def parse_posting(data, require_both: bool = False) -> dict:
+    """ validate one posting line from a transfer or batch request"""
+    if not isinstance(data, dict):
+        raise BadRequest("posting must be a JSON object")
+    debit_id = to_uuid(data['debit_id'], 'debit_id') if data.get('debit_id') else None
+    credit_id = to_uuid(data['credit_id'], 'credit_id') if data.get('credit_id') else None
+    if debit_id is None and credit_id is None:
+        raise BadRequest("posting needs a debit_id, a credit_id or both")
+    if require_both and (debit_id is None or credit_id is None):
+        raise BadRequest("a transfer needs both debit_id and credit_id")
+    if debit_id == credit_id:
+        raise BadRequest("debit_id and credit_id must be different accounts")
+    amount = to_amount(data.get('amount'))
+    note = data.get('note') or f"Transfer at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    if not isinstance(note, str) or len(note) > 128:
+        raise BadRequest("note must be a string of at most 128 characters")
+    return {'debit_id': debit_id, 'credit_id': credit_id, 'amount': amount, 'note': note}
+
+
+def rejected(line: int, error: HTTPException) -> dict:
+    return {'line': line, 'status': 'rejected', 'code': error.code, 'error': error.description}
+
+
+def post_chunk(chunk) -> list:
+    """ apply one chunk of (line number, posting or validation error) pairs and commit it.
+
+    Returns one result dict per line, in line order.
+    """
+    results = {}
+    postings = []
+    for line, posting in chunk:
+        if isinstance(posting, HTTPException):
+            results[line] = rejected(line, posting)
+        else:
+            postings.append((line, posting))
 
-class AccountsCustomers(db.Model):
-    __tablename__ = "accounts_customers"
-    account_id = db.Column(UUID(as_uuid=True), db.ForeignKey('accounts.id'), nullable=False)
-    customer_id = db.Column(UUID(as_uuid=True), db.ForeignKey('customers.id'), nullable=False)
-    __table_args__ = (
-        db.PrimaryKeyConstraint('account_id', 'customer_id'),
-        {})
-
-    def serialize(self):
-        return {
-            'account_id': str(self.account_id),
-            'customer_id': str(self.customer_id)
-        }
+    account_ids = sorted({p[side] for _, p in postings for side in ('debit_id', 'credit_id') if p[side]})
+    try:
+        # lock every account in the chunk, always in the same (id) order
+        locked = db.session.execute(
+            db.select(Accounts.id, Accounts.balance, Accounts.customer_id, Accounts.hold)
+            .where(Accounts.id.in_(account_ids))
+            .order_by(Accounts.id)
+            .with_for_update()).all() if account_ids else []
+        balances = {row.id: row.balance for row in locked}
+        owners = {row.id: row.customer_id for row in locked}
+        held = {row.id for row in locked if row.hold}
+
+        deltas = {}
+        inserts = []
+        now = datetime.utcnow()
+        for line, p in postings:
+            debit_id, credit_id, amount = p['debit_id'], p['credit_id'], p['amount']
+            if (debit_id and debit_id not in balances) or (credit_id and credit_id not in balances):
+                results[line] = rejected(line, NotFound("Account not found"))
+                continue
+            # a held account (see ratelimit.py) takes credits but pays nothing out, as in adjust_balance
+            if debit_id in held:
+                results[line] = rejected(line, AccountOnHold())
+                continue
+            if debit_id and balances[debit_id] < amount:
+                results[line] = rejected(line, InsufficientFunds())
+                continue
+            if debit_id:
+                balances[debit_id] -= amount
+                deltas[debit_id] = deltas.get(debit_id, 0) - amount
+            if credit_id:
+                balances[credit_id] += amount
+                deltas[credit_id] = deltas.get(credit_id, 0) + amount
+            transaction_id = uuid7()
+            inserts.append({
+                'id': transaction_id,
+                'amount': amount,
+                'note': p['note'],
+                'debit_id': debit_id,
+                'credit_id': credit_id,
+                'customer_id': owners[debit_id or credit_id],
+                'created_at': now,
+            })
+            results[line] = {'line': line, 'status': 'posted', 'transaction_id': str(transaction_id)}
+
+        if deltas:
+            changes = db.values(db.column('id', UUID(as_uuid=True)), db.column('delta', db.Numeric),
+                                name='deltas').data(list(deltas.items()))
+            db.session.execute(
+                db.update(Accounts)
+                .where(Accounts.id == db.cast(changes.c.id, UUID(as_uuid=True)))
+                .values(balance=Accounts.balance + db.cast(changes.c.delta, db.Numeric))
+                .execution_options(synchronize_session=False))
+        if inserts:
+            db.session.execute(db.insert(Transactions), inserts)
+            db.session.execute(db.insert(LedgerEvents), [
+                {'transaction_id': i['id'], 'created_at': now} for i in inserts])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_accounts((account_id, owners[account_id]) for account_id in deltas)
+    return [results[line] for line, _ in chunk]
+
+
+def post_postings(lines, require_both: bool = False, chunk_size: int = BATCH_CHUNK_SIZE) -> dict:
+    """ validate and apply an iterable of posting dicts chunk by chunk, returning the per-line report"""
+    report = {'posted': 0, 'rejected': 0, 'results': []}
+    chunk = []
+
+    def flush():
+        for result in post_chunk(chunk):
+            report[result['status']] += 1
+            report['results'].append(result)
+        chunk.clear()
 
+    for line, data in enumerate(lines, start=1):
+        try:
+            chunk.append((line, parse_posting(data, require_both)))
+        except HTTPException as e:
+            chunk.append((line, e))
+        if len(chunk) >= chunk_size:
+            flush()
+    if chunk:
+        flush()
+    return report
 
-# Customers.accounts = db.relationship('Accounts', secondary='accounts_customers', back_populates='customers')
-# Accounts.account_types = db.relationship('AccountTypes', back_populates='accounts')
 
 
+def json_response(body: bytes):
+    """ a 200 with an already encoded JSON body (see serializers.py)"""
+    return current_app.response_class(body, mimetype='application/json')
 
 
+###### LOOKUP CACHE ######
+# customer_show, account_show, customer_accounts and the account type lookups are read through this
+# cache (see cache.py). Anything that changes what they return must call the matching invalidate_*
+# after it commits.
 
+def cached_json(key: str, loader, ttl: float = None):
+    """ serve a cached JSON lookup with an ETag, answering a matching If-None-Match with a 304"""
+    entry = lookups.get_or_load(key, loader, ttl)
+    response = make_response(entry.body)
+    response.mimetype = 'application/json'
+    response.set_etag(entry.etag)
+    # let clients keep their copy but revalidate it every time; the revalidation is the cheap 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+def invalidate_customer(customer_id):
+    lookups.invalidate(f"customer:{customer_id}")
+
+
+def invalidate_accounts(accounts):
+    """ drop the cached account and customer_accounts entries for (account_id, customer_id) pairs"""
+    keys = set()
+    for account_id, customer_id in accounts:
+        keys.add(f"account:{account_id}")
+        keys.add(f"customer_accounts:{customer_id}")
+    if keys:
+        lookups.invalidate(*keys)
 
 
 
 ####### API endpoints ########
 
 
+##### health #####
+
+# healthz (liveness: the process is up and serving; never touches the database)
+@bp.route('/healthz', methods = ['GET'])
+def healthz():
+    return jsonify({"status": "ok"})
+
+
+# readyz (readiness: only send traffic here once the database answers)
+# replicas are only reported (lag as of their last check): reads fall back to the primary without them
+@bp.route('/readyz', methods = ['GET'])
+def readyz():
+    try:
+        db.session.execute(db.text('SELECT 1'))
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.warning("readiness check failed: %s", e)
+        return jsonify({"status": "unavailable", "database": "down"}), 503
+    result = {"status": "ready", "database": "ok"}
+    if current_app.extensions['replicas'] is not None:
+        result['replicas'] = current_app.extensions['replicas'].status()
+    return jsonify(result)
+
+
+# metrics (Prometheus text format; this worker process only -- see metrics.py)
+@bp.route('/metrics', methods = ['GET'])
+def metrics_endpoint():
+    cache_counts = [((prefix, what), count) for prefix, counts in sorted(lookups.stats().items())
+                    for what, count in sorted(counts.items())]
+    body = metrics.REGISTRY.render() + '\n'.join(metrics.counter_family(
+        'bank_lookup_cache_events_total', 'Lookup cache hits, misses and invalidations.', ['prefix', 'event'], cache_counts)) + '\n'
+    return current_app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+
+
 ##### START OF Customers endpoints   #####
 
 # customers_index
-@app.route('/customers', methods = ['GET']) # this decorator takes a path and a list of HTTP verbs
+@bp.route('/customers', methods = ['GET']) # this decorator takes a path and a list of HTTP verbs
+@replica_reads
 def customer_index():
-    customers = Customers.query.all()  # this is the ORM performing a SELECT query
-    result = []
-    for t in customers:
-        result.append(t.serialize()) # buid list of customers as dictionaries
-    return jsonify(result) # this returns a JSON result
+    # ?limit=&after= returns one keyset page, otherwise the whole table is streamed
+    return list_response(Customers.query, Customers.id, schema=serializers.CUSTOMER)
+
+
+def customer_json(customer: Customers) -> dict:
+    """ a customer as the API returns it: the customer schema's default fields, so no pin or password hash"""
+    return {name: value for name, value in customer.serialize().items() if name not in serializers.CUSTOMER.hidden}
 
 
 # customer_id
-@app.route('/customers/<id>', methods = ['GET'])
+@bp.route('/customers/<id>', methods = ['GET'])
 def customer_show(id: int):
-    customer = Customers.query.get_or_404(id)
-    return jsonify(customer.serialize())
+    customer_id = to_uuid(id, 'customer_id')
+    return cached_json(f"customer:{customer_id}", lambda: customer_json(Customers.query.get_or_404(customer_id)))
 
 
 
 # customer_create
-@app.route('/customers', methods = ['POST'])
+@bp.route('/customers', methods = ['POST'])
 def customer_create():
     if 'first_name' in request.json and 'last_name' in request.json and 'pin' in request.json and 'password' in request.json:
         customer = Customers(
             first_name = request.json['first_name'], 
             last_name = request.json['last_name'], 
-            pin = request.json['pin'], 
+            pin = to_pin(request.json['pin']), 
             password = scramble(request.json['password']))
         
         db.session.add(customer)
         db.session.commit()
-        return jsonify(customer.serialize()), 201
+        return jsonify(customer_json(customer)), 201
     else:
         return jsonify({"error": "Missing required fields"}), abort(400)
     
 
 
 # customer_update
-@app.route('/customers/<id>', methods = ['PUT'])
+@bp.route('/customers/<id>', methods = ['PUT'])
 def customer_update(id: int):
-    customer = Customers.query.get_or_404(id)
+    customer = Customers.query.get_or_404(to_uuid(id, 'customer_id'))
     if 'first_name' in request.json:
         customer.first_name = request.json['first_name']
     if 'last_name' in request.json:
         customer.last_name = request.json['last_name']
     if 'pin' in request.json:
-        customer.pin = request.json['pin']
+        customer.pin = to_pin(request.json['pin'])
     if 'password' in request.json:
         customer.password = scramble(request.json['password'])
-    db.session.commit()
     
     try:
         db.session.commit()
-        return jsonify(customer.serialize())
     except:
+        db.session.rollback()
         return jsonify({"error": "Could not add user"}), abort(400)
+    invalidate_customer(customer.id)
+    return jsonify(customer_json(customer))
+
+# customer_login (check a password; upgrades the stored hash when it was made at an older cost)
+@bp.route('/customers/<id>/login', methods = ['POST'])
+@rate_limited(customer_arg='id')
+def customer_login(id: int):
+    if 'password' not in request.json:
+        return jsonify({"error": "Missing required fields"}), abort(400)
+    customer = Customers.query.get_or_404(to_uuid(id, 'customer_id'))
+    if not passwords.verify(request.json['password'], customer.password):
+        abort(401, description="Incorrect password")
+    if passwords.needs_rehash(customer.password):
+        customer.password = scramble(request.json['password'])
+        db.session.commit()
+        invalidate_customer(customer.id)
+    return jsonify({"id": str(customer.id), "authenticated": True})
 
 ##### END OF CUSTOMERS ENDPOINTS #####
 
@@ -281,56 +548,68 @@ def customer_update(id: int):
 ######## START ACCOUNTS ENDPOINTS ########
 
 # accounts_index
-@app.route('/accounts', methods = ['GET']) 
+@bp.route('/accounts', methods = ['GET']) 
+@replica_reads
 def account_index():
-    accounts = Accounts.query.all()  
-    result = []
-    for t in accounts:
-        result.append(t.serialize()) 
-    return jsonify(result)
+    return list_response(Accounts.query, Accounts.id, schema=serializers.ACCOUNT)
 
 
 # account_id
-@app.route('/accounts/<id>', methods = ['GET'])
+@bp.route('/accounts/<id>', methods = ['GET'])
 def account_show(id: int):
-    accounts = Accounts.query.get_or_404(id)
-    return jsonify(accounts.serialize())
+    account_id = to_uuid(id, 'account_id')
+    return cached_json(f"account:{account_id}", lambda: Accounts.query.get_or_404(account_id).serialize())
 
 
 # customer_accounts (get all accounts for a customer)  
-@app.route('/customers/<id>/accounts', methods = ['GET'])
+@bp.route('/customers/<id>/accounts', methods = ['GET'])
 def customer_accounts(id: int):
-    customer_id = id
-    accounts = Accounts.query.filter(Accounts.customer_id == customer_id).all()
-    result = []
-    for t in accounts:
-        result.append(t.serialize()) 
-    return jsonify(result)
+    customer_id = to_uuid(id, 'customer_id')
+
+    def load():
+        accounts = Accounts.query.filter(Accounts.customer_id == customer_id).all()
+        result = []
+        for t in accounts:
+            result.append(t.serialize()) 
+        return result
+    return cached_json(f"customer_accounts:{customer_id}", load)
 
 
 # account_create
-@app.route('/accounts', methods = ['POST'])
+@bp.route('/accounts', methods = ['POST'])
+@idempotent
 def account_create():
-    if 'balance' in request.json and 'acct_type_id' and 'customer_id' and 'debit_id' in request.json:
+    if all(field in request.json for field in ('balance', 'acct_type_id', 'customer_id', 'debit_id')):
+        # an account may open empty, but not overdrawn
+        try:
+            balance = Decimal(str(request.json['balance'])).quantize(CENTS, rounding=ROUND_HALF_UP)
+        except (InvalidOperation, ValueError):
+            raise BadRequest("balance must be a number")
+        if not balance.is_finite() or balance < 0:
+            raise BadRequest("balance must not be negative")
+        acct_type_id = request.json['acct_type_id']
+        if not isinstance(acct_type_id, int) or isinstance(acct_type_id, bool):
+            raise BadRequest("acct_type_id must be an integer")
+        customer_id = to_uuid(request.json['customer_id'], 'customer_id')
+        debit_id = to_uuid(request.json['debit_id'], 'debit_id')
+
         accounts = Accounts(
-            balance = request.json['balance'], 
-            acct_type_id = request.json['acct_type_id'],
-            customer_id = request.json['customer_id'])
+            id = uuid.uuid4(),
+            balance = balance, 
+            acct_type_id = acct_type_id,
+            customer_id = customer_id)
         
         db.session.add(accounts)
-        db.session.commit()
-
-        transaction_data = {
-            'customer_id': request.json['customer_id'],
-            'amount': request.json['balance'],
-            'note': f"Initial deposit at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-            'debit_id': request.json['debit_id'],
-            'credit_id': accounts.id
-        }
 
-        transaction = Transactions(**transaction_data)
-        db.session.add(transaction)
+        # the account and its opening ledger row are committed together
+        record_transaction(
+            customer_id = customer_id,
+            amount = accounts.balance,
+            note = f"Initial deposit at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            debit_id = debit_id,
+            credit_id = accounts.id)
         db.session.commit()
+        invalidate_accounts([(accounts.id, accounts.customer_id)])
 
         return jsonify(accounts.serialize()), 201
     else:
@@ -338,83 +617,164 @@ def account_create():
 
 
 # account_withdrawal
-@app.route('/accounts/<id>/withdrawal', methods = ['GET','POST'])
+@bp.route('/accounts/<id>/withdrawal', methods = ['GET','POST'])
+@rate_limited(account_arg='id')
+@idempotent
 def account_withdrawal(id: int):
-    if 'amount' in request.json and 'customer_id' in request.json and request.method == 'POST' and request.json['amount'] != 0 and 'pin' in request.json:
-        account = Accounts.query.get_or_404(id)
-        amount = float(request.json['amount'])
-        pin = request.json['pin']
-        customer = Customers.query.get_or_404(request.json['customer_id'])
+    if 'amount' in request.json and 'customer_id' in request.json and request.method == 'POST' and 'pin' in request.json:
+        amount = to_amount(request.json['amount'])
+        customer = Customers.query.get_or_404(to_uuid(request.json['customer_id'], 'customer_id'))
+
+        check_pin(customer, id)
+
+        # balance check, ownership check, debit and ledger row all happen in one commit
+        result = post_movement(id, -amount, f"Withdrawal at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", customer.id)
+        return jsonify(result)
 
-        if account is None:
-            return jsonify({"error": "Account not found"}), abort(400)
-        
-        if account.balance >= amount and str(account.customer_id) == request.json['customer_id'] and int(customer.pin) == pin:
-            account.balance = float(account.balance) - amount
-            db.session.add(account)
-            db.session.commit()
-
-            transaction_data = {
-                'customer_id': request.json['customer_id'],
-                'amount': request.json['amount'],
-                'note': f"Withdrawal at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                'debit_id': account.id,
-                'credit_id': None
-            }
-            transaction = Transactions(**transaction_data)
-            db.session.add(transaction)
-            db.session.commit()
-
-            return jsonify({"account": account.serialize(), "transaction": transaction.serialize()})
-
-        elif float(account.balance) < amount:
-            return jsonify({"error": "Insufficient Funds"}), abort(400)
-        
-        elif customer.pin != request.json['pin']:
-            return jsonify({"error": "Incorrect PIN"}), abort(400)
-        
     else:
         return jsonify({"error": "Missing required fields"}), abort(400)
         
 
 # account deposit
-@app.route('/accounts/<id>/deposit', methods = ['GET','POST'])
+@bp.route('/accounts/<id>/deposit', methods = ['GET','POST'])
+@rate_limited(account_arg='id')
+@idempotent
 def account_deposit(id: int):
-    if 'amount' in request.json and 'customer_id' in request.json and request.method == 'POST' and request.json['amount'] != 0 and 'pin' in request.json:
-        account = Accounts.query.get_or_404(id)
-        amount = float(request.json['amount'])
-        pin = request.json['pin']
-        customer = Customers.query.get_or_404(request.json['customer_id'])
+    if 'amount' in request.json and 'customer_id' in request.json and request.method == 'POST' and 'pin' in request.json:
+        amount = to_amount(request.json['amount'])
+        customer = Customers.query.get_or_404(to_uuid(request.json['customer_id'], 'customer_id'))
 
-        if account is None:
-            return jsonify({"error": "Account not found"}), abort(400)
-        
-        if str(account.customer_id) == request.json['customer_id'] and int(customer.pin) == pin:
-            account.balance = float(account.balance) + amount
-            db.session.add(account)
-            db.session.commit()
-                
-            transaction_data = {
-                'customer_id': request.json['customer_id'],
-                'amount': request.json['amount'],
-                'note': f"Deposit at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
-                'debit_id': None,
-                'credit_id': account.id
-            }
-            transaction = Transactions(**transaction_data)
-            db.session.add(transaction)
-            db.session.commit()
-
-            return jsonify({"account": account.serialize(), "transaction": transaction.serialize()})
-        
-        elif customer.pin != request.json['pin']:
-            return jsonify({"error": "Incorrect PIN"}), abort(400)
+        check_pin(customer, id)
+
+        result = post_movement(id, amount, f"Deposit at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", customer.id)
+        return jsonify(result)
     
     else:
         return jsonify({"error": "Missing required fields"}), abort(400)
 
 
 
+def check_pin(customer: Customers, account_id):
+    """ abort with a 400 on a wrong PIN; too many in a row put the account on hold (see ratelimit.py)"""
+    # only the owner's PIN counts against an account: otherwise anyone could get someone else's
+    # account held by sending their own wrong PIN with it
+    account = db.session.get(Accounts, to_uuid(account_id, 'account_id'))
+    if account is None:
+        raise NotFound("Account not found")
+    if account.customer_id != customer.id:
+        raise BadRequest("Account does not belong to this customer")
+    # a held account takes no PINs at all, so guessing can't carry on against it
+    if account.hold:
+        raise AccountOnHold()
+    # a malformed PIN is a bad request, not a guess: it doesn't count towards the hold
+    pin = to_pin(request.json['pin'])
+    limiter = current_app.extensions['ratelimit']
+    if customer.pin == pin:
+        limiter.pin_succeeded(account_id)
+        return
+    if not limiter.pin_failed(account_id):
+        abort(400, description="Incorrect PIN")
+    # in a transaction of its own: the request's session may hold an idempotency key that must
+    # roll back with the failed request, not commit with the hold
+    with db.engine.begin() as conn:
+        held = conn.execute(db.update(Accounts).where(Accounts.id == to_uuid(account_id, 'account_id'))
+                            .values(hold=True).returning(Accounts.id, Accounts.customer_id)).first()
+    if held is not None:
+        invalidate_accounts([held])
+    raise AccountLocked()
+
+
+##### transfers and batches #####
+
+class OperatorOnly(Forbidden):
+    description = "Bulk postings need an operator token (Authorization: Bearer <token>)"
+
+
+def require_operator():
+    """ abort with a 403 unless the request carries one of OPERATOR_TOKENS"""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme != 'Bearer' or not token or not any(
+            hmac.compare_digest(token.encode(), operator.encode()) for operator in current_app.config['OPERATOR_TOKENS']):
+        raise OperatorOnly()
+
+
+def request_postings():
+    """ the postings in the request body: a JSON array, or one JSON object per line for NDJSON uploads"""
+    if request.mimetype in idempotency.STREAMED_MIMETYPES:
+        return ndjson_lines(idempotency.request_stream())
+    postings = request.get_json(silent=True)
+    if not isinstance(postings, list):
+        abort(400, description="body must be a JSON array of postings or an NDJSON upload")
+    return postings
+
+
+def ndjson_lines(stream):
+    """ decode NDJSON lazily so a large upload is never held in memory all at once"""
+    for raw in stream:
+        raw = raw.strip()
+        if not raw:
+            continue
+        try:
+            yield json.loads(raw)
+        except ValueError:
+            # let parse_posting report it against the right line number
+            yield None
+
+
+# transfers (account to account; one object, or many as an array / NDJSON)
+@bp.route('/transfers', methods = ['POST'])
+@rate_limited(account_field='debit_id')
+@idempotent
+def transfers_create():
+    if request.is_json and isinstance(request.get_json(silent=True), dict):
+        # one transfer is authorised by the owner of the account it debits, like a withdrawal
+        if not all(field in request.json for field in ('debit_id', 'customer_id', 'pin')):
+            abort(400, description="a transfer needs debit_id, customer_id and pin")
+        customer = Customers.query.get_or_404(to_uuid(request.json['customer_id'], 'customer_id'))
+        check_pin(customer, request.json['debit_id'])
+        report = post_postings([request.json], require_both=True)
+        result = report['results'][0]
+        if result['status'] == 'rejected':
+            abort(result['code'], description=result['error'])
+        return jsonify(result), 201
+    # many at once debit many customers' accounts: only an operator can send those
+    require_operator()
+    return jsonify(post_postings(request_postings(), require_both=True))
+
+
+# batches (payroll / settlement files: any mix of transfers, debits and credits; operators only)
+@bp.route('/batches', methods = ['POST'])
+@rate_limited()
+@idempotent
+def batches_create():
+    require_operator()
+    return jsonify(post_postings(request_postings()))
+
+
+
+##### account types (read-mostly reference data, cached for ACCOUNT_TYPES_CACHE_TTL) #####
+
+# account_types_index
+@bp.route('/account_types', methods = ['GET'])
+def account_types_index():
+    return cached_json("account_types", lambda: [t.serialize() for t in AccountTypes.query.order_by(AccountTypes.id)],
+                       ttl=current_app.config['ACCOUNT_TYPES_CACHE_TTL'])
+
+
+# account_type_show
+@bp.route('/account_types/<int:id>', methods = ['GET'])
+def account_type_show(id: int):
+    return cached_json(f"account_type:{id}", lambda: AccountTypes.query.get_or_404(id).serialize(),
+                       ttl=current_app.config['ACCOUNT_TYPES_CACHE_TTL'])
+
+
+# cache_stats (hit/miss counters for the lookup cache)
+@bp.route('/cache/stats', methods = ['GET'])
+def cache_stats():
+    return jsonify(lookups.stats())
+
+
+
 #######  END OF ACCOUNTS ENDPOINTS #########
 
 
@@ -422,66 +782,230 @@ def account_deposit(id: int):
 ######## START OF TRANSACTIONS ENDPOINTS ########
 
 # transactions_index           
-@app.route('/transactions', methods = ['GET'])
+@bp.route('/transactions', methods = ['GET'])
+@replica_reads
 def transactions_index():
-    transactions = Transactions.query.all()
-    result = []
-    for t in transactions:
-        result.append(t.serialize()) 
-    return jsonify(result)
+    return list_response(Transactions.query, Transactions.id, schema=serializers.TRANSACTION)
+
+# transactions_export (the whole ledger, or a slice of it, streamed as NDJSON or CSV; see exports.py)
+# ?format=ndjson|csv  ?from=&to=  ?customer_id=  ?account_id=  ?after_id= (resume after the last row received)
+@bp.route('/transactions/export', methods = ['GET'])
+@replica_reads
+def transactions_export():
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in exports.FORMATS:
+        abort(400, description="format must be one of " + ", ".join(exports.FORMATS))
+    after = None
+    if 'after_id' in request.args:
+        after = exports.resume_point(to_uuid(request.args['after_id'], 'after_id'))
+        if after is None:
+            abort(400, description="after_id must be the id of an exported transaction")
+    customer_id = request.args.get('customer_id')
+    account_id = request.args.get('account_id')
+    query = exports.export_query(
+        after=after,
+        start=parse_datetime_arg('from'),
+        end=parse_datetime_arg('to', end_of_day=True),
+        customer_id=to_uuid(customer_id, 'customer_id') if customer_id else None,
+        account_id=to_uuid(account_id, 'account_id') if account_id else None)
+    compress = 'gzip' in request.accept_encodings
+    return exports.stream_export(query, fmt, compress, f"transactions.{fmt}")
+
+# events_index (ledger changes after a seq, long-polled, or streamed with Accept: text/event-stream; see events.py)
+# ?since=<seq> (or a Last-Event-ID header)  ?limit=  ?timeout= (seconds to wait when there's nothing new)
+@bp.route('/events', methods = ['GET'])
+def events_index():
+    since = request.headers.get('Last-Event-ID') or request.args.get('since', '0')
+    try:
+        since = int(since)
+        limit = int(request.args.get('limit', current_app.config['EVENTS_PAGE_SIZE']))
+        timeout = float(request.args.get('timeout', current_app.config['EVENTS_LONG_POLL_TIMEOUT']))
+    except ValueError:
+        abort(400, description="since and limit must be integers and timeout a number of seconds")
+    if since < 0 or limit < 1:
+        abort(400, description="since must be 0 or more and limit at least 1")
+    limit = min(limit, current_app.config['EVENTS_PAGE_SIZE'])
+    timeout = min(max(timeout, 0), current_app.config['EVENTS_LONG_POLL_TIMEOUT'])
+    if request.accept_mimetypes.best == 'text/event-stream':
+        return events.stream(since, limit)
+    return json_response(serializers.dumps(events.poll(since, limit, timeout)))
+
+##### transaction history filters #####
+# ?from=&to=            created_at range, ISO dates or datetimes (a bare date for `to` includes that whole day)
+# ?min_amount=&max_amount=
+# ?direction=debit|credit
+# ?sort=created_at|-created_at|amount|-amount   (default newest first)
+# ?limit=
+
+HISTORY_SORTS = {
+    'created_at': (Transactions.created_at.asc(), Transactions.id.asc()),
+    '-created_at': (Transactions.created_at.desc(), Transactions.id.desc()),
+    'amount': (Transactions.amount.asc(), Transactions.id.asc()),
+    '-amount': (Transactions.amount.desc(), Transactions.id.desc()),
+}
+HISTORY_MAX_LIMIT = 10000
+
+
+def parse_datetime_arg(name: str, end_of_day: bool = False):
+    """ parse an ISO date/datetime query arg, or None if it wasn't given"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, description=f"{name} must be an ISO date or datetime")
+    if end_of_day and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+
+def parse_decimal_arg(name: str):
+    """ parse a numeric query arg as a Decimal, or None if it wasn't given"""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        abort(400, description=f"{name} must be a number")
+
+
+def filter_history(query, debit_column, credit_column):
+    """ apply the date/amount/direction filters and ordering shared by the history endpoints"""
+    start = parse_datetime_arg('from')
+    end = parse_datetime_arg('to', end_of_day=True)
+    if start is not None:
+        query = query.filter(Transactions.created_at >= start)
+    if end is not None:
+        query = query.filter(Transactions.created_at < end)
+
+    min_amount = parse_decimal_arg('min_amount')
+    max_amount = parse_decimal_arg('max_amount')
+    if min_amount is not None:
+        query = query.filter(Transactions.amount >= min_amount)
+    if max_amount is not None:
+        query = query.filter(Transactions.amount <= max_amount)
+
+    direction = request.args.get('direction')
+    if direction == 'debit':
+        query = query.filter(debit_column)
+    elif direction == 'credit':
+        query = query.filter(credit_column)
+    elif direction is not None:
+        abort(400, description="direction must be debit or credit")
+
+    sort = request.args.get('sort', '-created_at')
+    if sort not in HISTORY_SORTS:
+        abort(400, description="sort must be one of " + ", ".join(HISTORY_SORTS))
+    query = query.order_by(*HISTORY_SORTS[sort])
+
+    if 'limit' in request.args:
+        try:
+            limit = int(request.args['limit'])
+        except ValueError:
+            abort(400, description="limit must be an integer")
+        if limit < 1 or limit > HISTORY_MAX_LIMIT:
+            abort(400, description=f"limit must be between 1 and {HISTORY_MAX_LIMIT}")
+        query = query.limit(limit)
+    return query
+
 
 #transactions_customer (get all transactions for a customer) 
-@app.route('/customers/<id>/transactions', methods = ['GET'])
+@bp.route('/customers/<id>/transactions', methods = ['GET'])
+@replica_reads
 def customer_transactions(id: int):
-    customer_id = id
-    transactions = Transactions.query.filter(Transactions.customer_id == customer_id).all()
-    result = []
-    for t in transactions:
-        result.append(t.serialize()) 
-    return jsonify(result)
-
-#transactions_account (get all transactions for an account) 
-@app.route('/accounts/<id>/transactions', methods = ['GET'])
+    customer_id = to_uuid(id, 'customer_id')
+    query = Transactions.query.filter(Transactions.customer_id == customer_id)
+    query = filter_history(query, Transactions.debit_id.isnot(None), Transactions.credit_id.isnot(None))
+    return json_response(serializers.TRANSACTION.dump_query(query))
+
+#transactions_account (get all transactions for an account, both money out and money in) 
+@bp.route('/accounts/<id>/transactions', methods = ['GET'])
+@replica_reads
 def account_transactions(id: int):
-    account_id = id
-    transactions = Transactions.query.filter(Transactions.debit_id == account_id).all()
-    result = []
-    for t in transactions:
-        result.append(t.serialize()) 
-    return jsonify(result)
+    account_id = to_uuid(id, 'account_id')
+    # the OR of the two indexed columns is planned as a BitmapOr of the debit and credit indexes
+    query = Transactions.query.filter(db.or_(Transactions.debit_id == account_id, Transactions.credit_id == account_id))
+    query = filter_history(query, Transactions.debit_id == account_id, Transactions.credit_id == account_id)
+    return json_response(serializers.TRANSACTION.dump_query(query))
+
+# account_statement (opening balance, every movement with a running balance, closing balance)
+# ?from= defaults to the start of this month, ?to= to now; see snapshots.py for how the opening
+# balance is found without replaying the account's whole history
+@bp.route('/accounts/<id>/statement', methods = ['GET'])
+@replica_reads
+def account_statement(id: int):
+    account = Accounts.query.get_or_404(to_uuid(id))
+    now = datetime.utcnow()
+    start = parse_datetime_arg('from') or now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = parse_datetime_arg('to', end_of_day=True) or now
+    if end < start:
+        abort(400, description="to must not be before from")
+    return jsonify(snapshots.statement(account.id, start, end))
+
+##### search #####
+
+# search (customers by name or transactions by note: substring, prefix and fuzzy matches, best first; see search.py)
+# ?q=  ?type=customers|transactions  ?limit=&offset=  ?fields=
+# transactions also take ?from=&to=  ?customer_id=  ?account_id=
+@bp.route('/search', methods = ['GET'])
+@replica_reads
+def search_index():
+    q = request.args.get('q', '').strip()
+    kind = request.args.get('type', 'customers')
+    if kind not in search.KINDS:
+        abort(400, description="type must be one of " + ", ".join(search.KINDS))
+    if not search.MIN_LENGTH <= len(q) <= search.MAX_LENGTH:
+        abort(400, description=f"q must be {search.MIN_LENGTH} to {search.MAX_LENGTH} characters")
+    try:
+        limit = int(request.args.get('limit', current_app.config['SEARCH_PAGE_SIZE']))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        abort(400, description="limit and offset must be integers")
+    max_results = current_app.config['SEARCH_MAX_RESULTS']
+    if limit < 1 or offset < 0 or offset >= max_results:
+        abort(400, description=f"limit must be at least 1 and offset between 0 and {max_results - 1}")
+    limit = min(limit, max_results - offset)
+    if kind == 'customers':
+        items = search.customers(q, serializers.CUSTOMER.requested(), limit, offset)
+    else:
+        customer_id = request.args.get('customer_id')
+        account_id = request.args.get('account_id')
+        items = search.transactions(
+            q, serializers.TRANSACTION.requested(), limit, offset, max_results,
+            start=parse_datetime_arg('from'),
+            end=parse_datetime_arg('to', end_of_day=True),
+            customer_id=to_uuid(customer_id, 'customer_id') if customer_id else None,
+            account_id=to_uuid(account_id, 'account_id') if account_id else None)
+    return search.search_response(items, limit, offset, max_results)
 
 ######## END OF TRANSACTIONS ENDPOINTS ########
 
 ############ START OF (PORTFOLIO) & POSITIONS ENDPOINTS ###########
 
 # portfolios_index
-@app.route('/portfolios', methods = ['GET'])
+@bp.route('/portfolios', methods = ['GET'])
+@replica_reads
 def portfolios_index():
-    portfolios = Portfolios.query.all()
-    result = []
-    for p in portfolios:
-        result.append(p.serialize()) 
-    return jsonify(result)
+    return list_response(Portfolios.query, Portfolios.id, schema=serializers.PORTFOLIO)
 
 #portfolio_customer (get all portfolios for a customer) ###untested
-@app.route('/customers/<id>/portfolios', methods = ['GET'])
+@bp.route('/customers/<id>/portfolios', methods = ['GET'])
+@replica_reads
 def customer_portfolios(id: int):
-    customer_id = id
-    portfolios = Portfolios.query.filter(Portfolios.customer_id == customer_id).all()
-    result = []
-    for p in portfolios:
-        result.append(p.serialize()) 
-    return jsonify(result)
+    customer_id = to_uuid(id, 'customer_id')
+    portfolios = Portfolios.query.filter(Portfolios.customer_id == customer_id)
+    return json_response(serializers.PORTFOLIO.dump_query(portfolios))
 
 # customer_portfolio_positions (show portfolio positions for a customer) 
 # JOIN customer, on customer_id w    portfolios    on portfolio_id w    positions    on ticker_id with    tickers 
 
-@app.route('/customers/<id>/positions', methods = ['GET'])
+@bp.route('/customers/<id>/positions', methods = ['GET'])
+@replica_reads
 def customer_positions(id: int):
-    customer_id = id
-    portfolio_id = Portfolios.query.filter(Portfolios.customer_id == customer_id).first()
-    print(portfolio_id)
-    positions = Positions.query.filter(Positions.portfolio_id == portfolio_id.id).all()
+    customer_id = to_uuid(id, 'customer_id')
+    positions = Positions.query.filter(Positions.portfolio_id == first_portfolio_id(customer_id)).all()
     result = []
     for p in positions:
         result.append(p.serialize())
@@ -490,69 +1014,106 @@ def customer_positions(id: int):
 # customer portfolio positions tickers
 # JOIN customer, on customer_id w    portfolios    on portfolio_id w    positions    on ticker_id with    tickers 
 
-@app.route('/customers/<id>/tickers', methods = ['GET'])
+@bp.route('/customers/<id>/tickers', methods = ['GET'])
+@replica_reads
 def customer_tickers(id: int):
-    customer_id = id
-    portfolio = Portfolios.query.filter(Portfolios.customer_id == customer_id).first()
-    positions = Positions.query.filter(Positions.portfolio_id == portfolio.id).all()
-    positions_result = []
-    for p in positions:
-        positions_result.append(p.serialize())
-    
+    customer_id = to_uuid(id, 'customer_id')
+    # one round trip for every ticker in the portfolio instead of one query per position
+    holdings = (db.session.query(Tickers, Positions)
+                .join(Positions, Positions.ticker_id == Tickers.id)
+                .filter(Positions.portfolio_id == first_portfolio_id(customer_id))
+                .all())
     result = []
-    ticker_list = []
-
-    for r in positions_result:
-        ticker_id = r['ticker_id']
-        ticker_list.append(ticker_id)
-
-
-    for t in ticker_list:
-        tickers = Tickers.query.filter(Tickers.id == t).all()
-        for t in tickers:
-                result.append(t.serialize())
+    for t, p in holdings:
+        result.append(dict(t.serialize(), price=float(p.average_cost()), quantity=p.quantity))
     return jsonify(result)
 
 
+def first_portfolio_id(customer_id):
+    """ the customer's (first) portfolio as a scalar subquery, 404 handling is left to the caller"""
+    return (db.session.query(Portfolios.id)
+            .filter(Portfolios.customer_id == customer_id)
+            .limit(1)
+            .scalar_subquery())
+
+
+def price_of(closes: dict, symbol: str, position: Positions):
+    """ (close, price day) for a holding from stored_closes(); a ticker that has never been priced
+    is valued at what was paid for it, with no price day"""
+    return closes.get(symbol, (position.average_cost(), None))
+
+
+# customer_valuation (market value of every position in every portfolio of a customer)
+# ?date= values the current holdings at the stored closes as of that day (default: latest stored)
+@bp.route('/customers/<id>/valuation', methods = ['GET'])
+@replica_reads
+def customer_valuation(id: int):
+    customer_id = to_uuid(id, 'customer_id')
+    day = parse_datetime_arg('date')
+    # the whole tree in one SELECT: portfolios LEFT JOIN positions LEFT JOIN tickers
+    portfolios = (Portfolios.query
+                  .filter(Portfolios.customer_id == customer_id)
+                  .options(joinedload(Portfolios.positions).joinedload(Positions.tickers))
+                  .all())
+    if not portfolios:
+        abort(404, description="Customer has no portfolio")
+
+    holdings = [(portfolio, position) for portfolio in portfolios for position in portfolio.positions
+                if position.tickers is not None]
+    # every distinct ticker's stored close in one query (see valuation.py), then a single pass to value them
+    closes = stored_closes((position.tickers.ticker for _, position in holdings), day.date() if day else None)
+
+    totals = {portfolio.id: [Decimal(0), Decimal(0)] for portfolio in portfolios}
+    positions = {portfolio.id: [] for portfolio in portfolios}
+    for portfolio, position in holdings:
+        ticker = position.tickers
+        close, price_day = price_of(closes, ticker.ticker, position)
+        value = close * position.quantity
+        cost = position.cost_basis
+        totals[portfolio.id][0] += value
+        totals[portfolio.id][1] += cost
+        positions[portfolio.id].append({
+            'position_id': str(position.id),
+            'ticker': ticker.ticker,
+            'quantity': position.quantity,
+            'close': float(close),
+            'price_date': price_day.isoformat() if price_day else None,
+            'market_value': float(value),
+            'cost': float(cost),
+            'unrealized_gain': float(value - cost),
+        })
 
+    result = []
+    for portfolio in portfolios:
+        value, cost = totals[portfolio.id]
+        result.append({
+            'id': str(portfolio.id),
+            'market_value': float(value),
+            'cost': float(cost),
+            'unrealized_gain': float(value - cost),
+            'positions': positions[portfolio.id],
+        })
+    return jsonify({
+        'customer_id': str(customer_id),
+        'market_value': float(sum(total[0] for total in totals.values())),
+        'portfolios': result,
+    })
 
-# customer positions tickers (Get ticker sell price from polygon API)
-@app.route('/positions/<id>/tickers', methods = ['GET'])
 
+# customer positions tickers (Get ticker sell price from polygon API)
+@bp.route('/positions/<id>/tickers', methods = ['GET'])
+@replica_reads
 def positions_tickers(id: int):
-    position_id = id
-    ticker_id = Positions.query.filter(Positions.id == position_id).first()
-    ticker_row = Tickers.query.filter(Tickers.id == ticker_id.ticker_id).first()
-    ticker = ticker_row.ticker
-  
-    ##############  POLYGON API CALL  ######################################
-
-    """Get the current price of a ticker.
-
-    :param ticker: The ticker to get the price of.
-    :type ticker: str
-    :return: The current price of the ticker.
-    :rtype: float
-    """
-    api_key = "6dUHDmEeO0iPwf0NJ3g3ehpw_8YgLLXd"
-    yest_date = (datetime.today() - timedelta(days=1)).strftime("%Y-%m-%d")
-    url = f"https://api.polygon.io/v1/open-close/{ticker}/{yest_date}?adjusted=true&apiKey={api_key}"
-    # print(url)
-    response = requests.get(url)
-    if response.status_code == 200:
-        # print(response.json()['close'])
-        ticker_value = response.json()["close"] * ticker_row.quantity
-        ticker_value_dict = {f"{ticker}_position_value": ticker_value}
-        ######THIS IS NOT "JSONIFIED", BC I NEED TO USE THE RETURN VALUE IN ANOTHER FUNCTION, AND IF YOU JSONIFY IT, IT WILL NOT BE SERIALIZABLE########
-        return (ticker_value_dict)
-    else:
-        raise Exception('Error getting price of ticker: ' + ticker)
-    
-    ############### END OF POLYGON API CALL  ################################
+    position = Positions.query.get_or_404(to_uuid(id, 'position_id'))
+    ticker = position.tickers.ticker
+    close, _ = price_of(stored_closes([ticker]), ticker, position)
+    ticker_value = float(close * position.quantity)
+    ######THIS IS NOT "JSONIFIED", BC I NEED TO USE THE RETURN VALUE IN ANOTHER FUNCTION, AND IF YOU JSONIFY IT, IT WILL NOT BE SERIALIZABLE########
+    return {f"{ticker}_position_value": ticker_value}
 
 
 # # get price of ticker from polygon API
-# @app.route('/ticker_price')
+# @bp.route('/ticker_price')
 # def ticker_price():
 #     if "ticker" in request.json and "quantity" in request.json:
 #         ticker = request.json(['ticker'])
@@ -571,128 +1132,301 @@ def positions_tickers(id: int):
 
 
 # portfolio_positions (show portfolio positions VALUES for a portfolio)
-@app.route('/portfolios/<id>/positions', methods = ['GET'])
+@bp.route('/portfolios/<id>/positions', methods = ['GET'])
+@replica_reads
 def portfolio_positions(id: int):
-    portfolio_id = id
-    positions = Positions.query.filter(Positions.portfolio_id == portfolio_id).all()
+    portfolio_id = to_uuid(id, 'portfolio_id')
+    # one query for the positions and their tickers, one for their stored prices; no outbound calls
+    holdings = (db.session.query(Tickers.ticker, Positions)
+                .join(Positions, Positions.ticker_id == Tickers.id)
+                .filter(Positions.portfolio_id == portfolio_id)
+                .all())
+    closes = stored_closes(h.ticker for h in holdings)
     result = []
-    for p in positions:
-        position_value = positions_tickers(p.id)
-        result.append(position_value)
+    for h in holdings:
+        close, _ = price_of(closes, h.ticker, h.Positions)
+        result.append({f"{h.ticker}_position_value": float(close * h.Positions.quantity)})
     return (jsonify(result))
 
+# portfolio_value_history (daily market value of the portfolio's current holdings from stored prices)
+# ?from= defaults to 30 days ago, ?to= to today
+VALUE_HISTORY_MAX_DAYS = 3660
+
+@bp.route('/portfolios/<id>/valuation/history', methods = ['GET'])
+@replica_reads
+def portfolio_value_history(id: int):
+    portfolio = Portfolios.query.get_or_404(to_uuid(id, 'portfolio_id'))
+    end = parse_datetime_arg('to')
+    end = end.date() if end else date.today()
+    start = parse_datetime_arg('from')
+    start = start.date() if start else end - timedelta(days=30)
+    if end < start or (end - start).days > VALUE_HISTORY_MAX_DAYS:
+        abort(400, description=f"from must be before to and at most {VALUE_HISTORY_MAX_DAYS} days earlier")
+    return jsonify({
+        'portfolio_id': str(portfolio.id),
+        'values': [{'date': day.isoformat(), 'market_value': float(value)}
+                   for day, value in valuation.value_history(portfolio.id, start, end)],
+    })
+
+def instrument_id(symbol: str):
+    """ the catalog id for a ticker symbol, adding it to the catalog the first time it's bought"""
+    found = db.session.execute(db.select(Tickers.id).where(Tickers.ticker == symbol)).scalar()
+    if found is not None:
+        return found
+    # two first-time buys of a symbol can race here; ON CONFLICT lets the second one use the first's row
+    db.session.execute(insert(Tickers).values(id=uuid.uuid4(), ticker=symbol).on_conflict_do_nothing(index_elements=['ticker']))
+    return db.session.execute(db.select(Tickers.id).where(Tickers.ticker == symbol)).scalar()
+
+
+def fill_buy(order: Orders, price: Decimal) -> Accounts:
+    """ fill a queued buy at `price` in the caller's transaction (see orders.py) and mark it filled;
+    returns the account it was paid from"""
+    total_cost = (price * order.quantity).quantize(CENTS, rounding=ROUND_HALF_UP)
+    # the debit, the position change and the ledger row are one unit of work; the account must be
+    # a checking account (acct_type_id 1) with enough money, which adjust_balance checks in the UPDATE
+    account = adjust_balance(order.account_id, -total_cost, acct_type_id=1)
+
+    # open the position or add to it in one statement; the unique (portfolio_id, ticker_id)
+    # constraint makes concurrent buys of the same ticker add up instead of making two positions
+    stmt = insert(Positions).values(id=uuid.uuid4(), portfolio_id=order.portfolio_id, ticker_id=instrument_id(order.ticker),
+                                    quantity=order.quantity, cost_basis=total_cost)
+    position_id = db.session.execute(
+        stmt.on_conflict_do_update(
+            constraint='uq_positions_portfolio_id_ticker_id',
+            set_={'quantity': Positions.quantity + stmt.excluded.quantity,
+                  'cost_basis': Positions.cost_basis + stmt.excluded.cost_basis})
+        .returning(Positions.id)).scalar()
+    # and the shares bought become a tax lot of their own for sells to draw on
+    db.session.add(PositionLots(position_id=position_id, quantity=order.quantity, remaining=order.quantity, cost_basis=total_cost))
+
+    transaction = record_transaction(
+        customer_id=account.customer_id,
+        debit_id=account.id,
+        credit_id=order.portfolio_id,
+        amount=total_cost,
+        note=f"Buy {order.quantity} shares of {order.ticker} for {total_cost}; credited to portfolio at {datetime.now()}")
+    order.status = 'filled'
+    order.price = price
+    order.total_cost = total_cost
+    order.position_id = position_id
+    order.transaction_id = transaction.id
+    order.completed_at = datetime.utcnow()
+    return account
+
+
 # portfolio_positions_tickers (BUY stock with money from checking acct)
-@app.route('/portfolios/<id>/positions/buy', methods = ['POST'])
+# only queues the order and answers 202 with it: `flask orders work` prices and fills it (see
+# orders.py) and GET /orders/<id> tells the client how it went
+@bp.route('/portfolios/<id>/positions/buy', methods = ['POST'])
+@rate_limited()
+@idempotent
 def buy_ticker(id: int):
     portfolio_id = id
     if "ticker" in request.json and "quantity" in request.json and "account_id" in request.json:
-        ticker = request.json["ticker"]
-        # ticker_row = Tickers.query.filter(Tickers.ticker == ticker).first()
-        # ticker_id = ticker_row.id
+        ticker = str(request.json["ticker"]).strip().upper()
         quantity = request.json["quantity"]
         account_id = request.json["account_id"]
-        account_row = Accounts.query.filter(Accounts.id == account_id).first()
+        if not ticker or len(ticker) > 128:
+            abort(400, description="ticker must be a symbol of 1 to 128 characters")
+        if not isinstance(quantity, int) or quantity <= 0:
+            abort(400, description="quantity must be a positive whole number of shares")
+
+        portfolio_id = to_uuid(portfolio_id, 'portfolio_id')
+        account_id = to_uuid(account_id, 'account_id')
+        portfolio = db.session.get(Portfolios, portfolio_id)
+        if portfolio is None:
+            raise NotFound("Portfolio not found")
+        # what can be checked now is; the balance is only known once the order is priced
+        account = db.session.get(Accounts, account_id)
+        if account is None:
+            raise NotFound("Account not found")
+        if account.customer_id != portfolio.customer_id:
+            raise Forbidden("Account does not belong to the portfolio's customer")
+        if account.acct_type_id != 1:
+            raise BadRequest("Funding account must be a checking account")
+
+        # id, status and created_at set here so the order can be returned without reading it back
+        order = Orders(id=uuid7(), portfolio_id=portfolio_id, account_id=account_id, ticker=ticker, quantity=quantity,
+                       status='pending', attempts=0, created_at=datetime.utcnow())
+        db.session.add(order)
+        result = order.serialize()
+        db.session.commit()
+        return jsonify(result), 202, {'Location': url_for('bank.order_show', id=result['id'])}
+    else:
+        abort(400, description="Missing required fields")
 
 
-   ##########  POLYGON API CALL ######################################
-        api_key = "6dUHDmEeO0iPwf0NJ3g3ehpw_8YgLLXd"
-        yest_date = (datetime.today() - timedelta(days=1)).strftime("%Y-%m-%d")
-        url = f"https://api.polygon.io/v1/open-close/{ticker}/{yest_date}?adjusted=true&apiKey={api_key}"
-        response = requests.get(url)
-        if response.status_code == 200:
-            ticker_value = response.json()["close"]
-        else:
-            raise Exception('Error getting price of ticker: ' + ticker)
-   ############ END OF POLYGON API CALL ##############################
-
-        total_cost = ticker_value * quantity
-        # check to see if account if account is a checking account and has enough money to buy stock
-        if account_row.acct_type_id == 1:
-            balance = float(account_row.balance)
-            if balance >= total_cost:
-                balance -= total_cost
-                balance = round(balance, 2)
-                account_row.balance = balance
-                db.session.commit()
-
-                # check to see if ticker in any positions, if so, add quantity to that ticker:
-                
-                all_portfolios_positions = Positions.query.filter(Positions.portfolio_id == portfolio_id).all()
-                all_position_ticker_ids = []
-                all_position_tickers = []
-                print("===================================== all portfolios positions line 621", all_portfolios_positions)
-                for p in all_portfolios_positions:
-                    all_position_ticker_ids.append(p.ticker_id)
-                for i in all_position_ticker_ids:
-                    ticker_row = Tickers.query.filter(Tickers.id == i).first()
-                    all_position_tickers.append(ticker_row.ticker)
-                print("===================================== all position ticker_ids line 625", all_position_ticker_ids)
-                print("===================================== all position line 626", all_position_tickers)
-                # is this ticker in the list?
-                if ticker in all_position_tickers:
-                    for p in all_position_tickers:
-                        if p == ticker:
-                            match_ticker_id = Tickers.query.filter(Tickers.ticker == ticker).first()
-                            ticker_to_update = Tickers.query.filter(Tickers.id == match_ticker_id.id).first()
-                            ticker_to_update.quantity += quantity
-                            db.session.commit()
-                            customer_id = Customers.query.filter(Customers.id == portfolio_id).first()
-                            transaction_data = {
-                                "id": uuid.uuid4(),
-                                "customer_id": customer_id,
-                                "debit_id": account_id,
-                                "credit_id": portfolio_id,
-                                "amount": total_cost,
-                                "note": f"Buy, added {quantity} shares of {ticker} for {total_cost}; added to position at {datetime.now()}"
-                            }
-                            updated_ticker_row = Tickers.query.filter(Tickers.id == match_ticker_id).first()
-                            new_transaction = Transactions(**transaction_data)
-                            db.session.add(new_transaction)
-                            db.session.commit()
-                            return jsonify(updated_ticker_row.serialize(), new_transaction.serialize())
-
-                # if ticker not in any positions, create new ticker and position:
-                else:
-                    new_ticker_id = uuid.uuid4()
-                    new_position_id = uuid.uuid4()
-
-                    new_ticker = Tickers(id = new_ticker_id, ticker = ticker, price = ticker_value, quantity = quantity)
-                    db.session.add(new_ticker)
-                    db.session.commit()
-
-                    new_position = Positions(id = new_position_id, ticker_id = new_ticker_id, portfolio_id = portfolio_id)
-                    db.session.add(new_position)
-                    db.session.commit()
-                    customer_row = Customers.query.filter(Customers.id == account_row.customer_id).first()
-
-                    customer_id = customer_row.id
-                    portfolio_id = new_position.portfolio_id
-                    transaction_data = {
-                        "id": uuid.uuid4(),
-                        "customer_id": customer_id,
-                        "debit_id": account_id,
-                        "credit_id": portfolio_id,
-                        "amount": total_cost,
-                        "note": f"Buy {quantity} shares of {ticker} for {total_cost}; created new position, credited to portfolio at {datetime.now()}"
-                    }
-                    new_transaction = Transactions(**transaction_data)
-                    db.session.add(new_transaction)
-                    db.session.commit()
-
-                    return jsonify(new_ticker.serialize(), new_position.serialize(), new_transaction.serialize())
-            else:
-                return jsonify("Insufficient funds")
-        else:
-            return jsonify("Funding account must be a checking account")
-    else:
-        return jsonify("Missing required fields")
+# order_show (a queued buy: pending, filled with its price, position and ledger row, or rejected and why)
+@bp.route('/orders/<id>', methods = ['GET'])
+def order_show(id: int):
+    return jsonify(Orders.query.get_or_404(to_uuid(id, 'order_id')).serialize())
     
 
-# @app.route('/portfolios/<id>/positions/sell', methods = ['POST'])
-# def sell_ticker(id: int):
-#     portfolio_id = id
-    
+##### selling and P&L #####
+# A sell uses up tax lots, oldest first (method "fifo", the default) or the ones the client names
+# (method "specific", with lots: [{"lot_id": ..., "quantity": n}, ...]). Each lot used gives up a
+# share of its cost in proportion to the shares taken, and proceeds minus that cost is the realized
+# gain. The position's quantity, cost_basis and realized_pnl are moved on in the same transaction
+# as the cash credit and the ledger row, so P&L is read straight off the positions.
+
+def lots_to_sell(position: Positions, quantity: int, method: str, requested) -> list:
+    """ [(lot, shares taken)] for selling `quantity` shares of a locked position, locking the lots"""
+    if method == 'fifo':
+        lots = (PositionLots.query
+                .filter(PositionLots.position_id == position.id, PositionLots.remaining > 0)
+                .order_by(PositionLots.acquired_at, PositionLots.id)
+                .with_for_update()
+                .all())
+        taken = []
+        for lot in lots:
+            if quantity == 0:
+                break
+            shares = min(lot.remaining, quantity)
+            taken.append((lot, shares))
+            quantity -= shares
+        return taken
+
+    if method != 'specific':
+        abort(400, description="method must be fifo or specific")
+    if not isinstance(requested, list) or not requested:
+        abort(400, description="a specific-lot sell needs lots: [{lot_id, quantity}, ...]")
+    wanted = {}
+    for item in requested:
+        shares = item.get('quantity') if isinstance(item, dict) else None
+        if not isinstance(shares, int) or shares <= 0:
+            abort(400, description="each lot needs a lot_id and a positive whole quantity")
+        lot_id = to_uuid(item.get('lot_id'), 'lot_id')
+        wanted[lot_id] = wanted.get(lot_id, 0) + shares
+    if sum(wanted.values()) != quantity:
+        abort(400, description="the lot quantities must add up to the quantity sold")
+    lots = (PositionLots.query
+            .filter(PositionLots.id.in_(wanted), PositionLots.position_id == position.id)
+            .order_by(PositionLots.id)
+            .with_for_update()
+            .all())
+    if len(lots) != len(wanted):
+        abort(400, description="every lot must belong to this position")
+    for lot in lots:
+        if lot.remaining < wanted[lot.id]:
+            abort(400, description=f"lot {lot.id} only has {lot.remaining} shares left")
+    return [(lot, wanted[lot.id]) for lot in lots]
+
+
+# sell_ticker (SELL stock, crediting the proceeds to a checking account)
+@bp.route('/portfolios/<id>/positions/sell', methods = ['POST'])
+@rate_limited()
+@idempotent
+def sell_ticker(id: int):
+    portfolio = Portfolios.query.get_or_404(to_uuid(id, 'portfolio_id'))
+    data = request.get_json(silent=True) or {}
+    if "ticker" not in data or "quantity" not in data or "account_id" not in data:
+        abort(400, description="ticker, quantity and account_id are required")
+    ticker = str(data["ticker"]).strip().upper()
+    quantity = data["quantity"]
+    if not isinstance(quantity, int) or quantity <= 0:
+        abort(400, description="quantity must be a positive whole number of shares")
+
+    price_day = valuation_day()
+    close = prices.close_price(ticker, price_day)
+    proceeds = (close * quantity).quantize(CENTS, rounding=ROUND_HALF_UP)
 
+    try:
+        # account first, then the position: the same lock order as a buy
+        account = adjust_balance(data["account_id"], proceeds, customer_id=portfolio.customer_id, acct_type_id=1)
+        position = (Positions.query
+                    .join(Tickers, Positions.ticker_id == Tickers.id)
+                    .filter(Positions.portfolio_id == portfolio.id, Tickers.ticker == ticker)
+                    .with_for_update(of=Positions)
+                    .first())
+        if position is None or position.quantity < quantity:
+            abort(400, description=f"Not enough {ticker} shares in this portfolio")
+        store_closes({ticker: close}, price_day, overwrite=False)
+
+        sold_lots = []
+        cost = Decimal(0)
+        for lot, shares in lots_to_sell(position, quantity, data.get('method', 'fifo'), data.get('lots')):
+            lot_cost = lot.cost_basis if shares == lot.remaining else \
+                (lot.cost_basis * shares / lot.remaining).quantize(CENTS, rounding=ROUND_HALF_UP)
+            lot.remaining -= shares
+            lot.cost_basis -= lot_cost
+            cost += lot_cost
+            sold_lots.append({'lot_id': str(lot.id), 'quantity': shares, 'cost': float(lot_cost)})
+
+        realized = proceeds - cost
+        position.quantity -= quantity
+        position.cost_basis -= cost
+        position.realized_pnl += realized
+
+        new_transaction = record_transaction(
+            customer_id=account.customer_id,
+            debit_id=portfolio.id,
+            credit_id=account.id,
+            amount=proceeds,
+            note=f"Sell {quantity} shares of {ticker} for {proceeds}; credited to account at {datetime.now()}")
+        result = {
+            'position': position.serialize(),
+            'proceeds': float(proceeds),
+            'cost': float(cost),
+            'realized_pnl': float(realized),
+            'lots': sold_lots,
+            'transaction': new_transaction.serialize(),
+        }
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_accounts([(account.id, account.customer_id)])
+    return jsonify(result)
+
+
+# position_lots (the open and used-up tax lots of a position, oldest first)
+@bp.route('/positions/<id>/lots', methods = ['GET'])
+@replica_reads
+def position_lots(id: int):
+    position_id = to_uuid(id, 'position_id')
+    lots = PositionLots.query.filter(PositionLots.position_id == position_id).order_by(PositionLots.acquired_at, PositionLots.id)
+    return jsonify([lot.serialize() for lot in lots])
+
+
+# portfolio_pnl (realized P&L and, at the latest stored closes, unrealized P&L per position and in total)
+@bp.route('/portfolios/<id>/pnl', methods = ['GET'])
+@replica_reads
+def portfolio_pnl(id: int):
+    portfolio = Portfolios.query.get_or_404(to_uuid(id, 'portfolio_id'))
+    holdings = (db.session.query(Tickers.ticker, Positions)
+                .join(Positions, Positions.ticker_id == Tickers.id)
+                .filter(Positions.portfolio_id == portfolio.id)
+                .all())
+    closes = stored_closes(h.ticker for h in holdings if h.Positions.quantity > 0)
+
+    totals = {'market_value': Decimal(0), 'cost_basis': Decimal(0), 'realized_pnl': Decimal(0)}
+    positions = []
+    for h in holdings:
+        position = h.Positions
+        close, price_day = price_of(closes, h.ticker, position)
+        value = close * position.quantity
+        totals['market_value'] += value
+        totals['cost_basis'] += position.cost_basis
+        totals['realized_pnl'] += position.realized_pnl
+        positions.append({
+            'position_id': str(position.id),
+            'ticker': h.ticker,
+            'quantity': position.quantity,
+            'close': float(close),
+            'price_date': price_day.isoformat() if price_day else None,
+            'market_value': float(value),
+            'cost_basis': float(position.cost_basis),
+            'unrealized_pnl': float(value - position.cost_basis),
+            'realized_pnl': float(position.realized_pnl),
+        })
+    return jsonify({
+        'portfolio_id': str(portfolio.id),
+        'market_value': float(totals['market_value']),
+        'cost_basis': float(totals['cost_basis']),
+        'unrealized_pnl': float(totals['market_value'] - totals['cost_basis']),
+        'realized_pnl': float(totals['realized_pnl']),
+        'positions': positions,
+    })
 
 
 
@@ -700,7 +1434,7 @@ def buy_ticker(id: int):
 ############# END OF (PORTFOLIO) POSITIONS ENDPOINTS ###########
 
 # This is where we tell it to start runnning and start listening
-##### this would go in your wsgi.py file if you were using a more separated file structure
+##### under gunicorn the entry point is wsgi.py (see gunicorn.conf.py); this is for local runs
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug = True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=5000, debug = True)
\ No newline at end of file
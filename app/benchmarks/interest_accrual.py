@@ -0,0 +1,127 @@
+"""Interest accrual benchmark on synthetic accounts.
+
+Creates --accounts accounts spread over three account types (no interest, a savings rate with a
+min_balance, a higher rate with a higher min_balance) with random balances, then times
+interest.accrue_interest() for one day at each --chunk-sizes value and checks the ledger rows it
+posted add up to the balance change. `--orm-sample N` also times the row-by-row ORM loop on N
+accounts for comparison (it is far too slow to run over all of them).
+
+Needs a Postgres 13+ database with the schema in place (or pass --create-schema); the synthetic
+accounts are left behind, so point it at a scratch database:
+
+    DATABASE_URL=postgresql://postgres@localhost:5432/bank_bench \\
+        python benchmarks/interest_accrual.py --accounts 1000000 --chunk-sizes 1000 5000 20000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import date, timedelta
+from decimal import Decimal, ROUND_HALF_UP
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bank  # noqa: E402
+from interest import accrue_interest  # noqa: E402
+from models import InterestRuns  # noqa: E402
+
+app = bank.create_app()
+db = bank.db
+
+ACCOUNT_TYPES = [
+    # id, type, interest_rate, min_balance
+    (901, 'bench checking', Decimal('0'), Decimal('0')),
+    (902, 'bench savings', Decimal('0.02'), Decimal('100')),
+    (903, 'bench money market', Decimal('0.045'), Decimal('10000')),
+]
+
+
+def setup(accounts: int, create_schema: bool):
+    """ account types, one customer and `accounts` accounts with balances between 0 and 50,000"""
+    if create_schema:
+        db.create_all()
+    for type_id, name, rate, min_balance in ACCOUNT_TYPES:
+        if db.session.get(bank.AccountTypes, type_id) is None:
+            db.session.add(bank.AccountTypes(id=type_id, type=name, interest_rate=rate, min_balance=min_balance))
+    customer = bank.Customers(first_name='bench', last_name='interest', pin=1234, password='x')
+    db.session.add(customer)
+    db.session.commit()
+    start = time.perf_counter()
+    db.session.execute(db.text("""
+        INSERT INTO accounts (id, balance, hold, acct_type_id, customer_id)
+        SELECT gen_random_uuid(), round((random() * 50000)::numeric, 2), false, 901 + (n % 3), :customer_id
+        FROM generate_series(1, :accounts) AS n
+    """), {'customer_id': str(customer.id), 'accounts': accounts})
+    db.session.commit()
+    print(f"created {accounts} accounts in {time.perf_counter() - start:.1f}s")
+
+
+def unused_date() -> date:
+    """ a day with no interest run yet, so every measurement starts from scratch"""
+    earliest = db.session.execute(db.select(db.func.min(InterestRuns.accrual_date))).scalar()
+    return (earliest or date(2000, 1, 1)) - timedelta(days=1)
+
+
+def bank_totals():
+    return db.session.execute(db.text("SELECT coalesce(sum(balance), 0), count(*) FROM accounts")).one()
+
+
+def orm_loop(limit: int, accrual_date: date):
+    """ the row-by-row way: load each account and its type, compute in python, write both rows"""
+    note = f"Interest for {accrual_date.isoformat()} (orm)"
+    accounts = bank.Accounts.query.order_by(bank.Accounts.id).limit(limit).all()
+    for account in accounts:
+        account_type = db.session.get(bank.AccountTypes, account.acct_type_id)
+        if account_type.interest_rate <= 0 or account.balance < account_type.min_balance:
+            continue
+        amount = (account.balance * account_type.interest_rate / 365).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        if amount <= 0:
+            continue
+        account.balance += amount
+        db.session.add(bank.Transactions(amount=amount, note=note, credit_id=account.id, customer_id=account.customer_id))
+        db.session.commit()
+    return len(accounts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=200000)
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--orm-sample', type=int, default=0, help='also time the row-by-row ORM loop on this many accounts')
+    parser.add_argument('--skip-setup', action='store_true', help='reuse the accounts from an earlier run')
+    parser.add_argument('--create-schema', action='store_true')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_ECHO'] = False
+    with app.app_context():
+        if not args.skip_setup:
+            setup(args.accounts, args.create_schema)
+        total_accounts = bank_totals()[1]
+
+        for chunk_size in args.chunk_sizes:
+            accrual_date = unused_date()
+            balance_before = bank_totals()[0]
+            start = time.perf_counter()
+            run = accrue_interest(accrual_date, chunk_size)
+            elapsed = time.perf_counter() - start
+            balance_after = bank_totals()[0]
+            posted = db.session.execute(
+                db.select(db.func.coalesce(db.func.sum(bank.Transactions.amount), 0))
+                .where(bank.Transactions.note == f"Interest for {accrual_date.isoformat()}")).scalar()
+            ok = posted == run.total_interest == balance_after - balance_before
+            print(f"set-based  chunk={chunk_size:<6} {total_accounts} accounts in {elapsed:7.2f}s "
+                  f"({total_accounts / elapsed:9.0f} accounts/s)  credited={run.accounts_credited} "
+                  f"interest={run.total_interest} ledger {'matches' if ok else 'DOES NOT MATCH'}")
+            if not ok:
+                sys.exit(1)
+
+        if args.orm_sample:
+            start = time.perf_counter()
+            processed = orm_loop(args.orm_sample, unused_date())
+            elapsed = time.perf_counter() - start
+            print(f"row-by-row ORM           {processed} accounts in {elapsed:7.2f}s "
+                  f"({processed / elapsed:9.0f} accounts/s)")
+
+
+if __name__ == '__main__':
+    main()
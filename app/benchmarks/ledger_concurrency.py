@@ -0,0 +1,119 @@
+"""Concurrency benchmark for the ledger: parallel writers against one account.
+
+Runs N threads that each post M deposits (and, with --withdrawals, the same number of
+withdrawals) of a fixed amount to the same account through the real Flask endpoints,
+then checks that the final balance and the number of Transactions rows match what was
+posted. `--mode naive` runs the old read-balance-in-python-then-write pattern instead,
+so you can see the lost updates it produces under the same load.
+
+Needs a Postgres database with the schema in place (or pass --create-schema):
+
+    DATABASE_URL=postgresql://postgres@localhost:5432/bank_bench \\
+        python benchmarks/ledger_concurrency.py --writers 16 --ops 200
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bank  # noqa: E402
+
+app = bank.create_app()
+
+
+def setup_account(create_schema: bool):
+    """ make a throwaway customer with a checking account holding 1,000,000.00"""
+    with app.app_context():
+        if create_schema:
+            bank.db.create_all()
+        if bank.db.session.get(bank.AccountTypes, 1) is None:
+            bank.db.session.add(bank.AccountTypes(id=1, type='checking'))
+        customer = bank.Customers(first_name='bench', last_name='writer', pin=1234, password='x')
+        bank.db.session.add(customer)
+        bank.db.session.flush()
+        account = bank.Accounts(balance=Decimal('1000000.00'), acct_type_id=1, customer_id=customer.id)
+        bank.db.session.add(account)
+        bank.db.session.commit()
+        return str(customer.id), str(account.id), account.balance
+
+
+def naive_movement(account_id, customer_id, amount: Decimal):
+    """ the pre-ledger pattern: read the balance, change it in python, commit, then commit the ledger row"""
+    account = bank.Accounts.query.get(account_id)
+    account.balance = float(account.balance) + float(amount)
+    bank.db.session.commit()
+    bank.db.session.add(bank.Transactions(customer_id=customer_id, amount=abs(amount), note='bench',
+                                          credit_id=account.id if amount > 0 else None,
+                                          debit_id=account.id if amount < 0 else None))
+    bank.db.session.commit()
+
+
+def writer(mode, customer_id, account_id, ops, amount, withdrawals, latencies, errors):
+    client = app.test_client()
+    movements = [('deposit', amount)] * ops + ([('withdrawal', -amount)] * ops if withdrawals else [])
+    for kind, delta in movements:
+        start = time.perf_counter()
+        if mode == 'ledger':
+            response = client.post(f'/accounts/{account_id}/{kind}',
+                                   json={'amount': str(amount), 'customer_id': customer_id, 'pin': 1234})
+            if response.status_code != 200:
+                errors.append(response.status_code)
+        else:
+            with app.app_context():
+                naive_movement(account_id, customer_id, delta)
+        latencies.append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=100, help='deposits per writer')
+    parser.add_argument('--amount', default='1.00')
+    parser.add_argument('--withdrawals', action='store_true', help='also post one withdrawal per deposit')
+    parser.add_argument('--mode', choices=['ledger', 'naive'], default='ledger')
+    parser.add_argument('--create-schema', action='store_true')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': args.writers, 'max_overflow': 0}
+
+    amount = Decimal(args.amount)
+    customer_id, account_id, opening = setup_account(args.create_schema)
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=writer, args=(args.mode, customer_id, account_id, args.ops, amount,
+                                                     args.withdrawals, latencies, errors))
+               for _ in range(args.writers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        balance = bank.db.session.get(bank.Accounts, account_id).balance
+        rows = bank.Transactions.query.filter(bank.db.or_(bank.Transactions.debit_id == account_id,
+                                                          bank.Transactions.credit_id == account_id)).count()
+
+    deposits = args.writers * args.ops
+    movements = deposits * (2 if args.withdrawals else 1)
+    expected = opening + (0 if args.withdrawals else deposits * amount)
+    lost = (expected - Decimal(balance)) / amount
+
+    latencies.sort()
+    print(f"mode={args.mode} writers={args.writers} movements={movements} errors={len(errors)}")
+    print(f"elapsed={elapsed:.2f}s throughput={movements / elapsed:.0f} movements/s "
+          f"p50={latencies[len(latencies) // 2] * 1000:.1f}ms p99={latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f}ms")
+    print(f"expected balance={expected} actual balance={balance} lost updates={lost}")
+    print(f"ledger rows={rows} (expected {movements})")
+    if lost != 0 or rows != movements:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
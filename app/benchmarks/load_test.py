@@ -0,0 +1,138 @@
+"""HTTP load-test harness: requests/sec and latency per runtime profile.
+
+For each config profile this starts the app under gunicorn with gunicorn.conf.py (BANK_CONFIG set
+to the profile, plus any --env overrides), waits for /readyz, then runs `--concurrency` keep-alive
+clients against `--paths` for `--duration` seconds. Results are printed and, with --out, appended
+as one JSON object per run so profiles and settings can be compared over time.
+
+    DATABASE_URL=postgresql://postgres@localhost:5432/bank \\
+        python benchmarks/load_test.py --profiles development production \\
+            --env GUNICORN_WORKERS=4 --env GUNICORN_THREADS=4 --out bench_runs.jsonl
+
+Use --url to load an already running server instead (the profile is then only a label).
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PATHS = ['/healthz', '/customers?limit=100', '/accounts?limit=100', '/transactions?limit=100']
+
+
+def start_server(profile, port, env_overrides):
+    env = dict(os.environ, BANK_CONFIG=profile, GUNICORN_BIND=f'127.0.0.1:{port}', GUNICORN_ACCESSLOG='')
+    env.update(env_overrides)
+    server = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'], cwd=APP_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(url + '/readyz', timeout=1).status_code == 200:
+                return server, url
+        except requests.RequestException:
+            pass
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {server.returncode} for profile {profile}")
+        time.sleep(0.25)
+    server.send_signal(signal.SIGTERM)
+    raise RuntimeError(f"server for profile {profile} never became ready")
+
+
+def load(url, paths, concurrency, duration):
+    latencies, errors = [], []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(offset):
+        session = requests.Session()
+        mine, failed = [], 0
+        i = offset
+        while time.perf_counter() < stop_at:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.perf_counter()
+            try:
+                response = session.get(url + path, timeout=30)
+                ok = response.status_code < 500
+            except requests.RequestException:
+                ok = False
+            mine.append(time.perf_counter() - start)
+            failed += not ok
+        with lock:
+            latencies.extend(mine)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2) if latencies else None
+
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'req_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': pct(0.50),
+        'p95_ms': pct(0.95),
+        'p99_ms': pct(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--profiles', nargs='+', default=['development', 'production'])
+    parser.add_argument('--url', help='load an already running server instead of starting one per profile')
+    parser.add_argument('--paths', nargs='+', default=DEFAULT_PATHS)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per profile')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds of unrecorded load first')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the server, e.g. GUNICORN_THREADS=8')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--out', help='append one JSON result per profile to this file')
+    args = parser.parse_args()
+
+    env_overrides = dict(item.split('=', 1) for item in args.env)
+
+    for profile in args.profiles:
+        server = None
+        try:
+            if args.url:
+                url = args.url.rstrip('/')
+            else:
+                server, url = start_server(profile, args.port, env_overrides)
+            if args.warmup:
+                load(url, args.paths, args.concurrency, args.warmup)
+            result = load(url, args.paths, args.concurrency, args.duration)
+        finally:
+            if server is not None:
+                server.send_signal(signal.SIGTERM)
+                server.wait(timeout=30)
+
+        result = dict({'profile': profile, 'concurrency': args.concurrency, 'duration': args.duration,
+                       'env': env_overrides, 'paths': args.paths}, **result)
+        print(f"{profile:<12} {result['req_per_sec']:8.1f} req/s  p50={result['p50_ms']}ms  "
+              f"p95={result['p95_ms']}ms  p99={result['p99_ms']}ms  errors={result['errors']}/{result['requests']}")
+        if args.out:
+            with open(args.out, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
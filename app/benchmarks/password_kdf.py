@@ -0,0 +1,84 @@
+"""Password KDF benchmark: hashes/sec and login latency at different cost settings.
+
+For each cost setting this measures raw single-thread hash time, then simulates a login burst:
+`--clients` threads each verify `--logins` passwords through a PasswordHasher with `--workers`
+pool threads, and reports throughput plus p50/p99 login latency (queueing included) and how many
+logins were turned away by back-pressure.
+
+    python benchmarks/password_kdf.py --workers 2 --clients 16 --logins 10
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials import CredentialsBusy, PasswordHasher  # noqa: E402
+
+SETTINGS = [
+    ('pbkdf2_sha256', {'pbkdf2_iterations': 100000}),
+    ('pbkdf2_sha256', {'pbkdf2_iterations': 600000}),
+    ('scrypt', {'scrypt_n': 2 ** 14}),
+    ('scrypt', {'scrypt_n': 2 ** 15}),
+    ('scrypt', {'scrypt_n': 2 ** 16}),
+]
+
+
+def percentile(values, pct):
+    # every login turned away leaves nothing to measure
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def run(algorithm, cost, args):
+    hasher = PasswordHasher(algorithm=algorithm, workers=args.workers, max_pending=args.max_pending,
+                            wait_timeout=args.wait_timeout, **cost)
+    stored = hasher.hash('correct horse battery staple')
+
+    start = time.perf_counter()
+    hasher._verify_now('correct horse battery staple', stored)
+    single = time.perf_counter() - start
+
+    latencies, rejected = [], []
+
+    def client():
+        for _ in range(args.logins):
+            t = time.perf_counter()
+            try:
+                hasher.verify('correct horse battery staple', stored)
+                latencies.append(time.perf_counter() - t)
+            except CredentialsBusy:
+                rejected.append(1)
+
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    label = f"{algorithm} {' '.join(f'{k}={v}' for k, v in cost.items())}"
+    print(f"{label:<36} single={single * 1000:7.1f}ms  {len(latencies) / elapsed:7.1f} hashes/s  "
+          f"p50={percentile(latencies, 0.5) * 1000:7.1f}ms  p99={percentile(latencies, 0.99) * 1000:7.1f}ms  "
+          f"rejected={len(rejected)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=2, help='KDF pool threads')
+    parser.add_argument('--max-pending', type=int, default=32)
+    parser.add_argument('--wait-timeout', type=float, default=5.0)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent login threads')
+    parser.add_argument('--logins', type=int, default=5, help='logins per client')
+    args = parser.parse_args()
+    for algorithm, cost in SETTINGS:
+        run(algorithm, cost, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Offline benchmark for the price service.
+
+Values a portfolio of N distinct tickers the way portfolio_positions used to (one blocking call
+per position, no cache) and through PriceService (concurrent cold fetch, then warm cache), using
+StubPriceProvider with a fixed per-call latency in place of Polygon:
+
+    python benchmarks/price_service.py --positions 50 --latency 0.08
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prices import PriceService, StubPriceProvider  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--positions', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.08, help='seconds per simulated Polygon call')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=20, help='concurrent requests for the same ticker')
+    args = parser.parse_args()
+
+    tickers = [f"T{i:04d}" for i in range(args.positions)]
+
+    provider = StubPriceProvider(latency=args.latency)
+    start = time.perf_counter()
+    for t in tickers:
+        provider.close_price(t, None)
+    serial = time.perf_counter() - start
+    print(f"serial, uncached:   {serial * 1000:8.1f}ms  provider calls={provider.calls}")
+
+    provider = StubPriceProvider(latency=args.latency)
+    service = PriceService(provider, workers=args.workers)
+    start = time.perf_counter()
+    service.close_prices(tickers)
+    cold = time.perf_counter() - start
+    print(f"service, cold:      {cold * 1000:8.1f}ms  provider calls={provider.calls}")
+
+    start = time.perf_counter()
+    service.close_prices(tickers)
+    warm = time.perf_counter() - start
+    print(f"service, warm:      {warm * 1000:8.1f}ms  provider calls={provider.calls}")
+
+    # many requests for one uncached ticker at the same moment should cost one outbound call
+    provider = StubPriceProvider(latency=args.latency)
+    service = PriceService(provider, workers=args.workers)
+    threads = [threading.Thread(target=service.close_price, args=('HOT',)) for _ in range(args.clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    coalesced = time.perf_counter() - start
+    print(f"{args.clients} concurrent same-ticker: {coalesced * 1000:8.1f}ms  provider calls={provider.calls}")
+
+
+if __name__ == '__main__':
+    main()
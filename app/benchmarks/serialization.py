@@ -0,0 +1,116 @@
+"""Serialization benchmark: serialize() + jsonify against the schema serializer.
+
+Makes sure there are at least --rows transactions (inserting synthetic ones if needed), then times
+turning the first --rows of them into a JSON body, --repeat times each, with:
+
+  serialize()      ORM objects -> Model.serialize() -> flask.json.dumps (what the endpoints did)
+  schema/json      column tuples -> Schema.convert -> stdlib json
+  schema/orjson    the same with orjson (skipped if it isn't installed)
+  schema/fields    orjson, only ?fields=id,amount,created_at
+
+and checks every variant produces the same document. Point it at a scratch database; the
+synthetic rows are left behind:
+
+    DATABASE_URL=postgresql://postgres@localhost:5432/bank_bench \\
+        python benchmarks/serialization.py --rows 100000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bank  # noqa: E402
+import serializers  # noqa: E402
+from flask import json as flask_json  # noqa: E402
+
+app = bank.create_app()
+db = bank.db
+
+
+def setup(rows: int, create_schema: bool):
+    """ top the transactions table up to `rows` rows"""
+    if create_schema:
+        db.create_all()
+    have = db.session.execute(db.select(db.func.count()).select_from(bank.Transactions)).scalar()
+    if have >= rows:
+        return
+    customer = bank.Customers(first_name='bench', last_name='serialization', pin=1234, password='x')
+    db.session.add(customer)
+    db.session.commit()
+    db.session.execute(db.text("""
+        INSERT INTO transactions (id, amount, note, debit_id, credit_id, customer_id, created_at)
+        SELECT gen_random_uuid(), round((random() * 1000)::numeric, 2), 'bench ' || n,
+               CASE WHEN n % 2 = 0 THEN gen_random_uuid() END, gen_random_uuid(), :customer_id,
+               now() - n * interval '1 second'
+        FROM generate_series(1, :rows) AS n
+    """), {'customer_id': str(customer.id), 'rows': rows - have})
+    db.session.commit()
+    print(f"inserted {rows - have} transactions")
+
+
+def query(rows: int):
+    return bank.Transactions.query.order_by(bank.Transactions.id).limit(rows)
+
+
+def with_serialize(rows: int) -> bytes:
+    return flask_json.dumps([t.serialize() for t in query(rows)]).encode('utf-8')
+
+
+def with_schema(rows: int, fields=None) -> bytes:
+    schema = serializers.TRANSACTION
+    return schema.dump_query(query(rows), schema.pick(fields))
+
+
+def timed(fn, repeat: int):
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        body = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        db.session.rollback()
+    return best, body
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--create-schema', action='store_true')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_ECHO'] = False
+    with app.test_request_context():
+        setup(args.rows, args.create_schema)
+        orjson = serializers.orjson
+        variants = [('serialize()', lambda: with_serialize(args.rows))]
+        serializers.orjson = None
+        variants.append(('schema/json', lambda: with_schema(args.rows)))
+        if orjson is not None:
+            variants.append(('schema/orjson', lambda: with_schema(args.rows)))
+            variants.append(('schema/fields', lambda: with_schema(args.rows, 'id,amount,created_at')))
+
+        baseline = reference = None
+        for name, fn in variants:
+            serializers.orjson = None if name == 'schema/json' else orjson
+            elapsed, body = timed(fn, args.repeat)
+            document = json.loads(body)
+            if name == 'schema/fields':
+                same = document == [{k: d[k] for k in ('id', 'amount', 'created_at')} for d in reference]
+            else:
+                reference = reference or document
+                same = document == reference
+            baseline = baseline or elapsed
+            print(f"{name:<14} {args.rows} rows in {elapsed:6.3f}s ({args.rows / elapsed:9.0f} rows/s, "
+                  f"{baseline / elapsed:4.1f}x)  {len(body) / 1e6:6.1f} MB  "
+                  f"{'same output' if same else 'OUTPUT DIFFERS'}")
+            if not same:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,467 @@
+"""Bulk load and export of customers, accounts and transactions.
+
+    flask bulk load customers partner_customers.csv.gz --rejects rejects.csv
+    flask bulk load accounts partner_accounts.ndjson
+    flask bulk export transactions - --format ndjson | gzip > transactions.ndjson.gz
+
+Files are CSV with a header row or NDJSON (one object per line), picked by --format or the file
+extension; a `.gz` suffix means gzip, `-` means stdin/stdout.
+
+A load reads the file a chunk at a time (BULK_CHUNK_SIZE rows) and never holds more than one chunk.
+Each row is validated and normalised in Python; the good rows are COPYed into a temporary staging
+table, then moved into the real table with one INSERT ... SELECT that skips rows whose id is
+already there (so a load that was stopped can simply be run again) and rows pointing at a customer
+or account type that doesn't exist. Every chunk is its own transaction. Rows that fail are written
+to --rejects with their line number and the reason, and the load carries on.
+
+Customer passwords must already be hashed in one of the credentials formats (see credentials.py):
+hashing plaintext costs the KDF's deliberate 50-100ms a row, which is days for millions of rows.
+`--hash-passwords` does it anyway, for small loads. Accounts get the same opening-balance ledger
+row account_create writes, unless --no-opening-entries is given (for when their history is loaded
+too). Ledger rows a load writes get their outbox events in the same statement, like any others.
+
+An export is one COPY ... TO STDOUT streamed straight to the file, in id order.
+"""
+import csv
+import gzip
+import io
+import json
+import logging
+import sys
+import time
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+import partitions
+from models import db, uuid7
+
+log = logging.getLogger('bank.bulk')
+
+
+##### row validation #####
+# each converter takes the raw value (a string from CSV, any JSON value from NDJSON) and returns it
+# in COPY text form, or raises ValueError with the reason
+
+def to_uuid(value) -> str:
+    return str(uuid.UUID(str(value)))
+
+
+def to_int(value) -> str:
+    if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+        raise ValueError("must be a whole number")
+    return str(int(value))
+
+
+def to_amount(value) -> str:
+    if isinstance(value, bool):
+        raise ValueError("must be a number")
+    try:
+        amount = Decimal(str(value))
+    except InvalidOperation:
+        raise ValueError("must be a number")
+    if not amount.is_finite():
+        raise ValueError("must be a finite number")
+    return str(amount)
+
+
+def to_bool(value) -> str:
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    text = str(value).strip().lower()
+    if text in ('1', 't', 'true', 'yes', 'y'):
+        return 't'
+    if text in ('0', 'f', 'false', 'no', 'n'):
+        return 'f'
+    raise ValueError("must be true or false")
+
+
+def to_datetime(value) -> str:
+    return datetime.fromisoformat(str(value).replace('Z', '+00:00')).isoformat()
+
+
+def to_text(max_length: int):
+    def convert(value) -> str:
+        text = str(value)
+        if not text or len(text) > max_length:
+            raise ValueError(f"must be 1 to {max_length} characters")
+        return text
+    return convert
+
+
+def new_uuid() -> str:
+    return str(uuid.uuid4())
+
+
+def new_uuid7() -> str:
+    return str(uuid7())
+
+
+def now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+class Field:
+
+    def __init__(self, name: str, convert, required: bool = True, default=None):
+        self.name = name
+        self.convert = convert
+        self.required = required
+        # called for a missing value; a missing optional field without a default loads as NULL
+        self.default = default
+
+
+class BulkTable:
+    """ what a load may put in a table: the fields, and the tables its foreign keys point at"""
+
+    def __init__(self, name: str, fields: list, references: dict = None, export_order: str = 'id', key: str = 'id'):
+        self.name = name
+        self.fields = fields
+        self.references = references or {}
+        self.export_order = export_order
+        # the unique key a row that is already loaded conflicts on
+        self.key = key
+
+    @property
+    def columns(self) -> list:
+        return [field.name for field in self.fields]
+
+
+TABLES = {
+    'customers': BulkTable('customers', [
+        Field('id', to_uuid, required=False, default=new_uuid),
+        Field('first_name', to_text(128)),
+        Field('last_name', to_text(128)),
+        Field('pin', to_int),
+        Field('password', to_text(128)),
+        Field('portfolio_id', to_uuid, required=False),
+    ], references={'portfolio_id': 'portfolios'}),
+    'accounts': BulkTable('accounts', [
+        Field('id', to_uuid, required=False, default=new_uuid),
+        Field('balance', to_amount, required=False, default=lambda: '0'),
+        Field('hold', to_bool, required=False, default=lambda: 'f'),
+        Field('acct_type_id', to_int),
+        Field('customer_id', to_uuid),
+    ], references={'acct_type_id': 'account_types', 'customer_id': 'customers'}),
+    'transactions': BulkTable('transactions', [
+        Field('id', to_uuid, required=False, default=new_uuid7),
+        Field('amount', to_amount),
+        Field('note', to_text(128)),
+        Field('debit_id', to_uuid, required=False),
+        Field('credit_id', to_uuid, required=False),
+        Field('customer_id', to_uuid),
+        Field('created_at', to_datetime, required=False, default=now),
+    ], references={'customer_id': 'customers'}, key='id, created_at'),
+}
+
+
+def copy_text(value) -> str:
+    """ one value in COPY's text format"""
+    if value is None:
+        return '\\N'
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def validate(table: BulkTable, record: dict, password_check=None) -> str:
+    """ a record as one line of COPY text, or ValueError("field: reason")"""
+    values = []
+    for field in table.fields:
+        raw = record.get(field.name)
+        if raw is None or raw == '':
+            if field.required:
+                raise ValueError(f"{field.name}: required")
+            values.append(field.default() if field.default else None)
+            continue
+        try:
+            value = field.convert(raw)
+            if field.name == 'password' and password_check is not None:
+                value = password_check(value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"{field.name}: {e}")
+        values.append(value)
+    return '\t'.join(copy_text(v) for v in values) + '\n'
+
+
+##### files #####
+
+def file_format(path: str, given: str = None) -> str:
+    if given:
+        return given
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    if name.endswith('.csv'):
+        return 'csv'
+    raise click.UsageError("can't tell the format from the file name, pass --format csv|ndjson")
+
+
+def open_text(path: str, mode: str):
+    """ a text file, gzip-compressed when the name ends in .gz; '-' is stdin/stdout"""
+    if path == '-':
+        return io.TextIOWrapper(sys.stdin.buffer if mode == 'r' else sys.stdout.buffer, encoding='utf-8', newline='')
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def read_records(stream, fmt: str):
+    """ (line number, record dict or ValueError) for every row, lazily"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, ValueError(f"not JSON: {e}")
+            continue
+        yield line_number, record if isinstance(record, dict) else ValueError("not a JSON object")
+
+
+def chunks(iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+##### load #####
+
+def stage_sql(table: BulkTable) -> str:
+    """ a temp table shaped like the target's loadable columns, plus the source line number"""
+    return (f"CREATE TEMP TABLE IF NOT EXISTS bulk_{table.name} ON COMMIT DELETE ROWS AS "
+            f"SELECT 0::bigint AS line, {', '.join(table.columns)} FROM {table.name} WITH NO DATA")
+
+
+def references_exist(table: BulkTable) -> str:
+    checks = [f"(s.{column} IS NULL OR EXISTS (SELECT 1 FROM {target} r WHERE r.id = s.{column}))"
+              for column, target in table.references.items()]
+    return ' AND '.join(checks) or 'true'
+
+
+def already_loaded(table: BulkTable) -> str:
+    """ with a wider unique key than the id (transactions: id, created_at) a rerun of a file without
+    created_at would stamp the rows with a new time and get past ON CONFLICT: look for the id itself"""
+    if table.key == 'id':
+        return ''
+    return f" AND NOT EXISTS (SELECT 1 FROM {table.name} t WHERE t.id = s.id)"
+
+
+def move_sql(table: BulkTable, opening_entries: bool) -> str:
+    """ staging -> target, skipping existing ids and dangling references; reports what went in"""
+    columns = ', '.join(table.columns)
+    returning = {'accounts': 'id, customer_id, balance', 'transactions': 'id, created_at'}.get(table.name, 'id')
+    sql = f"""
+        WITH inserted AS (
+            INSERT INTO {table.name} ({columns})
+            SELECT DISTINCT ON (s.id) {', '.join('s.' + c for c in table.columns)} FROM bulk_{table.name} s
+            WHERE {references_exist(table)}{already_loaded(table)}
+            ORDER BY s.id, s.line
+            ON CONFLICT ({table.key}) DO NOTHING
+            RETURNING {returning}
+        )"""
+    if opening_entries:
+        # the ledger row account_create writes for an opening balance (uuid_v7() needs Postgres 13+)
+        sql += """,
+        opened AS (
+            INSERT INTO transactions (id, amount, note, debit_id, credit_id, customer_id, created_at)
+            SELECT uuid_v7(), balance, :note, NULL, id, customer_id, clock_timestamp() AT TIME ZONE 'UTC'
+            FROM inserted WHERE balance <> 0
+            RETURNING id, created_at
+        ),
+        outbox AS (
+            INSERT INTO ledger_events (transaction_id, created_at) SELECT id, created_at FROM opened
+        )"""
+    if table.name == 'transactions':
+        # loaded history is published like any other ledger row (see events.py)
+        sql += """,
+        outbox AS (
+            INSERT INTO ledger_events (transaction_id, created_at) SELECT id, created_at FROM inserted
+        )"""
+    if table.name == 'accounts':
+        sql += """
+        SELECT count(*) AS loaded, array_agg(id::text) AS ids, array_agg(customer_id::text) AS customer_ids FROM inserted"""
+    else:
+        sql += """
+        SELECT count(*) AS loaded, NULL AS ids, NULL AS customer_ids FROM inserted"""
+    return sql
+
+
+class LoadReport:
+
+    def __init__(self):
+        self.read = 0
+        self.loaded = 0
+        self.rejected = 0
+        self.started = time.perf_counter()
+
+    @property
+    def skipped(self) -> int:
+        """ rows that were valid but already loaded"""
+        return self.read - self.loaded - self.rejected
+
+    @property
+    def rate(self) -> float:
+        return self.read / max(time.perf_counter() - self.started, 1e-9)
+
+
+def load(table_name: str, stream, fmt: str, chunk_size: int, rejects=None, opening_entries: bool = True,
+         password_check=None, invalidate=None, progress=None) -> LoadReport:
+    """ load every record from `stream` into a table, a chunk per transaction.
+
+    `rejects(line, reason)` is called for each row that isn't loaded because it's invalid or its
+    references don't exist; `invalidate` gets the (account_id, customer_id) pairs of loaded accounts
+    and `progress` the LoadReport after every chunk.
+    """
+    table = TABLES[table_name]
+    report = LoadReport()
+    move = db.text(move_sql(table, opening_entries and table.name == 'accounts'))
+    dangling = db.text(f"SELECT line FROM bulk_{table.name} s WHERE NOT ({references_exist(table)}) ORDER BY line")
+    copy = f"COPY bulk_{table.name} (line, {', '.join(table.columns)}) FROM STDIN"
+
+    for chunk in chunks(read_records(stream, fmt), chunk_size):
+        buffer = io.StringIO()
+        for line, record in chunk:
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                buffer.write(f"{line}\t{validate(table, record, password_check)}")
+            except ValueError as e:
+                report.rejected += 1
+                if rejects is not None:
+                    rejects(line, str(e))
+        report.read += len(chunk)
+
+        try:
+            db.session.execute(db.text(stage_sql(table)))
+            buffer.seek(0)
+            cursor = db.session.connection().connection.cursor()
+            cursor.copy_expert(copy, buffer)
+            if table.name == 'transactions':
+                # history can go back before the partitions that exist (see partitions.py)
+                first, last = db.session.execute(db.text("SELECT min(created_at), max(created_at) FROM bulk_transactions")).one()
+                if first is not None:
+                    partitions.ensure_partitions(db.session.connection(), first, last)
+            missing = db.session.execute(dangling).scalars().all()
+            result = db.session.execute(move, {'note': 'Opening balance (bulk load)'}).one()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        report.loaded += result.loaded
+        report.rejected += len(missing)
+        if rejects is not None:
+            for line in missing:
+                rejects(line, "refers to a row that doesn't exist")
+        if result.ids and invalidate is not None:
+            invalidate(zip(result.ids, result.customer_ids))
+        if progress is not None:
+            progress(report)
+    return report
+
+
+##### export #####
+
+def export(table_name: str, stream, fmt: str) -> int:
+    """ COPY a whole table out to `stream` in id order; returns the row count"""
+    table = TABLES[table_name]
+    select = f"SELECT {', '.join(table.columns)} FROM {table.name} ORDER BY {table.export_order}"
+    if fmt == 'csv':
+        copy = f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    else:
+        # csv format with quote/delimiter bytes that never occur in JSON, so each line goes out untouched
+        copy = (f"COPY (SELECT row_to_json(t) FROM ({select}) t) TO STDOUT "
+                f"WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')")
+    try:
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(copy, stream)
+        rows = cursor.rowcount
+    finally:
+        db.session.rollback()
+    return rows
+
+
+##### CLI: flask bulk load|export #####
+
+cli = AppGroup('bulk', help="Bulk load and export with COPY.")
+
+
+@cli.command('load')
+@click.argument('table', type=click.Choice(list(TABLES)))
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None,
+              help="input format (default from the file extension)")
+@click.option('--chunk-size', type=int, default=None, help="rows per transaction (default BULK_CHUNK_SIZE)")
+@click.option('--rejects', 'rejects_path', default=None, help="write rows that weren't loaded here, as CSV")
+@click.option('--opening-entries/--no-opening-entries', default=True,
+              help="post each account's opening balance to the ledger (default on)")
+@click.option('--hash-passwords', is_flag=True, help="hash plaintext customer passwords (slow)")
+def load_command(table, path, fmt, chunk_size, rejects_path, opening_entries, hash_passwords):
+    """Load customers, accounts or transactions from CSV or NDJSON."""
+    # the balance cache lives in the app module; imported here since app imports this one
+    from app import invalidate_accounts
+    hasher = current_app.extensions['passwords']
+
+    def password_check(value):
+        if hasher.is_hash(value):
+            return value
+        if not hash_passwords:
+            raise ValueError("not a password hash (pass --hash-passwords to hash plaintext)")
+        return hasher.hash(value)
+
+    def progress(report):
+        click.echo(f"{table}: {report.read} rows read, {report.loaded} loaded, {report.rejected} rejected "
+                   f"({report.rate:.0f} rows/s)", err=True)
+
+    rejects_file = open_text(rejects_path, 'w') if rejects_path else None
+    reject = None
+    if rejects_file:
+        writer = csv.writer(rejects_file)
+        writer.writerow(['line', 'reason'])
+
+        def reject(line, reason):
+            writer.writerow([line, reason])
+    try:
+        with open_text(path, 'r') as stream:
+            report = load(table, stream, file_format(path, fmt),
+                          chunk_size or current_app.config['BULK_CHUNK_SIZE'],
+                          rejects=reject,
+                          opening_entries=opening_entries,
+                          password_check=password_check if table == 'customers' else None,
+                          invalidate=invalidate_accounts,
+                          progress=progress)
+    finally:
+        if rejects_file:
+            rejects_file.close()
+    log.info("bulk load of %s from %s: %d read, %d loaded, %d already there, %d rejected",
+             table, path, report.read, report.loaded, report.skipped, report.rejected)
+    click.echo(f"{table}: {report.loaded} loaded, {report.skipped} already there, {report.rejected} rejected "
+               f"of {report.read} rows in {time.perf_counter() - report.started:.1f}s ({report.rate:.0f} rows/s)")
+    if report.rejected:
+        raise SystemExit(1)
+
+
+@cli.command('export')
+@click.argument('table', type=click.Choice(list(TABLES)))
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default=None,
+              help="output format (default from the file extension)")
+def export_command(table, path, fmt):
+    """Export customers, accounts or transactions as CSV or NDJSON."""
+    started = time.perf_counter()
+    with open_text(path, 'w') as stream:
+        rows = export(table, stream, file_format(path, fmt))
+    elapsed = time.perf_counter() - started
+    click.echo(f"{table}: {rows} rows exported in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)", err=True)
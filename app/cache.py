@@ -0,0 +1,177 @@
+"""Caches: an in-process LRU/TTL cache, and the read-through cache in front of hot lookups."""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    """A thread safe LRU cache whose entries also expire after `ttl` seconds.
+
+    OrderedDict keeps the recency order for us: a hit moves the key to the end and, when
+    the cache is full, the first key is the least recently used one.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, MISSING)
+            if entry is MISSING:
+                return default
+            expires, value = entry
+            if expires <= self._clock():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        expires = self._clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+##### shared backends #####
+# The in-process tier is per gunicorn worker. A shared backend sits behind it so every worker sees
+# the same entries and an invalidation in one worker reaches the others (their local copies only
+# live for the short local TTL). Values are stored as strings so any key/value store will do.
+
+class LocalSharedBackend:
+    """Stand-in for a shared cache when there's no Redis (dev, tests, single worker)"""
+
+    def __init__(self, maxsize: int = 100000):
+        self._cache = TTLCache(maxsize=maxsize)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value: str, ttl: float):
+        self._cache.set(key, value, ttl)
+
+    def delete(self, *keys):
+        for key in keys:
+            self._cache.delete(key)
+
+
+class RedisSharedBackend:
+    """Shared cache in Redis; needs the optional `redis` package"""
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis needs the redis package: pip install redis")
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key, value: str, ttl: float):
+        self._client.set(key, value, ex=max(1, int(ttl)))
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*keys)
+
+
+##### read-through cache #####
+
+class ReadThroughCache:
+    """Two tier read-through cache of JSON documents with ETags.
+
+    get_or_load(key, loader) returns an Entry with the JSON text and its ETag, calling
+    loader() (which returns something JSON serializable) only when neither tier has the key.
+    Hits and misses are counted per key prefix (the part before the first ':').
+    """
+
+    class Entry:
+        __slots__ = ('body', 'etag')
+
+        def __init__(self, body: str, etag: str):
+            self.body = body
+            self.etag = etag
+
+    def __init__(self, shared=None, local_ttl: float = 5.0, shared_ttl: float = 300.0, maxsize: int = 10000):
+        self.local = TTLCache(maxsize=maxsize, ttl=local_ttl)
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def get_or_load(self, key: str, loader, ttl: float = None) -> 'ReadThroughCache.Entry':
+        entry = self.local.get(key)
+        if entry is not None:
+            self._count(key, 'local_hits')
+            return entry
+
+        if self.shared is not None:
+            stored = self.shared.get(key)
+            if stored is not None:
+                self._count(key, 'shared_hits')
+                etag, body = stored.split('\n', 1)
+                entry = self.Entry(body, etag)
+                self.local.set(key, entry, ttl)
+                return entry
+
+        self._count(key, 'misses')
+        body = json.dumps(loader(), sort_keys=True, separators=(',', ':'))
+        entry = self.Entry(body, hashlib.blake2b(body.encode('utf-8'), digest_size=12).hexdigest())
+        self.local.set(key, entry, ttl)
+        if self.shared is not None:
+            self.shared.set(key, entry.etag + '\n' + body, self.shared_ttl if ttl is None else ttl)
+        return entry
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+            self._count(key, 'invalidations')
+        if self.shared is not None:
+            self.shared.delete(*keys)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {prefix: dict(counts) for prefix, counts in self._stats.items()}
+
+    def _count(self, key: str, what: str):
+        prefix = key.split(':', 1)[0]
+        with self._stats_lock:
+            counts = self._stats.setdefault(prefix, {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0})
+            counts[what] += 1
+
+
+def make_lookup_cache(config) -> ReadThroughCache:
+    """Build the lookup cache described by the app config"""
+    backend = config['CACHE_BACKEND']
+    if backend is None or backend == 'none':
+        shared = None
+    elif backend == 'local':
+        shared = LocalSharedBackend()
+    elif backend == 'redis':
+        shared = RedisSharedBackend(config['CACHE_REDIS_URL'])
+    else:
+        raise ValueError(f"unknown CACHE_BACKEND {backend!r}")
+    return ReadThroughCache(shared, local_ttl=config['CACHE_LOCAL_TTL'], shared_ttl=config['CACHE_TTL'])
@@ -0,0 +1,185 @@
+"""Configuration profiles.
+
+create_app() loads one of these, picked by name or by the BANK_CONFIG environment variable
+(development by default). Everything that differs between deployments can be overridden from
+the environment, so the same image runs everywhere.
+"""
+import os
+
+
+def env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+class Config:
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'dev')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql://postgres@localhost:5432/bank')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # logging every statement is a debugging aid, never something to leave on for real traffic
+    SQLALCHEMY_ECHO = env_bool('SQLALCHEMY_ECHO', False)
+
+    # connection pool, per gunicorn worker process. Each worker thread holds at most one connection,
+    # so pool_size should be >= GUNICORN_THREADS; pre_ping drops connections the server or a proxy
+    # has closed, recycle retires them before idle timeouts on the network path do.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': env_int('DB_POOL_SIZE', 5),
+        'max_overflow': env_int('DB_MAX_OVERFLOW', 5),
+        'pool_timeout': env_float('DB_POOL_TIMEOUT', 10),
+        'pool_recycle': env_int('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': env_bool('DB_POOL_PRE_PING', True),
+    }
+
+    # read replicas, comma separated; each becomes a bind (replica_0, ...) that the read-only GET
+    # endpoints are routed to (see replicas.py). A replica more than REPLICA_MAX_LAG seconds behind
+    # is left out until it catches up; lag is re-measured every REPLICA_CHECK_INTERVAL seconds
+    DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    SQLALCHEMY_BINDS = {f'replica_{i}': url for i, url in enumerate(DATABASE_REPLICA_URLS)}
+    REPLICA_MAX_LAG = env_float('REPLICA_MAX_LAG', 5)
+    REPLICA_CHECK_INTERVAL = env_float('REPLICA_CHECK_INTERVAL', 1)
+
+    # market data: 'polygon' for live prices, 'stub' for offline dev/tests (PRICE_STUB_LATENCY seconds
+    # slept per stub call stands in for the network)
+    PRICE_PROVIDER = os.environ.get('PRICE_PROVIDER', 'polygon')
+    PRICE_STUB_LATENCY = env_float('PRICE_STUB_LATENCY', 0)
+    POLYGON_API_KEY = os.environ.get('POLYGON_API_KEY', '6dUHDmEeO0iPwf0NJ3g3ehpw_8YgLLXd')
+    PRICE_HTTP_TIMEOUT = env_float('PRICE_HTTP_TIMEOUT', 5.0)
+    PRICE_CACHE_TTL = env_float('PRICE_CACHE_TTL', 3600)
+    PRICE_FETCH_WORKERS = env_int('PRICE_FETCH_WORKERS', 8)
+
+    # password KDF ('scrypt' or 'pbkdf2_sha256') and its cost; hashes made at an older cost are upgraded at login
+    PASSWORD_ALGORITHM = os.environ.get('PASSWORD_ALGORITHM', 'scrypt')
+    PASSWORD_PBKDF2_ITERATIONS = env_int('PASSWORD_PBKDF2_ITERATIONS', 600000)
+    PASSWORD_SCRYPT_N = env_int('PASSWORD_SCRYPT_N', 2 ** 14)
+    PASSWORD_SCRYPT_R = env_int('PASSWORD_SCRYPT_R', 8)
+    PASSWORD_SCRYPT_P = env_int('PASSWORD_SCRYPT_P', 1)
+    # the KDF runs on this many threads; past MAX_PENDING queued hashes callers wait, then get a 503
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', 2)
+    PASSWORD_HASH_MAX_PENDING = env_int('PASSWORD_HASH_MAX_PENDING', 32)
+    PASSWORD_HASH_WAIT_TIMEOUT = env_float('PASSWORD_HASH_WAIT_TIMEOUT', 5.0)
+
+    # read-through cache for hot lookups: CACHE_BACKEND is 'none' (per-process only), 'local' (in-process
+    # stand-in for a shared cache) or 'redis'. Local copies live CACHE_LOCAL_TTL seconds, since another
+    # worker's invalidation can't reach them; account types barely change so they get a long TTL.
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'none')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    CACHE_LOCAL_TTL = env_float('CACHE_LOCAL_TTL', 5.0)
+    CACHE_TTL = env_float('CACHE_TTL', 300.0)
+    ACCOUNT_TYPES_CACHE_TTL = env_float('ACCOUNT_TYPES_CACHE_TTL', 3600.0)
+
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    # requests slower than this many seconds are logged with their slowest SQL statements
+    SLOW_REQUEST_THRESHOLD = env_float('SLOW_REQUEST_THRESHOLD', 0.5)
+    SLOW_REQUEST_LOG_STATEMENTS = env_int('SLOW_REQUEST_LOG_STATEMENTS', 10)
+
+    # accounts per transaction for `flask snapshots take`, snapshots per transaction for `reconcile`
+    SNAPSHOT_CHUNK_SIZE = env_int('SNAPSHOT_CHUNK_SIZE', 1000)
+
+    # Idempotency-Key responses are replayed for this many seconds; a duplicate that arrives just as
+    # the original commits waits up to IDEMPOTENCY_WAIT seconds for its response to be saved
+    IDEMPOTENCY_TTL = env_int('IDEMPOTENCY_TTL', 24 * 3600)
+    IDEMPOTENCY_WAIT = env_float('IDEMPOTENCY_WAIT', 2.0)
+
+    # `flask interest accrue`: accounts per transaction, and the day count a year's rate is divided by
+    INTEREST_CHUNK_SIZE = env_int('INTEREST_CHUNK_SIZE', 5000)
+    INTEREST_DAYS_IN_YEAR = env_int('INTEREST_DAYS_IN_YEAR', 365)
+
+    # rows per transaction (and held in memory) for `flask bulk load`
+    BULK_CHUNK_SIZE = env_int('BULK_CHUNK_SIZE', 10000)
+
+    # GET /transactions/export: rows fetched from the server-side cursor and sent per chunk, and how
+    # many exports one worker process streams at once (the rest get a 503)
+    EXPORT_CHUNK_SIZE = env_int('EXPORT_CHUNK_SIZE', 2000)
+    EXPORT_MAX_CONCURRENT = env_int('EXPORT_MAX_CONCURRENT', 2)
+
+    # ledger events (see events.py): `flask events relay` publishes up to EVENTS_RELAY_BATCH at a time
+    # and looks for more every EVENTS_RELAY_INTERVAL seconds when idle, POSTing each batch to
+    # EVENTS_WEBHOOK_URL when that's set. GET /events returns up to EVENTS_PAGE_SIZE events, waits
+    # up to EVENTS_LONG_POLL_TIMEOUT seconds when there are none (also the SSE keepalive interval),
+    # and one worker process has at most EVENTS_MAX_WAITING polls waiting or streams open at once
+    EVENTS_RELAY_BATCH = env_int('EVENTS_RELAY_BATCH', 500)
+    EVENTS_RELAY_INTERVAL = env_float('EVENTS_RELAY_INTERVAL', 0.2)
+    EVENTS_WEBHOOK_URL = os.environ.get('EVENTS_WEBHOOK_URL', '')
+    EVENTS_WEBHOOK_TIMEOUT = env_float('EVENTS_WEBHOOK_TIMEOUT', 5.0)
+    EVENTS_PAGE_SIZE = env_int('EVENTS_PAGE_SIZE', 500)
+    EVENTS_LONG_POLL_TIMEOUT = env_float('EVENTS_LONG_POLL_TIMEOUT', 25)
+    EVENTS_MAX_WAITING = env_int('EVENTS_MAX_WAITING', 2)
+    # `flask events purge` deletes events published longer ago than this
+    EVENTS_RETENTION_DAYS = env_int('EVENTS_RETENTION_DAYS', 7)
+
+    # GET /search (see search.py): results per page by default, and how far down the ranking paging
+    # goes (also how many of the most recent matching transactions are ranked)
+    SEARCH_PAGE_SIZE = env_int('SEARCH_PAGE_SIZE', 20)
+    SEARCH_MAX_RESULTS = env_int('SEARCH_MAX_RESULTS', 1000)
+
+    # queued buys (see orders.py): `flask orders work` runs ORDERS_WORKERS threads, each filling up to
+    # ORDERS_BATCH_SIZE orders per transaction and looking for more every ORDERS_POLL_INTERVAL seconds
+    # when idle. An order that can't be priced is retried ORDERS_RETRY_DELAY seconds later (doubling
+    # each time) and rejected after ORDERS_MAX_ATTEMPTS tries
+    ORDERS_WORKERS = env_int('ORDERS_WORKERS', 4)
+    ORDERS_BATCH_SIZE = env_int('ORDERS_BATCH_SIZE', 100)
+    ORDERS_POLL_INTERVAL = env_float('ORDERS_POLL_INTERVAL', 0.2)
+    ORDERS_RETRY_DELAY = env_float('ORDERS_RETRY_DELAY', 5)
+    ORDERS_MAX_ATTEMPTS = env_int('ORDERS_MAX_ATTEMPTS', 5)
+
+    # transactions partitions (see partitions.py): each worker process makes sure this month and the
+    # next PARTITION_MONTHS_AHEAD have one, checking every PARTITION_CHECK_INTERVAL seconds
+    PARTITION_MONTHS_AHEAD = env_int('PARTITION_MONTHS_AHEAD', 3)
+    PARTITION_CHECK_INTERVAL = env_float('PARTITION_CHECK_INTERVAL', 3600)
+
+    # token buckets for the money-moving endpoints (see ratelimit.py): RATE requests a second sustained,
+    # bursts of up to BURST; a rate of 0 turns that scope off. 'local' keeps them per worker process,
+    # 'redis' shares them between workers.
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'local')
+    RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', CACHE_REDIS_URL)
+    RATE_LIMIT_IP_RATE = env_float('RATE_LIMIT_IP_RATE', 20)
+    RATE_LIMIT_IP_BURST = env_float('RATE_LIMIT_IP_BURST', 50)
+    RATE_LIMIT_CUSTOMER_RATE = env_float('RATE_LIMIT_CUSTOMER_RATE', 5)
+    RATE_LIMIT_CUSTOMER_BURST = env_float('RATE_LIMIT_CUSTOMER_BURST', 20)
+    RATE_LIMIT_ACCOUNT_RATE = env_float('RATE_LIMIT_ACCOUNT_RATE', 5)
+    RATE_LIMIT_ACCOUNT_BURST = env_float('RATE_LIMIT_ACCOUNT_BURST', 20)
+    # this many wrong PINs for an account within the window put it on hold
+    PIN_MAX_FAILURES = env_int('PIN_MAX_FAILURES', 5)
+    PIN_FAILURE_WINDOW = env_float('PIN_FAILURE_WINDOW', 900)
+
+    # bearer tokens (comma separated) allowed to post arrays and NDJSON uploads to /transfers and
+    # /batches, which debit accounts without their owners' PINs; unset, nobody can
+    OPERATOR_TOKENS = [token.strip() for token in os.environ.get('OPERATOR_TOKENS', '').split(',') if token.strip()]
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    SQLALCHEMY_ECHO = env_bool('SQLALCHEMY_ECHO', True)
+
+
+class ProductionConfig(Config):
+    SQLALCHEMY_ENGINE_OPTIONS = dict(
+        Config.SQLALCHEMY_ENGINE_OPTIONS,
+        pool_size=env_int('DB_POOL_SIZE', 10),
+        max_overflow=env_int('DB_MAX_OVERFLOW', 10),
+    )
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+}
+
+
+def get_config(name: str = None):
+    """The config class for a profile name, defaulting to $BANK_CONFIG"""
+    name = name or os.environ.get('BANK_CONFIG', 'development')
+    try:
+        return PROFILES[name]
+    except KeyError:
+        raise ValueError(f"unknown config profile {name!r}, expected one of {', '.join(PROFILES)}")
@@ -0,0 +1,131 @@
+"""Password hashing and verification.
+
+Passwords are stored as a self-describing string so they can be verified later and upgraded when
+we raise the cost:
+
+    scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+    pbkdf2_sha256$<iterations>$<salt hex>$<hash hex>
+
+The KDF is deliberately slow, so it never runs on the request thread: hash() and verify() hand the
+work to a small bounded thread pool (hashlib releases the GIL while it grinds) and wait for it. When
+more than `max_pending` hashes are already queued or running, callers wait up to `wait_timeout`
+for a slot and are then turned away with a 503, so a burst of sign-ups or logins can't pile up
+behind the pool and tie up every gunicorn worker.
+"""
+import hashlib
+import hmac
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import ServiceUnavailable
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+class CredentialsBusy(ServiceUnavailable):
+    description = "Too many password operations in progress, try again shortly"
+
+
+class PasswordHasher:
+
+    def __init__(self, algorithm: str = 'scrypt', pbkdf2_iterations: int = 600000,
+                 scrypt_n: int = 2 ** 14, scrypt_r: int = 8, scrypt_p: int = 1,
+                 workers: int = 2, max_pending: int = 32, wait_timeout: float = 5.0):
+        if algorithm not in ('scrypt', 'pbkdf2_sha256'):
+            raise ValueError(f"unknown password algorithm {algorithm!r}")
+        self.algorithm = algorithm
+        self.pbkdf2_iterations = pbkdf2_iterations
+        self.scrypt_params = (scrypt_n, scrypt_r, scrypt_p)
+        self.wait_timeout = wait_timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kdf')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    ##### public api #####
+
+    def hash(self, password: str) -> str:
+        """Hash a new password with the current algorithm and cost"""
+        return self._run(self._hash_now, password)
+
+    def verify(self, password: str, stored: str) -> bool:
+        """Check a password against a stored hash; unknown or legacy formats never verify"""
+        return self._run(self._verify_now, password, stored)
+
+    def needs_rehash(self, stored: str) -> bool:
+        """True when the stored hash wasn't made with the current algorithm and cost"""
+        return self._params(stored) != self._current_params()
+
+    def is_hash(self, stored: str) -> bool:
+        """True when the string is a hash in one of our formats (at any cost)"""
+        return self._params(stored) is not None
+
+    ##### internals #####
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise CredentialsBusy()
+        try:
+            future = self._pool.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def _current_params(self):
+        if self.algorithm == 'scrypt':
+            return ('scrypt',) + self.scrypt_params
+        return ('pbkdf2_sha256', self.pbkdf2_iterations)
+
+    @staticmethod
+    def _params(stored: str):
+        """(algorithm, *cost) parsed from a stored hash, or None if it isn't one of ours"""
+        parts = (stored or '').split('$')
+        try:
+            if parts[0] == 'scrypt' and len(parts) == 6:
+                return ('scrypt', int(parts[1]), int(parts[2]), int(parts[3]))
+            if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+                return ('pbkdf2_sha256', int(parts[1]))
+        except ValueError:
+            pass
+        return None
+
+    @staticmethod
+    def _derive(password: str, salt: bytes, params) -> bytes:
+        if params[0] == 'scrypt':
+            n, r, p = params[1:]
+            return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                                  maxmem=256 * n * r + 1024 * 1024, dklen=HASH_BYTES)
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, params[1], dklen=HASH_BYTES)
+
+    def _hash_now(self, password: str) -> str:
+        params = self._current_params()
+        salt = secrets.token_bytes(SALT_BYTES)
+        digest = self._derive(password, salt, params)
+        return '$'.join([str(p) for p in params] + [salt.hex(), digest.hex()])
+
+    def _verify_now(self, password: str, stored: str) -> bool:
+        params = self._params(stored)
+        if params is None:
+            return False
+        salt_hex, digest_hex = stored.split('$')[-2:]
+        try:
+            salt, expected = bytes.fromhex(salt_hex), bytes.fromhex(digest_hex)
+        except ValueError:
+            return False
+        return hmac.compare_digest(self._derive(password, salt, params), expected)
+
+
+def make_password_hasher(config) -> PasswordHasher:
+    """Build the hasher described by the app config"""
+    return PasswordHasher(
+        algorithm=config['PASSWORD_ALGORITHM'],
+        pbkdf2_iterations=config['PASSWORD_PBKDF2_ITERATIONS'],
+        scrypt_n=config['PASSWORD_SCRYPT_N'],
+        scrypt_r=config['PASSWORD_SCRYPT_R'],
+        scrypt_p=config['PASSWORD_SCRYPT_P'],
+        workers=config['PASSWORD_HASH_WORKERS'],
+        max_pending=config['PASSWORD_HASH_MAX_PENDING'],
+        wait_timeout=config['PASSWORD_HASH_WAIT_TIMEOUT'],
+    )
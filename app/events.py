@@ -0,0 +1,334 @@
+"""Ledger change events: a transactional outbox, the relay that publishes it, and GET /events.
+
+Every Transactions row is inserted together with a ledger_events row, in the same commit
+(record_transaction and post_chunk in app.py, the interest and bulk load statements), so there is
+an event exactly when there is a ledger row, whatever crashes in between.
+
+`flask events relay` publishes the outbox EVENTS_RELAY_BATCH rows at a time. In one transaction it
+takes the oldest unpublished rows, numbers them from the ledger_events_seq sequence (seq), POSTs
+them to EVENTS_WEBHOOK_URL if one is set, and NOTIFYs `ledger_events` with the highest seq, which
+Postgres delivers at commit. Only one relay works at a time (an advisory lock), so seqs become
+visible in order: a consumer that has seen seq N will never later find a committed event below N,
+which the outbox's own ids can't promise since writers commit out of id order. A webhook that fails
+rolls the batch back to be sent again, so delivery is at least once; consumers dedupe on seq.
+
+Consumers read published events by seq instead of scanning the ledger:
+
+- GET /events?since=N returns the events after seq N (up to EVENTS_PAGE_SIZE) and `next`, the seq
+  to ask for next time. With nothing new it long-polls, waiting up to ?timeout= seconds
+  (EVENTS_LONG_POLL_TIMEOUT by default) for the relay's NOTIFY before answering.
+- With `Accept: text/event-stream` it is a Server-Sent Events stream instead: events are sent as
+  they are published, each with `id: <seq>`, so a reconnecting EventSource resumes through
+  Last-Event-ID on its own.
+
+Waiting doesn't hold a pooled connection: each worker process has one listener thread on its own
+connection (LISTEN ledger_events) that wakes every waiting request. It does hold a worker thread,
+so each process serves at most EVENTS_MAX_WAITING waiting polls and streams and answers the rest
+with a 503 and Retry-After, the same as exports.
+"""
+import logging
+import select
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+import requests
+from flask import Response, current_app, g, stream_with_context
+from flask.cli import AppGroup
+from werkzeug.exceptions import ServiceUnavailable
+
+import serializers
+from models import db, LedgerEvents, Transactions
+
+log = logging.getLogger('bank.events')
+
+CHANNEL = 'ledger_events'
+EVENT_TYPE = 'transaction.posted'
+# pg_advisory_xact_lock key held by whichever relay is publishing
+RELAY_LOCK = 7311804125
+
+PUBLISH = db.text("""
+WITH batch AS (
+    SELECT id, nextval('ledger_events_seq') AS seq
+    FROM (SELECT id FROM ledger_events WHERE seq IS NULL ORDER BY id LIMIT :batch_size) pending
+    ORDER BY id
+)
+UPDATE ledger_events SET seq = batch.seq, published_at = :now
+FROM batch
+WHERE ledger_events.id = batch.id
+RETURNING batch.seq
+""")
+
+
+class EventsBusy(ServiceUnavailable):
+    description = "Too many event streams open, try again shortly"
+
+
+##### reading events #####
+
+def fetch(since: int, limit: int):
+    """ up to `limit` published events after seq `since`, and the seq to continue from"""
+    fields = serializers.TRANSACTION.pick()
+    rows = db.session.execute(
+        db.select(*serializers.Schema.columns(fields), LedgerEvents.seq)
+        .select_from(LedgerEvents)
+        .outerjoin(Transactions, db.and_(Transactions.id == LedgerEvents.transaction_id,
+                                         Transactions.created_at == LedgerEvents.created_at))
+        .where(LedgerEvents.seq > since)
+        .order_by(LedgerEvents.seq)
+        .limit(limit)).all()
+    if not rows:
+        return [], since
+    # an event whose ledger row is gone (archived, see partitions.py) is skipped, but still moves the cursor on
+    found = [row for row in rows if row[0] is not None]
+    events = [{'seq': row[-1], 'type': EVENT_TYPE, 'transaction': transaction}
+              for row, transaction in zip(found, serializers.Schema.convert(found, fields))]
+    return events, rows[-1][-1]
+
+
+class EventListener:
+    """One LISTEN connection per process; request threads wait on it for newly published seqs"""
+
+    def __init__(self, keepalive: float = 30):
+        self.keepalive = keepalive
+        # the highest seq announced since the listener (re)connected
+        self.latest = 0
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def wait(self, engine, since: int, timeout: float) -> bool:
+        """ block until a seq above `since` has been published, or `timeout` seconds; True if one was"""
+        self._start(engine)
+        with self._cond:
+            return self._cond.wait_for(lambda: self.latest > since, timeout)
+
+    def _start(self, engine):
+        with self._cond:
+            if self._thread is None:
+                # started on first use, so it is started in each gunicorn worker rather than before the fork
+                self._thread = threading.Thread(target=self._run, args=(engine,), name='events-listener', daemon=True)
+                self._thread.start()
+
+    def _announce(self, seq: int):
+        with self._cond:
+            if seq > self.latest:
+                self.latest = seq
+                self._cond.notify_all()
+
+    def _run(self, engine):
+        delay = 1
+        while True:
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                # ours for good rather than a pool slot
+                connection.detach()
+                raw = connection.connection
+                raw.autocommit = True
+                cursor = raw.cursor()
+                cursor.execute(f"LISTEN {CHANNEL}")
+                # catch up on whatever was published while we weren't listening
+                cursor.execute("SELECT coalesce(max(seq), 0) FROM ledger_events")
+                self._announce(cursor.fetchone()[0])
+                delay = 1
+                while True:
+                    if select.select([raw], [], [], self.keepalive) == ([], [], []):
+                        # quiet for a while: make sure the connection is still there
+                        cursor.execute("SELECT 1")
+                        continue
+                    raw.poll()
+                    seqs = [int(notify.payload) for notify in raw.notifies]
+                    raw.notifies.clear()
+                    if seqs:
+                        self._announce(max(seqs))
+            except Exception:
+                log.exception("event listener lost its connection, reconnecting in %ss", delay)
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+_listeners = {}
+_slots = {}
+_lock = threading.Lock()
+
+
+def listener(app) -> EventListener:
+    with _lock:
+        if app not in _listeners:
+            _listeners[app] = EventListener()
+        return _listeners[app]
+
+
+def waiting_slots(app) -> threading.BoundedSemaphore:
+    """ the per-process semaphore capping waiting polls and open streams for an app"""
+    with _lock:
+        if app not in _slots:
+            _slots[app] = threading.BoundedSemaphore(app.config['EVENTS_MAX_WAITING'])
+        return _slots[app]
+
+
+def poll(since: int, limit: int, timeout: float) -> dict:
+    """ the events after `since`, waiting up to `timeout` seconds for some if there are none yet"""
+    events, after = fetch(since, limit)
+    if events or timeout <= 0:
+        return {'events': events, 'next': after}
+    app = current_app._get_current_object()
+    slots = waiting_slots(app)
+    if not slots.acquire(blocking=False):
+        raise EventsBusy(retry_after=1)
+    try:
+        # give the connection back to the pool while we wait
+        db.session.rollback()
+        started = time.perf_counter()
+        woken = listener(app).wait(db.engine, after, timeout)
+        g.metrics_waited = time.perf_counter() - started
+        if woken:
+            events, after = fetch(after, limit)
+    finally:
+        slots.release()
+    return {'events': events, 'next': after}
+
+
+def stream(since: int, limit: int) -> Response:
+    """ a Server-Sent Events response that sends every event after `since` as it is published"""
+    app = current_app._get_current_object()
+    slots = waiting_slots(app)
+    if not slots.acquire(blocking=False):
+        raise EventsBusy(retry_after=5)
+    keepalive = app.config['EVENTS_LONG_POLL_TIMEOUT']
+    engine = db.engine
+    released = threading.Event()
+
+    def release():
+        # see exports.stream_export: whichever of the generator and the server gets here first
+        if not released.is_set():
+            released.set()
+            slots.release()
+
+    def generate():
+        cursor = since
+        try:
+            while True:
+                events, cursor = fetch(cursor, limit)
+                db.session.rollback()
+                if events:
+                    yield ''.join(f"id: {event['seq']}\nevent: {EVENT_TYPE}\ndata: {serializers.dumps(event).decode()}\n\n"
+                                  for event in events)
+                    continue
+                # a comment line now and then keeps proxies from timing the stream out, and is how
+                # we find out the client has gone
+                if not listener(app).wait(engine, cursor, keepalive):
+                    yield ': keepalive\n\n'
+        finally:
+            db.session.rollback()
+            release()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx would otherwise buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.call_on_close(release)
+    return response
+
+
+##### relay #####
+
+def make_publisher(config):
+    """ a function POSTing a batch of events to EVENTS_WEBHOOK_URL, or None when there's no webhook"""
+    url = config['EVENTS_WEBHOOK_URL']
+    if not url:
+        return None
+    session = requests.Session()
+    timeout = config['EVENTS_WEBHOOK_TIMEOUT']
+
+    def publish(events):
+        response = session.post(url, data=serializers.dumps({'events': events}), timeout=timeout,
+                                headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+    return publish
+
+
+def relay_batch(batch_size: int, publish=None) -> int:
+    """ publish up to `batch_size` outbox rows in one transaction; returns how many were published"""
+    try:
+        db.session.execute(db.select(db.func.pg_advisory_xact_lock(RELAY_LOCK)))
+        seqs = db.session.execute(PUBLISH, {'batch_size': batch_size, 'now': datetime.utcnow()}).scalars().all()
+        if seqs:
+            first, last = min(seqs), max(seqs)
+            if publish is not None:
+                # our own uncommitted rows: the only ones with seqs in this range
+                publish(fetch(first - 1, len(seqs))[0])
+            db.session.execute(db.select(db.func.pg_notify(CHANNEL, str(last))))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(seqs)
+
+
+def purge_published(before: datetime, chunk_size: int) -> int:
+    """ delete events published before `before` a chunk at a time; returns how many went"""
+    purged = 0
+    while True:
+        old = (db.select(LedgerEvents.id)
+               .where(LedgerEvents.published_at < before)
+               .limit(chunk_size)
+               .scalar_subquery())
+        deleted = db.session.execute(
+            db.delete(LedgerEvents).where(LedgerEvents.id.in_(old))
+            .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        purged += deleted
+        if deleted < chunk_size:
+            return purged
+
+
+##### CLI: flask events relay|purge #####
+
+cli = AppGroup('events', help="Ledger change events.")
+
+
+@cli.command('relay')
+@click.option('--batch-size', type=int, default=None, help="Events per publish (default EVENTS_RELAY_BATCH).")
+@click.option('--once', is_flag=True, help="Publish what is pending and exit instead of running forever.")
+def relay_command(batch_size, once):
+    """Publish the outbox, batch by batch, as events are written."""
+    config = current_app.config
+    batch_size = batch_size or config['EVENTS_RELAY_BATCH']
+    interval = config['EVENTS_RELAY_INTERVAL']
+    publish = make_publisher(config)
+    total, delay = 0, interval
+    while True:
+        try:
+            published = relay_batch(batch_size, publish)
+        except Exception as e:
+            if once:
+                raise click.ClickException(f"publishing failed after {total} events: {e}")
+            log.exception("publishing failed, retrying in %ss", delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+            continue
+        total, delay = total + published, interval
+        if published:
+            log.info("published %d events", published)
+        if published < batch_size:
+            if once:
+                break
+            # an idle relay checks the (tiny) unpublished index every EVENTS_RELAY_INTERVAL seconds
+            time.sleep(interval)
+    click.echo(f"published {total} events")
+
+
+@cli.command('purge')
+@click.option('--days', type=int, default=None, help="Keep events published in the last DAYS days (default EVENTS_RETENTION_DAYS).")
+def purge_command(days):
+    """Delete published events older than the retention period."""
+    days = current_app.config['EVENTS_RETENTION_DAYS'] if days is None else days
+    purged = purge_published(datetime.utcnow() - timedelta(days=days), current_app.config['EVENTS_RELAY_BATCH'])
+    click.echo(f"purged {purged} events")
@@ -0,0 +1,136 @@
+"""Streamed exports of transaction history.
+
+GET /transactions/export writes the ledger out as NDJSON (one object per line) or CSV, in
+(created_at, id) order, without building the result in memory:
+
+- rows come from a server-side cursor (stream_results) EXPORT_CHUNK_SIZE at a time, and each chunk
+  is encoded and sent before the next is fetched, so memory stays flat however long the export is;
+- with `Accept-Encoding: gzip` the stream is compressed on the fly, chunk by chunk;
+- an interrupted export resumes with `?after_id=<last id received>`, which restarts the keyset
+  scan just after that row, and `?from=`/`?to=` bound it by date.
+
+An export holds a worker thread and a pooled connection for as long as the client keeps reading,
+so each worker process runs at most EXPORT_MAX_CONCURRENT of them and answers the rest with a 503
+and Retry-After, leaving its other threads (and connections) for ordinary requests.
+"""
+import csv
+import io
+import threading
+import zlib
+
+from flask import Response, current_app, json, stream_with_context
+from werkzeug.exceptions import ServiceUnavailable
+
+from models import db, Transactions
+
+COLUMNS = ('id', 'created_at', 'amount', 'note', 'debit_id', 'credit_id', 'customer_id')
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+class ExportsBusy(ServiceUnavailable):
+    description = "Too many exports in progress, try again shortly"
+
+
+_slots = {}
+_slots_lock = threading.Lock()
+
+
+def export_slots(app) -> threading.BoundedSemaphore:
+    """ the per-process semaphore capping concurrent exports for an app"""
+    with _slots_lock:
+        if app not in _slots:
+            _slots[app] = threading.BoundedSemaphore(app.config['EXPORT_MAX_CONCURRENT'])
+        return _slots[app]
+
+
+def resume_point(after_id):
+    """ (created_at, id) of the row an export should resume after, or None if there's no such row"""
+    return db.session.execute(
+        db.select(Transactions.created_at, Transactions.id).where(Transactions.id == after_id)).first()
+
+
+def export_query(after=None, start=None, end=None, customer_id=None, account_id=None):
+    """ the ledger rows to export, in (created_at, id) order, starting after the `after` resume point"""
+    query = db.select(*[getattr(Transactions, c) for c in COLUMNS])
+    if after is not None:
+        # keyset resume: one range scan of the (created_at, id) index from just past that row
+        query = query.where(db.tuple_(Transactions.created_at, Transactions.id) > db.tuple_(after.created_at, after.id))
+    if start is not None:
+        query = query.where(Transactions.created_at >= start)
+    if end is not None:
+        query = query.where(Transactions.created_at < end)
+    if customer_id is not None:
+        query = query.where(Transactions.customer_id == customer_id)
+    if account_id is not None:
+        query = query.where(db.or_(Transactions.debit_id == account_id, Transactions.credit_id == account_id))
+    return query.order_by(Transactions.created_at, Transactions.id)
+
+
+def as_ndjson(rows) -> str:
+    return ''.join(json.dumps({
+        'id': str(row.id),
+        'created_at': row.created_at.isoformat(),
+        'amount': float(row.amount),
+        'note': row.note,
+        'debit_id': str(row.debit_id) if row.debit_id else None,
+        'credit_id': str(row.credit_id) if row.credit_id else None,
+        'customer_id': str(row.customer_id),
+    }) + '\n' for row in rows)
+
+
+def as_csv(rows) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        (row.id, row.created_at.isoformat(), row.amount, row.note, row.debit_id or '', row.credit_id or '', row.customer_id)
+        for row in rows)
+    return buffer.getvalue()
+
+
+def stream_export(query, fmt: str, compress: bool, filename: str) -> Response:
+    """ stream `query` as NDJSON or CSV, gzipped if asked; 503 when this process is already busy exporting"""
+    app = current_app._get_current_object()
+    slots = export_slots(app)
+    if not slots.acquire(blocking=False):
+        raise ExportsBusy(retry_after=5)
+    chunk_size = app.config['EXPORT_CHUNK_SIZE']
+    encode = as_csv if fmt == 'csv' else as_ndjson
+    released = threading.Event()
+
+    def release():
+        # once the stream has finished or, if the client went away before it started, when the
+        # server closes the response
+        if not released.is_set():
+            released.set()
+            slots.release()
+
+    def generate():
+        gzip = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+        def pack(text: str) -> bytes:
+            data = text.encode('utf-8')
+            # a sync flush per chunk so the client can decode what it has so far
+            return gzip.compress(data) + gzip.flush(zlib.Z_SYNC_FLUSH) if gzip else data
+
+        try:
+            result = db.session.execute(query, execution_options={'stream_results': True, 'max_row_buffer': chunk_size})
+            if fmt == 'csv':
+                yield pack(','.join(COLUMNS) + '\r\n')
+            for rows in result.partitions(chunk_size):
+                yield pack(encode(rows))
+            if gzip:
+                yield gzip.flush()
+        finally:
+            # end the read transaction (and close the cursor) now rather than at teardown
+            db.session.rollback()
+            release()
+
+    response = Response(stream_with_context(generate()), mimetype=FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.call_on_close(release)
+    return response
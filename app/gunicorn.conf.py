@@ -0,0 +1,21 @@
+# gunicorn settings, all overridable from the environment:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Threads per worker let a worker keep serving while another request waits on Postgres or Polygon;
+# keep DB_POOL_SIZE >= GUNICORN_THREADS so a thread never waits on the connection pool.
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# recycle workers now and then so a slow leak can't grow forever; jitter keeps them from restarting together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+# set GUNICORN_ACCESSLOG= (empty) to turn the access log off
+accesslog = os.environ.get('GUNICORN_ACCESSLOG', '-') or None
+loglevel = os.environ.get('GUNICORN_LOGLEVEL', 'info')
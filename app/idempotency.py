@@ -0,0 +1,193 @@
+"""Idempotency keys for mutating endpoints.
+
+A client that sends `Idempotency-Key: <unique string>` with a POST can safely retry it: the first
+request runs, later ones with the same key get the stored response back (with an
+`Idempotent-Replayed: true` header) without touching the ledger again.
+
+The key's row is inserted in the same database transaction as the work it guards, before the
+view runs, so the ledger change and the key commit (or roll back) together. A concurrent duplicate
+inserting the same key blocks on the primary key until the first request finishes: it then either
+finds the committed key and replays the response, or, if the first request failed and rolled
+back, runs the request itself. Only one of them ever executes.
+
+An error normally rolls the key back with everything else, so a retry after it runs again. Some
+views commit as they go, though (a transfer is posted in its own chunk before the view knows it was
+rejected, a long upload commits a chunk at a time), and their key commits with the first of it: for
+those the error is the request's outcome, and it is stored and replayed like a success. Keys are
+kept for IDEMPOTENCY_TTL seconds, then removed by `flask idempotency purge`.
+"""
+import functools
+import hashlib
+import json
+import logging
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app, g, make_response, request
+from flask.cli import AppGroup
+from sqlalchemy.dialects.postgresql import insert
+from werkzeug.exceptions import BadRequest, Conflict, HTTPException, InternalServerError, UnprocessableEntity
+
+from models import db, IdempotencyKeys
+
+log = logging.getLogger('bank.idempotency')
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+# bodies a view reads a line at a time (see request_postings in app.py) rather than all at once
+STREAMED_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+# how much of a streamed body is spooled in memory before it goes to a temporary file
+SPOOL_MEMORY = 1024 * 1024
+
+
+class IdempotencyKeyReused(UnprocessableEntity):
+    description = "This Idempotency-Key was already used for a different request"
+
+
+class IdempotencyInProgress(Conflict):
+    description = "A request with this Idempotency-Key was processed but its response is not available yet; retry shortly"
+
+
+def request_fingerprint() -> str:
+    """ what makes two requests "the same": method, path with query string, and body"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{request.method} {request.full_path}\n".encode('utf-8'))
+    if request.mimetype in STREAMED_MIMETYPES:
+        # hashing reads the whole upload: copy it aside on the way, so the view can still read it
+        # line by line (see request_stream) without it all being held in memory
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        for block in iter(lambda: request.stream.read(64 * 1024), b''):
+            digest.update(block)
+            spool.write(block)
+        spool.seek(0)
+        g.idempotency_body = spool
+    else:
+        digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def request_stream():
+    """ the request body as a stream, also once request_fingerprint() has read it"""
+    body = g.get('idempotency_body')
+    return body if body is not None else request.stream
+
+
+def replay(status: int, body: str):
+    response = current_app.response_class(body, status=status, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def claim(key: str, fingerprint: str):
+    """ insert the key in the current transaction; None if we own it now, else the committed row"""
+    while True:
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            insert(IdempotencyKeys)
+            .values(key=key, request_hash=fingerprint, created_at=now,
+                    expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_TTL']))
+            .on_conflict_do_nothing()
+            .returning(IdempotencyKeys.key)).first()
+        if claimed is not None:
+            return None
+        existing = db.session.execute(db.select(IdempotencyKeys).where(IdempotencyKeys.key == key)).scalar()
+        if existing is not None:
+            return existing
+        # purged between the two statements: try again
+
+
+def idempotent(view):
+    """ decorator: honour an Idempotency-Key header on POSTs to this view"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None or request.method != 'POST':
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise BadRequest(f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters")
+        fingerprint = request_fingerprint()
+
+        # blocks here while another request holding the same key is still running
+        existing = claim(key, fingerprint)
+        # between the original's commit and its response being saved there's a short window with no
+        # response yet; wait it out rather than send the client away
+        deadline = time.monotonic() + current_app.config['IDEMPOTENCY_WAIT']
+        while (existing is not None and existing.response_status is None
+               and existing.request_hash == fingerprint and time.monotonic() < deadline):
+            db.session.rollback()
+            time.sleep(0.05)
+            existing = claim(key, fingerprint)
+
+        if existing is not None:
+            request_hash, status, body = existing.request_hash, existing.response_status, existing.response_body
+            db.session.rollback()
+            if request_hash != fingerprint:
+                raise IdempotencyKeyReused()
+            if status is None:
+                raise IdempotencyInProgress()
+            return replay(status, body)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except HTTPException as e:
+            # an abort() may come after the view committed work (and our key with it): turn it into
+            # the response here so it can be saved like any other
+            response = make_response(current_app.handle_user_exception(e))
+        except Exception:
+            # release the key now rather than at teardown, so a waiting duplicate can go ahead
+            db.session.rollback()
+            # if work was committed before the failure, running it again isn't safe either
+            save_response(key, InternalServerError.code, json.dumps({
+                "code": InternalServerError.code,
+                "name": InternalServerError().name,
+                "description": "The request failed after part of it was committed; check its effects before sending it again",
+            }))
+            raise
+        if not 200 <= response.status_code < 300:
+            # undo what the view left uncommitted; the key goes too unless it was committed already
+            db.session.rollback()
+        save_response(key, response.status_code, response.get_data(as_text=True))
+        return response
+    return wrapper
+
+
+def save_response(key: str, status: int, body: str):
+    """ store what to replay for a key that is still ours, and commit it; a no-op once the key has
+    been rolled back"""
+    db.session.execute(
+        db.update(IdempotencyKeys)
+        .where(IdempotencyKeys.key == key, IdempotencyKeys.response_status.is_(None))
+        .values(response_status=status, response_body=body))
+    db.session.commit()
+
+
+def purge_expired(chunk_size: int) -> int:
+    """ delete expired keys a chunk at a time; returns how many went"""
+    purged = 0
+    while True:
+        expired = (db.select(IdempotencyKeys.key)
+                   .where(IdempotencyKeys.expires_at < datetime.utcnow())
+                   .limit(chunk_size)
+                   .scalar_subquery())
+        deleted = db.session.execute(
+            db.delete(IdempotencyKeys).where(IdempotencyKeys.key.in_(expired))
+            .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        purged += deleted
+        if deleted < chunk_size:
+            log.info("purged %d expired idempotency keys", purged)
+            return purged
+
+
+##### CLI: flask idempotency purge #####
+
+cli = AppGroup('idempotency', help="Idempotency key maintenance.")
+
+
+@cli.command('purge')
+@click.option('--chunk-size', type=int, default=10000, help="keys deleted per transaction")
+def purge_command(chunk_size):
+    """Delete idempotency keys older than IDEMPOTENCY_TTL."""
+    click.echo(f"purged {purge_expired(chunk_size)} expired keys")
@@ -0,0 +1,128 @@
+"""Nightly interest accrual.
+
+`flask interest accrue [--date YYYY-MM-DD]` credits one day of interest to every eligible account:
+AccountTypes.interest_rate is the annual rate as a fraction (0.02 is 2%), so a day's interest is
+balance * interest_rate / INTEREST_DAYS_IN_YEAR, rounded to the cent. Accounts below their type's
+min_balance, and amounts that round to nothing, get no interest.
+
+Accounts are processed in id order, INTEREST_CHUNK_SIZE at a time, each chunk one SQL statement:
+lock the chunk's accounts, work out the interest, add it to the balances and insert the ledger
+rows (credit_id = the account, no debit side) and their outbox events, all in the database. The
+interest_runs row for the date is moved on in the same transaction, so a run that is stopped or
+crashes picks up after the last committed chunk when started again, and rerunning a finished date
+does nothing.
+"""
+import logging
+from datetime import date, datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, InterestRuns
+
+log = logging.getLogger('bank.interest')
+
+FIRST_ID = '00000000-0000-0000-0000-000000000000'
+
+# needs Postgres 13+ for the gen_random_uuid() inside uuid_v7() (see models.py)
+ACCRUE_CHUNK = db.text("""
+WITH chunk AS (
+    SELECT a.id, a.customer_id, a.balance, t.interest_rate, t.min_balance
+    FROM accounts a JOIN account_types t ON t.id = a.acct_type_id
+    WHERE a.id > :after
+    ORDER BY a.id
+    LIMIT :chunk_size
+    FOR UPDATE OF a
+),
+interest AS (
+    SELECT id, customer_id, round(balance * interest_rate / :days_in_year, 2) AS amount
+    FROM chunk
+    WHERE interest_rate > 0 AND balance >= min_balance
+),
+credited AS (
+    UPDATE accounts SET balance = accounts.balance + interest.amount
+    FROM interest
+    WHERE accounts.id = interest.id AND interest.amount > 0
+    RETURNING accounts.id, interest.customer_id, interest.amount
+),
+posted AS (
+    -- stamped now, with the rows locked, like every other movement (see snapshots.py)
+    INSERT INTO transactions (id, amount, note, debit_id, credit_id, customer_id, created_at)
+    SELECT uuid_v7(), amount, :note, NULL, id, customer_id, clock_timestamp() AT TIME ZONE 'UTC' FROM credited
+    RETURNING id, credit_id, customer_id, amount, created_at
+),
+outbox AS (
+    INSERT INTO ledger_events (transaction_id, created_at)
+    SELECT id, created_at FROM posted
+)
+SELECT (SELECT id FROM chunk ORDER BY id DESC LIMIT 1) AS last_id,
+       (SELECT count(*) FROM posted) AS credited,
+       (SELECT coalesce(sum(amount), 0) FROM posted) AS total,
+       (SELECT array_agg(credit_id::text) FROM posted) AS account_ids,
+       (SELECT array_agg(customer_id::text) FROM posted) AS customer_ids
+""")
+
+
+def accrue_interest(accrual_date: date, chunk_size: int, days_in_year: int = 365, invalidate=None) -> InterestRuns:
+    """ credit a day's interest to every eligible account, resuming a run for the same date.
+
+    `invalidate` is called with the (account_id, customer_id) pairs credited by each chunk.
+    """
+    db.session.execute(insert(InterestRuns).values(accrual_date=accrual_date, accounts_credited=0,
+                                                   total_interest=0, started_at=datetime.utcnow())
+                       .on_conflict_do_nothing())
+    db.session.commit()
+    note = f"Interest for {accrual_date.isoformat()}"
+
+    while True:
+        # the run row is locked for the chunk, so two jobs for the same date take turns
+        run = db.session.execute(db.select(InterestRuns).where(InterestRuns.accrual_date == accrual_date)
+                                 .with_for_update()).scalar()
+        if run.finished_at is not None:
+            db.session.rollback()
+            return run
+
+        result = db.session.execute(ACCRUE_CHUNK, {
+            'after': str(run.last_account_id or FIRST_ID),
+            'chunk_size': chunk_size,
+            'days_in_year': days_in_year,
+            'note': note,
+        }).one()
+
+        if result.last_id is None:
+            run.finished_at = datetime.utcnow()
+        else:
+            run.last_account_id = result.last_id
+            run.accounts_credited += result.credited
+            run.total_interest += result.total
+        db.session.commit()
+
+        if result.account_ids and invalidate is not None:
+            invalidate(zip(result.account_ids, result.customer_ids))
+        if run.finished_at is not None:
+            log.info("interest for %s: %d accounts credited %s", accrual_date, run.accounts_credited, run.total_interest)
+            return run
+        log.info("interest for %s: through %s, %d accounts credited so far",
+                 accrual_date, run.last_account_id, run.accounts_credited)
+
+
+##### CLI: flask interest accrue #####
+
+cli = AppGroup('interest', help="Interest accrual.")
+
+
+@cli.command('accrue')
+@click.option('--date', 'accrual_date', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help="day to accrue for (default today, UTC)")
+@click.option('--chunk-size', type=int, default=None, help="accounts per transaction (default INTEREST_CHUNK_SIZE)")
+def accrue_command(accrual_date, chunk_size):
+    """Credit a day's interest to every eligible account."""
+    # the balance cache lives in the app module; imported here since app imports this one
+    from app import invalidate_accounts
+    run = accrue_interest(accrual_date.date() if accrual_date else datetime.utcnow().date(),
+                          chunk_size or current_app.config['INTEREST_CHUNK_SIZE'],
+                          current_app.config['INTEREST_DAYS_IN_YEAR'],
+                          invalidate=invalidate_accounts)
+    click.echo(f"{run.accrual_date}: {run.accounts_credited} accounts credited {run.total_interest}")
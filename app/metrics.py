@@ -0,0 +1,222 @@
+"""Request, SQL and outbound-call instrumentation, exposed in Prometheus text format.
+
+init_app() hooks every request (before_request / after_request) and every SQL statement
+(SQLAlchemy before/after_cursor_execute), and records per route:
+
+* bank_request_duration_seconds   handler latency
+* bank_request_db_statements      statements executed per request
+* bank_request_db_seconds         time spent in the database per request
+
+plus bank_outbound_request_seconds for calls to Polygon (see prices.py), the rate limiter's
+counters (see ratelimit.py) and where read-only requests were routed (see replicas.py). Requests
+slower than SLOW_REQUEST_THRESHOLD are logged to the `bank.slow_requests` logger together with
+their slowest statements (SQL text only, never parameters). Streamed responses (see
+pagination.py) run their query while the body is sent, after after_request, so it isn't counted
+against the route.
+
+Metrics live in the process that recorded them; with several gunicorn workers each scrape sees
+one worker, so scrape every worker or aggregate the series by `instance`.
+"""
+import heapq
+import logging
+import threading
+import time
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_log = logging.getLogger('bank.slow_requests')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets + ('+Inf',), series[:len(self.buckets)] + [series[-1]]):
+                    le = 'le="%s"' % bound
+                    lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, [le])} {count}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {series[-2]}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {series[-1]}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'bank_request_duration_seconds', 'Time spent handling a request.', ['method', 'route', 'status']))
+REQUEST_DB_STATEMENTS = REGISTRY.register(Histogram(
+    'bank_request_db_statements', 'SQL statements executed per request.', ['method', 'route'], COUNT_BUCKETS))
+REQUEST_DB_TIME = REGISTRY.register(Histogram(
+    'bank_request_db_seconds', 'Time spent executing SQL per request.', ['method', 'route']))
+SLOW_REQUESTS = REGISTRY.register(Counter(
+    'bank_slow_requests_total', 'Requests slower than SLOW_REQUEST_THRESHOLD.', ['method', 'route']))
+OUTBOUND_LATENCY = REGISTRY.register(Histogram(
+    'bank_outbound_request_seconds', 'Time spent in calls to external services.', ['service', 'outcome']))
+RATE_LIMITED = REGISTRY.register(Counter(
+    'bank_rate_limited_total', 'Requests turned away by a rate limit or PIN lockout.', ['scope']))
+PIN_LOCKOUTS = REGISTRY.register(Counter(
+    'bank_pin_lockouts_total', 'Accounts put on hold after repeated PIN failures.'))
+REPLICA_READS = REGISTRY.register(Counter(
+    'bank_replica_reads_total', 'Read-only requests by the database they were sent to.', ['target']))
+
+
+def counter_family(name: str, help: str, labelnames, samples) -> list:
+    """Exposition lines for a counter whose values are read at scrape time: samples is [(label values, value)]"""
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} counter']
+    for values, value in samples:
+        lines.append(f'{name}{_labels(labelnames, values)} {value}')
+    return lines
+
+
+##### hooks #####
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.db_statements = 0
+    g.db_time = 0.0
+    # only the SLOW_REQUEST_LOG_STATEMENTS slowest statements are kept (a min-heap of (duration,
+    # statement)), so a request running thousands of them doesn't hold every one
+    g.db_trace = []
+    g.db_trace_size = current_app.config['SLOW_REQUEST_LOG_STATEMENTS']
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    route = _route()
+    REQUEST_LATENCY.observe(elapsed, method=request.method, route=route, status=response.status_code)
+    REQUEST_DB_STATEMENTS.observe(g.db_statements, method=request.method, route=route)
+    REQUEST_DB_TIME.observe(g.db_time, method=request.method, route=route)
+
+    # a long-poll's wait for something to happen (see events.py) is the point of it, not slowness
+    if elapsed - g.pop('metrics_waited', 0.0) >= current_app.config['SLOW_REQUEST_THRESHOLD']:
+        SLOW_REQUESTS.inc(method=request.method, route=route)
+        slowest = sorted(g.db_trace, reverse=True)
+        slow_log.warning(
+            "slow request %s %s (%s) took %.1fms, %d statements in %.1fms:%s",
+            request.method, request.path, route, elapsed * 1000, g.db_statements, g.db_time * 1000,
+            ''.join(f"\n  {duration * 1000:8.1f}ms  {statement}" for duration, statement in slowest))
+    return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    if not g or 'db_trace' not in g:
+        # outside a request (CLI, background threads)
+        return
+    duration = time.perf_counter() - start
+    g.db_statements += 1
+    g.db_time += duration
+    if len(g.db_trace) < g.db_trace_size:
+        heapq.heappush(g.db_trace, (duration, ' '.join(statement.split())[:500]))
+    elif g.db_trace and duration > g.db_trace[0][0]:
+        heapq.heapreplace(g.db_trace, (duration, ' '.join(statement.split())[:500]))
+
+
+def _handle_error(context):
+    # a statement that fails never reaches after_cursor_execute: drop its start time here, or it
+    # stays behind on the pooled connection
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+_engine_hooks_installed = False
+
+
+def init_app(app):
+    """Install the request and SQL hooks on an app"""
+    global _engine_hooks_installed
+    app.config.setdefault('SLOW_REQUEST_THRESHOLD', 0.5)
+    app.config.setdefault('SLOW_REQUEST_LOG_STATEMENTS', 10)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    if not _engine_hooks_installed:
+        # listening on the Engine class covers every engine, including any created later
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _engine_hooks_installed = True
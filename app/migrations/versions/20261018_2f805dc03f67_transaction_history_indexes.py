@@ -0,0 +1,39 @@
+"""add transactions.created_at and history indexes
+
+Revision ID: 2f805dc03f67
+Revises:
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f805dc03f67'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows get the migration time; new rows are stamped by the app/server default
+    op.add_column('transactions', sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False))
+
+    # build the indexes without locking out writes on a large table; CONCURRENTLY can't run
+    # inside a transaction so these go in an autocommit block
+    with op.get_context().autocommit_block():
+        op.create_index('ix_transactions_customer_id_created_at', 'transactions', ['customer_id', 'created_at'],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index('ix_transactions_debit_id_created_at', 'transactions', ['debit_id', 'created_at'],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index('ix_transactions_credit_id_created_at', 'transactions', ['credit_id', 'created_at'],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_transactions_credit_id_created_at', table_name='transactions', postgresql_concurrently=True)
+        op.drop_index('ix_transactions_debit_id_created_at', table_name='transactions', postgresql_concurrently=True)
+        op.drop_index('ix_transactions_customer_id_created_at', table_name='transactions', postgresql_concurrently=True)
+    op.drop_column('transactions', 'created_at')
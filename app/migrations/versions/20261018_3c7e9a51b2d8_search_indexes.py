@@ -0,0 +1,33 @@
+"""trigram indexes on customer names and transaction notes for /search
+
+Revision ID: 3c7e9a51b2d8
+Revises: e8a14c7b3f92
+Create Date: 2026-10-18 23:59:31.118204
+
+Needs the pg_trgm extension available to the server (it ships with Postgres' contrib package).
+The note index is built on every transactions partition while the table is locked against writes.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c7e9a51b2d8'
+down_revision = 'e8a14c7b3f92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # must stay the same expression as search.FULL_NAME
+    op.create_index('ix_customers_name_trgm', 'customers',
+                    [sa.text("(first_name || ' ' || last_name) gin_trgm_ops")], postgresql_using='gin')
+    op.create_index('ix_transactions_note_trgm', 'transactions', ['note'],
+                    postgresql_using='gin', postgresql_ops={'note': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_transactions_note_trgm', table_name='transactions')
+    op.drop_index('ix_customers_name_trgm', table_name='customers')
+    # the extension stays: it may have been installed for something else
@@ -0,0 +1,30 @@
+"""add price_history
+
+Revision ID: 3e7a92c1b8f0
+Revises: 8d03f5b61ae4
+Create Date: 2026-10-18 19:08:52.114730
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e7a92c1b8f0'
+down_revision = '8d03f5b61ae4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('price_history',
+    sa.Column('ticker', sa.String(length=128), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('close', sa.Numeric(), nullable=False),
+    sa.Column('fetched_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('ticker', 'day')
+    )
+
+
+def downgrade():
+    op.drop_table('price_history')
@@ -0,0 +1,27 @@
+"""(created_at, id) index on transactions for streamed exports
+
+Revision ID: 5f3c8a0d14b7
+Revises: d72b4e19a6c3
+Create Date: 2026-10-18 23:11:09.604417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f3c8a0d14b7'
+down_revision = 'd72b4e19a6c3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_transactions_created_at_id', 'transactions', ['created_at', 'id'],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_transactions_created_at_id', table_name='transactions', postgresql_concurrently=True)
@@ -0,0 +1,37 @@
+"""add balance_snapshots
+
+Revision ID: 6b1e4d2a9c37
+Revises: 2f805dc03f67
+Create Date: 2026-10-18 14:02:17.554120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '6b1e4d2a9c37'
+down_revision = '2f805dc03f67'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('balance_snapshots',
+    sa.Column('account_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('as_of', sa.DateTime(), nullable=False),
+    sa.Column('balance', sa.Numeric(), nullable=False),
+    sa.Column('reconciled', sa.Boolean(), nullable=True),
+    sa.Column('ledger_balance', sa.Numeric(), nullable=True),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.PrimaryKeyConstraint('account_id', 'as_of')
+    )
+    # only the snapshots still waiting for `flask snapshots reconcile`
+    op.create_index('ix_balance_snapshots_unreconciled', 'balance_snapshots', ['account_id', 'as_of'],
+                    unique=False, postgresql_where=sa.text('reconciled IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_balance_snapshots_unreconciled', table_name='balance_snapshots')
+    op.drop_table('balance_snapshots')
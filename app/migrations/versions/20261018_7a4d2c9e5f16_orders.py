@@ -0,0 +1,47 @@
+"""orders queue for buys
+
+Revision ID: 7a4d2c9e5f16
+Revises: 3c7e9a51b2d8
+Create Date: 2026-10-19 00:04:12.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7a4d2c9e5f16'
+down_revision = '3c7e9a51b2d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('orders',
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('portfolio_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('account_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('ticker', sa.String(length=128), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=16), server_default='pending', nullable=False),
+    sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('retry_at', sa.DateTime(), nullable=True),
+    sa.Column('price', sa.Numeric(), nullable=True),
+    sa.Column('total_cost', sa.Numeric(), nullable=True),
+    sa.Column('position_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('transaction_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('error', sa.String(length=256), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('completed_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['account_id'], ['accounts.id'], ),
+    sa.ForeignKeyConstraint(['portfolio_id'], ['portfolios.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_orders_pending', 'orders', ['created_at'],
+                    unique=False, postgresql_where=sa.text("status = 'pending'"))
+
+
+def downgrade():
+    op.drop_index('ix_orders_pending', table_name='orders')
+    op.drop_table('orders')
@@ -0,0 +1,33 @@
+"""add interest_runs
+
+Revision ID: 8d03f5b61ae4
+Revises: c4a9e07f5d12
+Create Date: 2026-10-18 17:21:45.602317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8d03f5b61ae4'
+down_revision = 'c4a9e07f5d12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('interest_runs',
+    sa.Column('accrual_date', sa.Date(), nullable=False),
+    sa.Column('last_account_id', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('accounts_credited', sa.Integer(), nullable=False),
+    sa.Column('total_interest', sa.Numeric(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('accrual_date')
+    )
+
+
+def downgrade():
+    op.drop_table('interest_runs')
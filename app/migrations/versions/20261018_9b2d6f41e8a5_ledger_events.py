@@ -0,0 +1,41 @@
+"""ledger_events outbox
+
+Revision ID: 9b2d6f41e8a5
+Revises: 5f3c8a0d14b7
+Create Date: 2026-10-18 23:52:31.118402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2d6f41e8a5'
+down_revision = '5f3c8a0d14b7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('ledger_events_seq')))
+    op.create_table('ledger_events',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('transaction_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('seq', sa.BigInteger(), nullable=True),
+    sa.Column('published_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_ledger_events_unpublished', 'ledger_events', ['id'],
+                    unique=False, postgresql_where=sa.text('seq IS NULL'))
+    op.create_index('ix_ledger_events_seq', 'ledger_events', ['seq'], unique=True)
+    # no backfill: consumers start from an export (GET /transactions/export) and follow
+    # /events from there
+
+
+def downgrade():
+    op.drop_index('ix_ledger_events_seq', table_name='ledger_events')
+    op.drop_index('ix_ledger_events_unpublished', table_name='ledger_events')
+    op.drop_table('ledger_events')
+    op.execute(sa.schema.DropSequence(sa.Sequence('ledger_events_seq')))
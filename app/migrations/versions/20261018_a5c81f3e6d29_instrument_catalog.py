@@ -0,0 +1,82 @@
+"""tickers become a shared instrument catalog; holdings move onto positions
+
+Revision ID: a5c81f3e6d29
+Revises: 3e7a92c1b8f0
+Create Date: 2026-10-18 20:34:11.073395
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5c81f3e6d29'
+down_revision = '3e7a92c1b8f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('positions', sa.Column('quantity', sa.Integer(), nullable=True))
+    op.add_column('positions', sa.Column('cost_basis', sa.Numeric(), nullable=True))
+
+    # each position takes its holding off the ticker row it pointed at
+    op.execute("""
+        UPDATE positions p SET quantity = t.quantity, cost_basis = t.price * t.quantity
+        FROM tickers t WHERE t.id = p.ticker_id
+    """)
+    op.execute("UPDATE positions SET quantity = 0, cost_basis = 0 WHERE quantity IS NULL")
+
+    # one catalog row per symbol: repoint every position at the first row for its symbol
+    op.execute("UPDATE tickers SET ticker = upper(trim(ticker))")
+    op.execute("""
+        UPDATE positions p SET ticker_id = keep.id
+        FROM tickers t
+        JOIN (SELECT DISTINCT ON (ticker) ticker, id FROM tickers ORDER BY ticker, id) keep ON keep.ticker = t.ticker
+        WHERE p.ticker_id = t.id AND t.id <> keep.id
+    """)
+    # and fold several positions in the same instrument within a portfolio into the first of them
+    op.execute("""
+        WITH ranked AS (
+            SELECT id,
+                   first_value(id) OVER (PARTITION BY portfolio_id, ticker_id ORDER BY id) AS keep_id,
+                   sum(quantity) OVER (PARTITION BY portfolio_id, ticker_id) AS total_quantity,
+                   sum(cost_basis) OVER (PARTITION BY portfolio_id, ticker_id) AS total_cost
+            FROM positions
+            WHERE ticker_id IS NOT NULL
+        ),
+        merged AS (
+            UPDATE positions p SET quantity = r.total_quantity, cost_basis = r.total_cost
+            FROM ranked r WHERE p.id = r.id AND r.id = r.keep_id
+        )
+        DELETE FROM positions p USING ranked r WHERE p.id = r.id AND r.id <> r.keep_id
+    """)
+    op.execute("DELETE FROM tickers WHERE id NOT IN (SELECT DISTINCT ON (ticker) id FROM tickers ORDER BY ticker, id)")
+
+    op.alter_column('positions', 'quantity', existing_type=sa.Integer(), nullable=False)
+    op.alter_column('positions', 'cost_basis', existing_type=sa.Numeric(), nullable=False)
+    op.drop_column('tickers', 'quantity')
+    op.drop_column('tickers', 'price')
+    op.create_index('ix_tickers_ticker', 'tickers', ['ticker'], unique=True)
+    op.create_unique_constraint('uq_positions_portfolio_id_ticker_id', 'positions', ['portfolio_id', 'ticker_id'])
+
+
+def downgrade():
+    op.drop_constraint('uq_positions_portfolio_id_ticker_id', 'positions', type_='unique')
+    op.drop_index('ix_tickers_ticker', table_name='tickers')
+    op.add_column('tickers', sa.Column('price', sa.Numeric(), nullable=True))
+    op.add_column('tickers', sa.Column('quantity', sa.Integer(), nullable=True))
+
+    # a ticker row per position again (reusing the position's id), priced at the average cost
+    op.execute("""
+        INSERT INTO tickers (id, ticker, price, quantity)
+        SELECT p.id, t.ticker, CASE WHEN p.quantity > 0 THEN p.cost_basis / p.quantity ELSE 0 END, p.quantity
+        FROM positions p JOIN tickers t ON t.id = p.ticker_id
+    """)
+    op.execute("UPDATE positions SET ticker_id = id WHERE ticker_id IS NOT NULL")
+    op.execute("DELETE FROM tickers WHERE quantity IS NULL")
+
+    op.alter_column('tickers', 'price', existing_type=sa.Numeric(), nullable=False)
+    op.alter_column('tickers', 'quantity', existing_type=sa.Integer(), nullable=False)
+    op.drop_column('positions', 'cost_basis')
+    op.drop_column('positions', 'quantity')
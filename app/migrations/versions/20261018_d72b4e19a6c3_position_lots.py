@@ -0,0 +1,46 @@
+"""tax lots on positions and realized P&L
+
+Revision ID: d72b4e19a6c3
+Revises: a5c81f3e6d29
+Create Date: 2026-10-18 22:05:47.512904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd72b4e19a6c3'
+down_revision = 'a5c81f3e6d29'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('positions', sa.Column('realized_pnl', sa.Numeric(), server_default='0', nullable=False))
+    op.create_table('position_lots',
+    sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('position_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('quantity', sa.Integer(), nullable=False),
+    sa.Column('remaining', sa.Integer(), nullable=False),
+    sa.Column('cost_basis', sa.Numeric(), nullable=False),
+    sa.Column('acquired_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['position_id'], ['positions.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_position_lots_position_id_acquired_at', 'position_lots', ['position_id', 'acquired_at'],
+                    unique=False, postgresql_where=sa.text('remaining > 0'))
+
+    # the individual buys behind existing positions aren't known: each open position becomes one lot
+    # (needs Postgres 13+ for gen_random_uuid())
+    op.execute("""
+        INSERT INTO position_lots (id, position_id, quantity, remaining, cost_basis, acquired_at)
+        SELECT gen_random_uuid(), id, quantity, quantity, cost_basis, now() FROM positions WHERE quantity > 0
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_position_lots_position_id_acquired_at', table_name='position_lots')
+    op.drop_table('position_lots')
+    op.drop_column('positions', 'realized_pnl')
@@ -0,0 +1,98 @@
+"""partition transactions by month on created_at; uuid_v7() for ids made in SQL
+
+Revision ID: e8a14c7b3f92
+Revises: 9b2d6f41e8a5
+Create Date: 2026-10-18 23:58:12.406151
+
+The rows are copied into the new partitioned table, which rewrites the whole ledger and holds an
+exclusive lock on it for as long as that takes: run it in a maintenance window.
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a14c7b3f92'
+down_revision = '9b2d6f41e8a5'
+branch_labels = None
+depends_on = None
+
+COLUMNS = 'id, amount, note, debit_id, credit_id, customer_id, created_at'
+INDEXES = {
+    'ix_transactions_customer_id_created_at': ['customer_id', 'created_at'],
+    'ix_transactions_debit_id_created_at': ['debit_id', 'created_at'],
+    'ix_transactions_credit_id_created_at': ['credit_id', 'created_at'],
+    'ix_transactions_created_at_id': ['created_at', 'id'],
+}
+
+# see models.UUID_V7_FUNCTION
+UUID_V7_FUNCTION = """
+CREATE OR REPLACE FUNCTION uuid_v7() RETURNS uuid AS $$
+    SELECT encode(set_bit(set_bit(overlay(uuid_send(gen_random_uuid())
+        PLACING substring(int8send(floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint) FROM 3)
+        FROM 1 FOR 6), 52, 1), 53, 1), 'hex')::uuid
+$$ LANGUAGE sql VOLATILE
+"""
+
+
+def columns():
+    return [
+        sa.Column('id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('amount', sa.Numeric(), nullable=False),
+        sa.Column('note', sa.String(length=128), nullable=False),
+        sa.Column('debit_id', postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column('credit_id', postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column('customer_id', postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+        sa.ForeignKeyConstraint(['customer_id'], ['customers.id'], ),
+    ]
+
+
+def set_aside(table: str):
+    """ rename the current transactions table and free up its index names"""
+    op.execute(f"ALTER TABLE transactions RENAME TO {table}")
+    op.execute(f"ALTER TABLE {table} RENAME CONSTRAINT transactions_pkey TO {table}_pkey")
+    for name in INDEXES:
+        op.drop_index(name, table_name=table)
+
+
+def create_indexes():
+    for name, index_columns in INDEXES.items():
+        op.create_index(name, 'transactions', index_columns, unique=False)
+
+
+def upgrade():
+    op.execute(UUID_V7_FUNCTION)
+    set_aside('transactions_unpartitioned')
+    op.create_table('transactions', *columns(), sa.PrimaryKeyConstraint('id', 'created_at'),
+                    postgresql_partition_by='RANGE (created_at)')
+    create_indexes()
+    # a partition for every month from the oldest row to three months from now (after that
+    # partitions.py keeps them coming)
+    op.execute("""
+        DO $$
+        DECLARE
+            month date;
+            last date := date_trunc('month', now() + interval '3 months');
+        BEGIN
+            SELECT date_trunc('month', coalesce(min(created_at), now())) INTO month FROM transactions_unpartitioned;
+            WHILE month <= last LOOP
+                EXECUTE format('CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                               'transactions_p' || to_char(month, 'YYYYMM'), month, month + interval '1 month');
+                month := month + interval '1 month';
+            END LOOP;
+        END $$
+    """)
+    op.execute(f"INSERT INTO transactions ({COLUMNS}) SELECT {COLUMNS} FROM transactions_unpartitioned")
+    op.drop_table('transactions_unpartitioned')
+
+
+def downgrade():
+    set_aside('transactions_partitioned')
+    op.create_table('transactions', *columns(), sa.PrimaryKeyConstraint('id'))
+    create_indexes()
+    op.execute(f"INSERT INTO transactions ({COLUMNS}) SELECT {COLUMNS} FROM transactions_partitioned")
+    # takes the partitions with it
+    op.drop_table('transactions_partitioned')
+    op.execute("DROP FUNCTION uuid_v7()")
@@ -0,0 +1,399 @@
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import UUID
+from replicas import RoutingSQLAlchemy
+import os
+import time
+import uuid
+from datetime import datetime
+
+
+###### MODELS: #######
+
+##If you change anything in these classes in these models you need to do an upgrade and migrate-- 
+# (flask db migrate -m "..." then flask db upgrade)
+
+# reads from @replica_reads views go to a replica, everything else to the primary (see replicas.py)
+db = RoutingSQLAlchemy()
+
+
+def uuid7() -> uuid.UUID:
+    """ a time-ordered UUID (version 7): 48 bits of Unix time in milliseconds, then random bits.
+    New rows land at the right-hand end of the id index instead of on a random page of it."""
+    value = (time.time_ns() // 1000000) << 80 | int.from_bytes(os.urandom(10), 'big')
+    value = value & ~(0xf << 76) | 0x7 << 76
+    value = value & ~(0x3 << 62) | 0x2 << 62
+    return uuid.UUID(int=value)
+
+
+# the same for rows inserted in SQL (interest accrual, bulk loads); Postgres 18's uuidv7() is equivalent
+UUID_V7_FUNCTION = """
+CREATE OR REPLACE FUNCTION uuid_v7() RETURNS uuid AS $$
+    SELECT encode(set_bit(set_bit(overlay(uuid_send(gen_random_uuid())
+        PLACING substring(int8send(floor(extract(epoch FROM clock_timestamp()) * 1000)::bigint) FROM 3)
+        FROM 1 FOR 6), 52, 1), 53, 1), 'hex')::uuid
+$$ LANGUAGE sql VOLATILE
+"""
+event.listen(db.Model.metadata, 'before_create', DDL(UUID_V7_FUNCTION))
+
+
+# trigram operator classes for the search indexes (see search.py) come from pg_trgm, a contrib extension
+# that isn't always installed. create_all() adds the extension and the indexes only where the server
+# has it, so a bare Postgres still gets a schema (search just won't work on it); migrations always do.
+# Autogenerate ignores the indexes (see migrations/env.py) since they aren't in the metadata.
+SEARCH_INDEXES = ('ix_customers_name_trgm', 'ix_transactions_note_trgm')
+
+
+def pg_trgm_available(ddl, target, bind, **kw):
+    return bind.execute(db.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).first() is not None
+
+
+event.listen(db.Model.metadata, 'before_create',
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(callable_=pg_trgm_available))
+
+class Customers(db.Model):
+    __tablename__ = "customers"
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    first_name = db.Column(db.String(128), nullable=False)
+    last_name = db.Column(db.String(128), nullable=False)
+    pin = db.Column(db.Integer, nullable=False)
+    password = db.Column(db.String(128), nullable=False)
+    portfolio_id = db.Column(UUID(as_uuid=True), db.ForeignKey('portfolios.id'), nullable=True)
+    # customers and portfolios point at each other, so say which foreign key this one follows
+    portfolios = db.relationship('Portfolios', back_populates='customer', foreign_keys='Portfolios.customer_id')
+    # serialize tells us what each table should return, telling what columns to return and giving us
+    # a chance in python to optimize the data types we want to returnflask 
+    def serialize(self):
+        return {
+            'id': str(self.id),
+            'first_name': self.first_name,
+            'last_name': self.last_name,
+            'pin': self.pin,
+            'password': self.password,
+            'portfolio_id': str(self.portfolio_id)
+        }
+
+
+class Accounts(db.Model):
+    __tablename__ = "accounts"
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    balance = db.Column(db.Numeric, nullable=False, default=0.00)
+    hold = db.Column(db.Boolean, nullable=False, default=False)
+    acct_type_id = db.Column(db.Integer, db.ForeignKey('account_types.id'), nullable=False)
+    customer_id = db.Column(UUID(as_uuid=True), db.ForeignKey('customers.id'), nullable=False)
+
+    def serialize(self):
+        return {
+            'id': str(self.id),
+            'balance': float(self.balance),
+            'acct_type_id': self.acct_type_id,
+            'hold': self.hold
+        }
+
+
+class AccountTypes(db.Model):
+    __tablename__ = "account_types"
+    id = db.Column(db.Integer, autoincrement = True, primary_key=True)
+    type = db.Column(db.String(128), nullable=False)
+    interest_rate = db.Column(db.Numeric, nullable=False, default=0.0)
+    min_balance = db.Column(db.Numeric, nullable=False, default=0.0)
+    # accounts = db.relationship('Accounts', backref='account_types', lazy=True)
+
+    def serialize(self):
+        return {
+            'id': self.id,
+            'type': self.type,
+            'interest_rate': float(self.interest_rate),
+            'min_balance': float(self.min_balance)
+        }
+
+class Portfolios(db.Model):
+    __tablename__ = "portfolios"
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    customer_id = db.Column(UUID(as_uuid=True), db.ForeignKey('customers.id'), nullable=False)
+    customer = db.relationship('Customers', back_populates='portfolios', foreign_keys=[customer_id])
+    positions = db.relationship('Positions', back_populates='portfolio')
+
+    def serialize(self):
+        return {
+            'id': str(self.id),
+            'customer_id': str(self.customer_id)
+        }
+
+class Positions(db.Model):
+    # one row per instrument held in a portfolio: quantity and cost_basis (what the shares still held
+    # cost) move with every buy and sell, realized_pnl adds up each sell's gain or loss
+    __tablename__ = "positions"
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    ticker_id = db.Column(UUID(as_uuid=True), db.ForeignKey('tickers.id'), nullable=True)
+    portfolio_id = db.Column(UUID(as_uuid=True), db.ForeignKey('portfolios.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    cost_basis = db.Column(db.Numeric, nullable=False, default=0)
+    realized_pnl = db.Column(db.Numeric, nullable=False, default=0, server_default='0')
+    portfolio = db.relationship('Portfolios', back_populates='positions')
+    tickers = db.relationship('Tickers', back_populates='positions')
+    lots = db.relationship('PositionLots', back_populates='position')
+    __table_args__ = (
+        db.UniqueConstraint('portfolio_id', 'ticker_id', name='uq_positions_portfolio_id_ticker_id'),
+        {})
+
+    def average_cost(self):
+        return self.cost_basis / self.quantity if self.quantity else self.cost_basis
+
+    def serialize(self):
+        return {
+            'id': str(self.id),
+            'ticker_id': str(self.ticker_id),
+            'portfolio_id': str(self.portfolio_id),
+            'quantity': self.quantity,
+            'cost_basis': float(self.cost_basis),
+            'realized_pnl': float(self.realized_pnl or 0)
+        }
+
+class PositionLots(db.Model):
+    # one row per buy (tax lot): sells use up the oldest lots first, or the ones the client names
+    __tablename__ = "position_lots"
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    position_id = db.Column(UUID(as_uuid=True), db.ForeignKey('positions.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    # what is left of the lot, and what those remaining shares cost
+    remaining = db.Column(db.Integer, nullable=False)
+    cost_basis = db.Column(db.Numeric, nullable=False)
+    acquired_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    position = db.relationship('Positions', back_populates='lots')
+    __table_args__ = (
+        db.Index('ix_position_lots_position_id_acquired_at', 'position_id', 'acquired_at',
+                 postgresql_where=db.text('remaining > 0')),
+        {})
+
+    def serialize(self):
+        return {
+            'id': str(self.id),
+            'position_id': str(self.position_id),
+            'quantity': self.quantity,
+            'remaining': self.remaining,
+            'cost_basis': float(self.cost_basis),
+            'acquired_at': self.acquired_at.isoformat()
+        }
+
+class Orders(db.Model):
+    # a buy queued by POST /portfolios/<id>/positions/buy and filled later by `flask orders work`
+    # (see orders.py); price, total_cost and the ids of what the fill made are set when it's filled
+    __tablename__ = "orders"
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
+    portfolio_id = db.Column(UUID(as_uuid=True), db.ForeignKey('portfolios.id'), nullable=False)
+    account_id = db.Column(UUID(as_uuid=True), db.ForeignKey('accounts.id'), nullable=False)
+    ticker = db.Column(db.String(128), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    # pending until a worker gets to it, then filled, or rejected with the reason in error
+    status = db.Column(db.String(16), nullable=False, default='pending', server_default='pending')
+    # rounds the order has been left pending because it couldn't be filled yet (its ticker couldn't be
+    # priced), and when the next one may start
+    attempts = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    retry_at = db.Column(db.DateTime, nullable=True)
+    price = db.Column(db.Numeric, nullable=True)
+    total_cost = db.Column(db.Numeric, nullable=True)
+    position_id = db.Column(UUID(as_uuid=True), nullable=True)
+    transaction_id = db.Column(UUID(as_uuid=True), nullable=True)
+    error = db.Column(db.String(256), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=db.func.now())
+    completed_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (
+        # the queue: just the pending orders, oldest first
+        db.Index('ix_orders_pending', 'created_at', postgresql_where=db.text("status = 'pending'")),
+        {})
+
+    def serialize(self):
+        return {
+            'id': str(self.id),
+            'portfolio_id': str(self.portfolio_id),
+            'account_id': str(self.account_id),
+            'ticker': self.ticker,
+            'quantity': self.quantity,
+            'status': self.status,
+            'price': float(self.price) if self.price is not None else None,
+            'total_cost': float(self.total_cost) if self.total_cost is not None else None,
+            'position_id': str(self.position_id) if self.position_id else None,
+            'transaction_id': str(self.transaction_id) if self.transaction_id else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
+
+class Tickers(db.Model):
+    # the instrument catalog: one row per symbol, shared by every portfolio that holds it
+    __tablename__ = "tickers"
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    ticker = db.Column(db.String(128), nullable=False)
+    positions = db.relationship('Positions', back_populates='tickers')
+    __table_args__ = (
+        db.Index('ix_tickers_ticker', 'ticker', unique=True),
+        {})
+
+    def serialize(self):
+        return {
+            'id': str(self.id),
+            'ticker': self.ticker,
+        }
+
+class PriceHistory(db.Model):
+    # closing prices by valuation date, filled in by `flask prices revalue` (and by buys) so valuations
+    # read prices from here instead of calling Polygon; close is the latest close on or before `day`
+    __tablename__ = "price_history"
+    ticker = db.Column(db.String(128), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    close = db.Column(db.Numeric, nullable=False)
+    fetched_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.PrimaryKeyConstraint('ticker', 'day'),
+        {})
+
+    def serialize(self):
+        return {
+            'ticker': self.ticker,
+            'day': self.day.isoformat(),
+            'close': float(self.close),
+            'fetched_at': self.fetched_at.isoformat()
+        }
+
+class Transactions(db.Model):
+    # range partitioned by month on created_at, which therefore has to be part of the primary key;
+    # partitions are created ahead of time and old ones archived by `flask partitions` (see partitions.py)
+    __tablename__ = "transactions"
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid7)
+    amount = db.Column(db.Numeric, nullable=False)
+    note = db.Column(db.String(128), nullable=False)
+    debit_id = db.Column(UUID(as_uuid=True), nullable=True)
+    credit_id = db.Column(UUID(as_uuid=True), nullable=True)
+    customer_id = db.Column(UUID(as_uuid=True), db.ForeignKey('customers.id'), nullable=False)
+    created_at = db.Column(db.DateTime, primary_key=True, nullable=False, default=datetime.utcnow, server_default=db.func.now())
+    # history lookups are always "this customer/account, in this date range", so lead with the
+    # owner and keep created_at second for the range scan and the ORDER BY
+    __table_args__ = (
+        db.Index('ix_transactions_customer_id_created_at', 'customer_id', 'created_at'),
+        db.Index('ix_transactions_debit_id_created_at', 'debit_id', 'created_at'),
+        db.Index('ix_transactions_credit_id_created_at', 'credit_id', 'created_at'),
+        # the export walks the whole ledger in (created_at, id) order and resumes from a row in it
+        db.Index('ix_transactions_created_at_id', 'created_at', 'id'),
+        {'postgresql_partition_by': 'RANGE (created_at)'})
+
+    def serialize(self):
+        return {
+            'id': str(self.id),
+            'amount': float(self.amount),
+            'note': self.note,
+            'debit_id': str(self.debit_id),
+            'credit_id': str(self.credit_id),
+            'customer_id': str(self.customer_id),
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+
+# GET /search?type=customers looks names up by the trigrams of the full name; search.FULL_NAME has to
+# stay the same expression for the planner to use it. GET /search?type=transactions matches notes.
+event.listen(Customers.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_customers_name_trgm ON customers USING gin ((first_name || ' ' || last_name) gin_trgm_ops)"
+).execute_if(callable_=pg_trgm_available))
+event.listen(Transactions.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_transactions_note_trgm ON transactions USING gin (note gin_trgm_ops)"
+).execute_if(callable_=pg_trgm_available))
+
+
+# handed out by `flask events relay` as it publishes, so seq order is publish order (see events.py)
+LEDGER_EVENT_SEQ = db.Sequence('ledger_events_seq', metadata=db.Model.metadata)
+
+
+class LedgerEvents(db.Model):
+    # the transactional outbox: one row per Transactions row, inserted in the same commit, with the
+    # same created_at so reading the ledger row back only has to look in one partition. seq is NULL
+    # until the relay publishes the row; consumers page through published rows by seq
+    __tablename__ = "ledger_events"
+    id = db.Column(db.BigInteger, primary_key=True)
+    transaction_id = db.Column(UUID(as_uuid=True), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    seq = db.Column(db.BigInteger, nullable=True)
+    published_at = db.Column(db.DateTime, nullable=True)
+    __table_args__ = (
+        # the relay's queue: only the unpublished rows, so it stays tiny however long the table gets
+        db.Index('ix_ledger_events_unpublished', 'id', postgresql_where=db.text('seq IS NULL')),
+        db.Index('ix_ledger_events_seq', 'seq', unique=True),
+        {})
+
+
+class BalanceSnapshots(db.Model):
+    # an account's balance as of a point in time, so statements and point-in-time balances start
+    # here instead of replaying the whole ledger. Taken by `flask snapshots take`, checked against
+    # the ledger by `flask snapshots reconcile` (see snapshots.py)
+    __tablename__ = "balance_snapshots"
+    account_id = db.Column(UUID(as_uuid=True), db.ForeignKey('accounts.id'), nullable=False)
+    as_of = db.Column(db.DateTime, nullable=False)
+    balance = db.Column(db.Numeric, nullable=False)
+    # None until reconciled, then whether the ledger agreed; ledger_balance is what the ledger says
+    reconciled = db.Column(db.Boolean, nullable=True)
+    ledger_balance = db.Column(db.Numeric, nullable=True)
+    __table_args__ = (
+        db.PrimaryKeyConstraint('account_id', 'as_of'),
+        db.Index('ix_balance_snapshots_unreconciled', 'account_id', 'as_of',
+                 postgresql_where=db.text('reconciled IS NULL')),
+        {})
+
+    def serialize(self):
+        return {
+            'account_id': str(self.account_id),
+            'as_of': self.as_of.isoformat(),
+            'balance': float(self.balance),
+            'reconciled': self.reconciled,
+            'ledger_balance': float(self.ledger_balance) if self.ledger_balance is not None else None
+        }
+
+
+class IdempotencyKeys(db.Model):
+    # one row per Idempotency-Key a client has sent to a mutating endpoint; it commits together with
+    # the work it guards, and holds the response to replay for retries (see idempotency.py)
+    __tablename__ = "idempotency_keys"
+    key = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(32), nullable=False)
+    response_status = db.Column(db.Integer, nullable=True)
+    response_body = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class InterestRuns(db.Model):
+    # one row per accrual date: how far `flask interest accrue` got (it commits this with each chunk
+    # of accounts it credits, so a rerun carries on from last_account_id instead of paying twice)
+    __tablename__ = "interest_runs"
+    accrual_date = db.Column(db.Date, primary_key=True)
+    last_account_id = db.Column(UUID(as_uuid=True), nullable=True)
+    accounts_credited = db.Column(db.Integer, nullable=False, default=0)
+    total_interest = db.Column(db.Numeric, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def serialize(self):
+        return {
+            'accrual_date': self.accrual_date.isoformat(),
+            'last_account_id': str(self.last_account_id) if self.last_account_id else None,
+            'accounts_credited': self.accounts_credited,
+            'total_interest': float(self.total_interest),
+            'started_at': self.started_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+class AccountsCustomers(db.Model):
+    __tablename__ = "accounts_customers"
+    account_id = db.Column(UUID(as_uuid=True), db.ForeignKey('accounts.id'), nullable=False)
+    customer_id = db.Column(UUID(as_uuid=True), db.ForeignKey('customers.id'), nullable=False)
+    __table_args__ = (
+        db.PrimaryKeyConstraint('account_id', 'customer_id'),
+        {})
+
+    def serialize(self):
+        return {
+            'account_id': str(self.account_id),
+            'customer_id': str(self.customer_id)
+        }
+
+
+# Customers.accounts = db.relationship('Accounts', secondary='accounts_customers', back_populates='customers')
+# Accounts.account_types = db.relationship('AccountTypes', back_populates='accounts')
@@ -0,0 +1,164 @@
+"""Queued buy orders.
+
+POST /portfolios/<id>/positions/buy used to hold a worker thread for a Polygon round trip and a
+handful of statements before it could answer, so a burst of buys at market open tied up every
+thread and the plain banking endpoints queued behind them. Now the request only checks what it can
+and inserts a pending Orders row (202 Accepted, and the client polls GET /orders/<id>), and
+`flask orders work` fills the queue, batch by batch, on a pool of threads:
+
+- a thread claims up to ORDERS_BATCH_SIZE pending orders, oldest first, with FOR UPDATE SKIP
+  LOCKED, so threads and worker processes never pick up the same order;
+- every distinct ticker in the batch is priced once, however many orders want it, through the
+  PriceService (concurrent fetches, its cache and in-flight coalescing);
+- each order is filled in a savepoint: the debit, the position, the tax lot and the ledger row, as
+  the endpoint used to. An order that can't be filled (not enough money, account on hold) is
+  rejected with the reason without undoing the rest, and the batch commits once;
+- an order whose ticker couldn't be priced (or that failed for any reason other than a rejection)
+  stays pending and is tried again ORDERS_RETRY_DELAY seconds later, then twice that, and so on;
+  it's rejected after ORDERS_MAX_ATTEMPTS tries.
+
+A worker that dies mid-batch rolls back, which leaves its orders pending for the others.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from werkzeug.exceptions import HTTPException
+
+from models import db, Orders
+from valuation import store_closes, valuation_day
+
+log = logging.getLogger('bank.orders')
+
+
+def reject(order: Orders, reason: str):
+    order.status = 'rejected'
+    order.error = reason[:256]
+    order.completed_at = datetime.utcnow()
+
+
+def retry_later(order: Orders, reason: str, config):
+    """ leave an order pending for a later round, backing off, or reject it once it has had its tries"""
+    order.attempts += 1
+    if order.attempts >= config['ORDERS_MAX_ATTEMPTS']:
+        reject(order, reason)
+    else:
+        order.retry_at = datetime.utcnow() + timedelta(seconds=config['ORDERS_RETRY_DELAY'] * 2 ** (order.attempts - 1))
+
+
+def fill_batch(batch_size: int, fill, invalidate=None) -> int:
+    """ claim, price and fill up to `batch_size` pending orders in one transaction; returns how many
+    were claimed. `fill(order, price)` does the buy in the current transaction and returns the
+    account it debited; `invalidate` gets the (account_id, customer_id) pairs once they're committed"""
+    config = current_app.config
+    try:
+        now = datetime.utcnow()
+        orders = (Orders.query
+                  .filter(Orders.status == 'pending', db.or_(Orders.retry_at.is_(None), Orders.retry_at <= now))
+                  .order_by(Orders.created_at)
+                  .limit(batch_size)
+                  .with_for_update(skip_locked=True)
+                  .all())
+        if not orders:
+            db.session.rollback()
+            return 0
+        day = valuation_day()
+        closes = current_app.extensions['prices'].close_prices([order.ticker for order in orders], day, return_exceptions=True)
+        priced = {ticker: close for ticker, close in closes.items() if not isinstance(close, Exception)}
+        # keep the prices paid, so the positions can be valued before the next revaluation
+        store_closes(priced, day, overwrite=False)
+
+        debited = []
+        # accounts in id order, so two batches paying from the same accounts lock them in the same order
+        for order in sorted(orders, key=lambda order: (order.account_id, order.created_at)):
+            if order.ticker not in priced:
+                error = closes[order.ticker]
+                retry_later(order, getattr(error, 'description', None) or str(error), config)
+                continue
+            try:
+                with db.session.begin_nested():
+                    account = fill(order, priced[order.ticker])
+                debited.append((account.id, account.customer_id))
+            except HTTPException as e:
+                reject(order, e.description)
+            except Exception as e:
+                # not the order's fault (a lock timeout, a bug): don't let it hold up the rest of the batch
+                log.exception("couldn't fill order %s", order.id)
+                retry_later(order, f"couldn't be filled: {e}", config)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if debited and invalidate is not None:
+        invalidate(debited)
+    return len(orders)
+
+
+def work(app, stop: threading.Event, fill, batch_size: int, invalidate=None):
+    """ one worker thread: fill batches until `stop` is set, resting ORDERS_POLL_INTERVAL when the queue is empty"""
+    interval = app.config['ORDERS_POLL_INTERVAL']
+    delay = interval
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                claimed = fill_batch(batch_size, fill, invalidate)
+            except Exception:
+                log.exception("filling orders failed, retrying in %ss", delay)
+                stop.wait(delay)
+                delay = min(delay * 2, 30)
+                continue
+            delay = interval
+            if claimed:
+                log.info("filled a batch of %d orders", claimed)
+            if claimed < batch_size:
+                # an idle worker checks the (tiny) pending index every ORDERS_POLL_INTERVAL seconds
+                stop.wait(interval)
+            db.session.remove()
+
+
+##### CLI: flask orders work #####
+
+cli = AppGroup('orders', help="Queued buy orders.")
+
+
+@cli.command('work')
+@click.option('--workers', type=int, default=None, help="Threads filling orders (default ORDERS_WORKERS).")
+@click.option('--batch-size', type=int, default=None, help="Orders per batch (default ORDERS_BATCH_SIZE).")
+@click.option('--once', is_flag=True, help="Fill what is pending and exit instead of running forever.")
+def work_command(workers, batch_size, once):
+    """Price and fill queued buy orders."""
+    # the ledger helpers and the balance cache live in the app module; imported here since app imports this one
+    from app import fill_buy, invalidate_accounts
+    config = current_app.config
+    batch_size = batch_size or config['ORDERS_BATCH_SIZE']
+    if once:
+        total = 0
+        while True:
+            claimed = fill_batch(batch_size, fill_buy, invalidate_accounts)
+            total += claimed
+            # orders put off for a retry aren't claimed again, so this ends
+            if claimed < batch_size:
+                break
+        click.echo(f"processed {total} orders")
+        return
+
+    app = current_app._get_current_object()
+    stop = threading.Event()
+    threads = [threading.Thread(target=work, args=(app, stop, fill_buy, batch_size, invalidate_accounts),
+                                name=f'orders-{n}', daemon=True)
+               for n in range(workers or config['ORDERS_WORKERS'])]
+    for thread in threads:
+        thread.start()
+    log.info("%d order workers started", len(threads))
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        # let each thread finish the batch it's on
+        stop.set()
+        for thread in threads:
+            thread.join()
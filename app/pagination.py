@@ -0,0 +1,105 @@
+"""Keyset (cursor) pagination and streamed JSON listings for the index endpoints.
+
+Offset pagination gets slower the deeper you page because Postgres still has to
+walk every skipped row, so the index endpoints page on the primary key instead:
+the client passes back the last id it saw as ``after`` and we ask for
+``WHERE id > :after ORDER BY id LIMIT :limit``, which is a single index range scan
+no matter how far in we are.
+"""
+import uuid
+from itertools import islice
+from urllib.parse import urlencode
+
+from flask import Response, abort, request, stream_with_context
+
+from serializers import dumps
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_CHUNK_SIZE = 1000
+
+
+def wants_page():
+    """True when the client asked for a page (limit/after) instead of the full listing"""
+    return 'limit' in request.args or 'after' in request.args
+
+
+def page_args():
+    """Read and validate the ?limit= and ?after= query parameters"""
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        abort(400, description="limit must be an integer")
+    if limit < 1 or limit > MAX_LIMIT:
+        abort(400, description=f"limit must be between 1 and {MAX_LIMIT}")
+
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            after = uuid.UUID(after)
+        except ValueError:
+            abort(400, description="after must be an id returned by a previous page")
+    return limit, after
+
+
+def schema_page(query, key_column, schema, fields, limit, after=None):
+    """Fetch one page of `query` ordered by `key_column`, starting after the cursor.
+
+    The rows come back as tuples of just the fields' columns, with the key column added at the end
+    for the cursor. We ask for one extra row so we know whether there is another page without
+    running a COUNT(*). Returns (items, next_cursor).
+    """
+    if after is not None:
+        query = query.filter(key_column > after)
+    rows = query.with_entities(*schema.columns(fields), key_column).order_by(key_column).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = str(rows[-1][-1]) if has_more else None
+    return schema.convert(rows, fields), next_cursor
+
+
+def page_response(body: bytes, next_cursor, limit):
+    """Return the already encoded page and point at the next page with a Link header"""
+    response = Response(body, mimetype='application/json')
+    if next_cursor is not None:
+        params = {'limit': limit, 'after': next_cursor}
+        if 'fields' in request.args:
+            params['fields'] = request.args['fields']
+        response.headers['Link'] = f'<{request.base_url}?{urlencode(params)}>; rel="next"'
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+
+def stream_schema_array(query, key_column, schema, fields, chunk_size=STREAM_CHUNK_SIZE):
+    """Stream every row of `query` as one JSON array without holding the result set.
+
+    yield_per with stream_results makes psycopg2 use a server side cursor, so we only ever hold
+    `chunk_size` rows in memory and the first bytes go out as soon as the first chunk arrives. Each
+    chunk of row tuples is converted and encoded in one go.
+    """
+    rows = iter(query.with_entities(*schema.columns(fields)).order_by(key_column)
+                .execution_options(stream_results=True).yield_per(chunk_size))
+
+    def generate():
+        yield b'['
+        separator = b''
+        for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+            # the chunk encoded as an array, minus its brackets
+            yield separator + dumps(schema.convert(chunk, fields))[1:-1]
+            separator = b','
+        yield b']'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def list_response(query, key_column, schema):
+    """Keyset page when the client asks for one, otherwise stream the whole listing.
+
+    Rows are read as tuples and encoded in bulk (see serializers.py), and ?fields= picks the fields.
+    """
+    fields = schema.requested()
+    if wants_page():
+        limit, after = page_args()
+        items, next_cursor = schema_page(query, key_column, schema, fields, limit, after)
+        return page_response(dumps(items), next_cursor, limit)
+    return stream_schema_array(query, key_column, schema, fields)
@@ -0,0 +1,241 @@
+"""Monthly partitions of the transactions table.
+
+transactions is range partitioned on created_at, one partition per calendar month, named
+transactions_pYYYYMM. Queries that bound created_at (the history filters, statements, exports with
+?from=) only read the partitions in range, each partition is vacuumed and indexed on its own, and
+a month that is no longer needed online goes as a whole instead of through a huge DELETE.
+
+A row can only be inserted once its month's partition exists, so partitions are created ahead of
+time: every worker process makes sure the next PARTITION_MONTHS_AHEAD months exist at most once an
+hour (PARTITION_CHECK_INTERVAL, usually a single catalog query), `flask partitions create` does the
+same from cron or a deploy, and bulk loads create the months of history they bring in.
+
+`flask partitions archive --before YYYY-MM --to DIR` takes every month before the given one out of
+the table: it detaches the partition (CONCURRENTLY, so writers aren't blocked; Postgres 14+),
+writes its rows to DIR/transactions_pYYYYMM.csv.gz and, once the file holds every row, drops it.
+A run that is interrupted picks up the detached partitions it left behind. Archived rows are gone
+from every endpoint, so only archive months that balance snapshots (see snapshots.py) already
+cover, as statements replay the ledger from the latest snapshot.
+"""
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+from datetime import date, datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event
+
+from models import db, Transactions
+
+log = logging.getLogger('bank.partitions')
+
+PARENT = 'transactions'
+NAME = re.compile(r'^transactions_p(\d{4})(\d{2})$')
+# pg_advisory_xact_lock key held while creating partitions, so workers don't race each other
+CREATE_LOCK = 7311804126
+
+
+def month_start(day) -> date:
+    return date(day.year, day.month, 1)
+
+
+def add_months(month: date, n: int) -> date:
+    years, index = divmod(month.month - 1 + n, 12)
+    return date(month.year + years, index + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT}_p{month:%Y%m}"
+
+
+def months(first: date, last: date) -> list:
+    """ the first day of every month from first's to last's, inclusive"""
+    result, month = [], month_start(first)
+    while month <= month_start(last):
+        result.append(month)
+        month = add_months(month, 1)
+    return result
+
+
+def ensure_partitions(connection, first: date, last: date) -> list:
+    """ create whichever monthly partitions from first's month to last's are missing; returns their names"""
+    wanted = {partition_name(month): month for month in months(first, last)}
+    missing = connection.execute(db.text("SELECT name FROM unnest(:names) AS name WHERE to_regclass(name) IS NULL"),
+                                 {'names': list(wanted)}).scalars().all()
+    if not missing:
+        return []
+    connection.execute(db.select(db.func.pg_advisory_xact_lock(CREATE_LOCK)))
+    for name in sorted(missing):
+        month = wanted[name]
+        # bounds are dates we formatted ourselves; DDL doesn't take bind parameters
+        connection.execute(db.text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {PARENT} "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"))
+        log.info("created partition %s", name)
+    return sorted(missing)
+
+
+def ensure_ahead(connection, months_ahead: int) -> list:
+    """ make sure this month and the next `months_ahead` have partitions"""
+    this_month = month_start(datetime.utcnow())
+    return ensure_partitions(connection, this_month, add_months(this_month, months_ahead))
+
+
+@event.listens_for(Transactions.__table__, 'after_create')
+def _create_first_partitions(target, connection, **kw):
+    # db.create_all() (development, tests): last month through a few months ahead
+    this_month = month_start(datetime.utcnow())
+    ensure_partitions(connection, add_months(this_month, -1), add_months(this_month, 3))
+
+
+_checked = {}
+_checked_lock = threading.Lock()
+
+
+def _check_partitions():
+    """ before_request: create upcoming partitions, at most once per PARTITION_CHECK_INTERVAL per process"""
+    app = current_app._get_current_object()
+    now = time.monotonic()
+    with _checked_lock:
+        if app in _checked and now - _checked[app] < app.config['PARTITION_CHECK_INTERVAL']:
+            return
+        _checked[app] = now
+    try:
+        # a connection of its own: DDL has no business in the request's transaction
+        with db.engine.begin() as connection:
+            ensure_ahead(connection, app.config['PARTITION_MONTHS_AHEAD'])
+    except Exception:
+        log.exception("couldn't create upcoming partitions, will try again in %ss", app.config['PARTITION_CHECK_INTERVAL'])
+
+
+def init_app(app):
+    app.before_request(_check_partitions)
+
+
+##### archiving #####
+
+def monthly_partitions(connection, attached: bool) -> list:
+    """ (name, month) of the monthly partitions still attached to transactions, or of the ones that
+    have been detached (or are being detached) but not dropped yet, oldest first"""
+    if attached:
+        rows = connection.execute(db.text(
+            "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:parent AS regclass) AND NOT i.inhdetachpending"), {'parent': PARENT})
+    else:
+        rows = connection.execute(db.text(
+            "SELECT c.relname FROM pg_class c LEFT JOIN pg_inherits i ON i.inhrelid = c.oid "
+            "WHERE c.relkind = 'r' AND c.relname LIKE :pattern "
+            "AND c.relnamespace = 'public'::regnamespace AND (i.inhrelid IS NULL OR i.inhdetachpending)"),
+            {'pattern': f"{PARENT}\\_p%"})
+    found = []
+    for name in rows.scalars():
+        match = NAME.match(name)
+        if match:
+            found.append((name, date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(found, key=lambda p: p[1])
+
+
+def detach(engine, name: str):
+    """ take a partition out of transactions without blocking writers (finishing an interrupted detach)"""
+    # DETACH ... CONCURRENTLY can't run inside a transaction block
+    with engine.execution_options(isolation_level='AUTOCOMMIT').connect() as connection:
+        pending = connection.execute(db.text(
+            "SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(:name)"), {'name': name}).scalar()
+        if pending is None:
+            return
+        mode = 'FINALIZE' if pending else 'CONCURRENTLY'
+        connection.execute(db.text(f"ALTER TABLE {PARENT} DETACH PARTITION {name} {mode}"))
+
+
+def export_partition(engine, name: str, path: str) -> int:
+    """ COPY a detached partition out to a gzipped CSV; returns the row count after checking the file has them all"""
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        partial = path + '.partial'
+        with gzip.open(partial, 'wt', encoding='utf-8', newline='') as stream:
+            cursor.copy_expert(f"COPY (SELECT * FROM {name} ORDER BY created_at, id) TO STDOUT WITH (FORMAT csv, HEADER)", stream)
+        written = cursor.rowcount
+        cursor.execute(f"SELECT count(*) FROM {name}")
+        expected = cursor.fetchone()[0]
+        raw.rollback()
+    finally:
+        raw.close()
+    if written != expected:
+        raise RuntimeError(f"{name}: wrote {written} rows of {expected}")
+    os.replace(partial, path)
+    return written
+
+
+def archive(before: date, directory: str, keep: bool = False, progress=None) -> list:
+    """ detach, export and (unless keep) drop every monthly partition before `before`; returns
+    (name, rows) for each one archived"""
+    engine = db.engine
+    with engine.connect() as connection:
+        old = [name for name, month in monthly_partitions(connection, attached=True) if month < before]
+    for name in old:
+        detach(engine, name)
+        log.info("detached %s", name)
+    with engine.connect() as connection:
+        # includes anything detached by an earlier run that stopped before dropping it
+        detached = [(name, month) for name, month in monthly_partitions(connection, attached=False) if month < before]
+    archived = []
+    for name, month in detached:
+        # a detach that was interrupted is still pending: finish it first
+        detach(engine, name)
+        rows = export_partition(engine, name, os.path.join(directory, f"{name}.csv.gz"))
+        if not keep:
+            with engine.begin() as connection:
+                connection.execute(db.text(f"DROP TABLE {name}"))
+        archived.append((name, rows))
+        if progress is not None:
+            progress(name, rows)
+    return archived
+
+
+##### CLI: flask partitions create|list|archive #####
+
+cli = AppGroup('partitions', help="Monthly partitions of the transactions table.")
+
+
+@cli.command('create')
+@click.option('--months-ahead', type=int, default=None, help="Months after this one to create (default PARTITION_MONTHS_AHEAD).")
+def create_command(months_ahead):
+    """Create the partitions for this month and the coming ones."""
+    months_ahead = current_app.config['PARTITION_MONTHS_AHEAD'] if months_ahead is None else months_ahead
+    with db.engine.begin() as connection:
+        created = ensure_ahead(connection, months_ahead)
+    click.echo(f"created {', '.join(created)}" if created else "nothing to create")
+
+
+@cli.command('list')
+def list_command():
+    """Show the attached partitions and their estimated row counts."""
+    with db.engine.connect() as connection:
+        for name, month in monthly_partitions(connection, attached=True):
+            rows = connection.execute(db.text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:name)"),
+                                      {'name': name}).scalar()
+            click.echo(f"{name}  {month:%Y-%m}  ~{max(rows, 0)} rows")
+
+
+@cli.command('archive')
+@click.option('--before', 'before', required=True, help="Archive every month before this one (YYYY-MM).")
+@click.option('--to', 'directory', required=True, type=click.Path(file_okay=False, writable=True),
+              help="Directory for the transactions_pYYYYMM.csv.gz files.")
+@click.option('--keep', is_flag=True, help="Leave the detached tables in place instead of dropping them.")
+def archive_command(before, directory, keep):
+    """Detach, export and drop the partitions of old months."""
+    try:
+        before = month_start(datetime.strptime(before, '%Y-%m'))
+    except ValueError:
+        raise click.BadParameter("must be YYYY-MM", param_hint='--before')
+    if before > month_start(datetime.utcnow()):
+        raise click.BadParameter("can't archive the current month or later ones", param_hint='--before')
+    os.makedirs(directory, exist_ok=True)
+    archived = archive(before, directory, keep, progress=lambda name, rows: click.echo(f"{name}: {rows} rows archived"))
+    click.echo(f"archived {len(archived)} partitions, {sum(rows for _, rows in archived)} rows")
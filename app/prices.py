@@ -0,0 +1,154 @@
+"""Market data: close prices for tickers.
+
+The endpoints never call Polygon directly any more, they ask the PriceService, which
+
+* keeps close prices in an LRU/TTL cache keyed by (ticker, date),
+* coalesces concurrent requests for the same ticker into one outbound call,
+* fetches several tickers at once on a small thread pool, and
+* talks to a pluggable provider: Polygon over a pooled requests.Session in production,
+  or StubPriceProvider for tests and offline benchmarks.
+"""
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+from werkzeug.exceptions import BadGateway
+
+from cache import TTLCache
+from metrics import OUTBOUND_LATENCY
+
+
+class PriceUnavailable(BadGateway):
+    description = "Could not get a price for this ticker"
+
+
+class PolygonPriceProvider:
+    """Daily close prices from Polygon's open-close endpoint"""
+
+    base_url = "https://api.polygon.io/v1/open-close"
+
+    def __init__(self, api_key: str, timeout: float = 5.0, pool_size: int = 10):
+        self.api_key = api_key
+        self.timeout = timeout
+        # one keep-alive connection pool shared by every request instead of a new TLS handshake per call
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+
+    def close_price(self, ticker: str, day: date):
+        """Return the close for `day`, or None when there was no trading that day"""
+        url = f"{self.base_url}/{ticker}/{day.strftime('%Y-%m-%d')}"
+        start = time.perf_counter()
+        try:
+            response = self.session.get(url, params={'adjusted': 'true', 'apiKey': self.api_key}, timeout=self.timeout)
+        except requests.RequestException as e:
+            OUTBOUND_LATENCY.observe(time.perf_counter() - start, service='polygon', outcome='error')
+            raise PriceUnavailable(f"Error getting price of ticker {ticker}: {e}")
+        OUTBOUND_LATENCY.observe(time.perf_counter() - start, service='polygon', outcome=response.status_code)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise PriceUnavailable(f"Error getting price of ticker {ticker}: HTTP {response.status_code}")
+        return Decimal(str(response.json()['close']))
+
+
+class StubPriceProvider:
+    """Offline provider for tests and benchmarks.
+
+    Prices come from `prices` when given, otherwise a stable made-up price is derived from the
+    ticker symbol. `latency` seconds are slept per call to stand in for the network.
+    """
+
+    def __init__(self, prices: dict = None, latency: float = 0.0):
+        self.prices = prices or {}
+        self.latency = latency
+        self.calls = 0
+
+    def close_price(self, ticker: str, day: date):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if ticker in self.prices:
+            return Decimal(str(self.prices[ticker]))
+        return Decimal(10 + zlib.crc32(ticker.encode()) % 49000) / 100
+
+
+class PriceService:
+    """Cached, coalesced, concurrent access to a price provider"""
+
+    # the close for "yesterday" doesn't exist on weekends/holidays, so walk back this many days
+    LOOKBACK_DAYS = 5
+
+    def __init__(self, provider, cache_ttl: float = 3600, cache_size: int = 10000, workers: int = 8):
+        self.provider = provider
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prices')
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def close_price(self, ticker: str, day: date = None) -> Decimal:
+        """The most recent close on or before `day` (default: yesterday)"""
+        day = day or date.today() - timedelta(days=1)
+        key = (ticker, day)
+        price = self.cache.get(key)
+        if price is not None:
+            return price
+
+        # if someone is already fetching this key, wait for their answer instead of calling out again
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            price = self._fetch(ticker, day)
+            self.cache.set(key, price)
+            future.set_result(price)
+            return price
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def close_prices(self, tickers, day: date = None, return_exceptions: bool = False) -> dict:
+        """Close prices for several tickers, fetched concurrently; returns {ticker: price}.
+
+        With return_exceptions a ticker that can't be priced maps to its exception instead of the
+        first failure being raised.
+        """
+        tickers = list(dict.fromkeys(tickers))
+        if len(tickers) == 1 and not return_exceptions:
+            return {tickers[0]: self.close_price(tickers[0], day)}
+        futures = {t: self._pool.submit(self.close_price, t, day) for t in tickers}
+        if not return_exceptions:
+            return {t: f.result() for t, f in futures.items()}
+        return {t: f.exception() or f.result() for t, f in futures.items()}
+
+    def _fetch(self, ticker: str, day: date) -> Decimal:
+        for back in range(self.LOOKBACK_DAYS):
+            price = self.provider.close_price(ticker, day - timedelta(days=back))
+            if price is not None:
+                return price
+        raise PriceUnavailable(f"No close price for {ticker} in the {self.LOOKBACK_DAYS} days up to {day}")
+
+
+def make_price_service(config) -> PriceService:
+    """Build the price service described by the app config"""
+    if config['PRICE_PROVIDER'] == 'stub':
+        provider = StubPriceProvider(latency=config['PRICE_STUB_LATENCY'])
+    elif config['PRICE_PROVIDER'] == 'polygon':
+        provider = PolygonPriceProvider(config['POLYGON_API_KEY'], timeout=config['PRICE_HTTP_TIMEOUT'],
+                                        pool_size=config['PRICE_FETCH_WORKERS'])
+    else:
+        raise ValueError(f"unknown PRICE_PROVIDER {config['PRICE_PROVIDER']!r}")
+    return PriceService(provider, cache_ttl=config['PRICE_CACHE_TTL'], workers=config['PRICE_FETCH_WORKERS'])
@@ -0,0 +1,231 @@
+"""Token-bucket rate limiting and PIN lockout for the money-moving endpoints.
+
+Every limited request takes a token from up to three buckets: one for the client IP, one for the
+customer and one for the account it names. A bucket holds BURST tokens and refills at RATE tokens a
+second, so a client can burst briefly but not sustain more than RATE requests a second; an empty
+bucket means a 429 with Retry-After. The check runs before the view (and before @idempotent), so a
+flood is turned away without a single query reaching Postgres.
+
+Wrong PINs are counted per account. PIN_MAX_FAILURES of them within PIN_FAILURE_WINDOW seconds put
+the account on hold (Accounts.hold, until someone clears it with `flask ratelimit release`). The
+hold in the database is the lock: every worker refuses PIN attempts on a held account with a 423
+and the ledger refuses to debit it, so releasing it in one place releases it everywhere. The count
+starts over when it trips, and whenever a correct PIN is given.
+
+State lives in an in-process store by default. It is per gunicorn worker, so the effective limits
+and PIN counts are per worker. RATE_LIMIT_BACKEND=redis keeps the buckets and counters in Redis
+instead, shared by every worker and host, at the cost of a round trip per check.
+"""
+import functools
+import logging
+import threading
+import time
+import uuid
+
+import click
+from flask import current_app, request
+from flask.cli import AppGroup
+from werkzeug.exceptions import Locked, TooManyRequests
+
+from cache import TTLCache
+from metrics import PIN_LOCKOUTS, RATE_LIMITED
+from models import db, Accounts
+
+log = logging.getLogger('bank.ratelimit')
+
+
+class RateLimited(TooManyRequests):
+    description = "Too many requests, slow down"
+
+
+class AccountLocked(Locked):
+    description = "Account is on hold after too many incorrect PINs"
+
+
+##### stores #####
+
+class LocalLimiterStore:
+    """Buckets and counters in this process, in a bounded LRU (an evicted bucket was idle long
+    enough to have refilled, an evicted counter just starts over)"""
+
+    def __init__(self, maxsize: int = 100000, clock=time.monotonic):
+        self._clock = clock
+        self._data = TTLCache(maxsize=maxsize, clock=clock)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """ take a token; 0 if there was one, else the seconds until there will be"""
+        with self._lock:
+            now = self._clock()
+            tokens, stamp = self._data.get(key) or (burst, now)
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            if tokens >= 1:
+                self._data.set(key, (tokens - 1, now), ttl=burst / rate)
+                return 0.0
+            self._data.set(key, (tokens, now), ttl=burst / rate)
+            return (1 - tokens) / rate
+
+    def incr(self, key: str, window: float) -> int:
+        """ add one to a counter that starts over `window` seconds after its first increment"""
+        with self._lock:
+            now = self._clock()
+            count, expires = self._data.get(key) or (0, now + window)
+            self._data.set(key, (count + 1, expires), ttl=expires - now)
+            return count + 1
+
+    def delete(self, *keys):
+        for key in keys:
+            self._data.delete(key)
+
+
+class RedisLimiterStore:
+    """The same in Redis, shared by every worker; needs the optional `redis` package"""
+
+    # refill and take in one atomic step; time comes from the Redis server so hosts needn't agree
+    TAKE = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1e6
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+    local tokens = tonumber(state[1]) or burst
+    local stamp = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + (now - stamp) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate))
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the redis package: pip install redis")
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(self.TAKE)
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        return float(self._take(keys=[key], args=[rate, burst]))
+
+    def incr(self, key: str, window: float) -> int:
+        pipe = self._client.pipeline()
+        # the window starts with the first increment: only a missing key gets the expiry
+        pipe.set(key, 0, ex=max(1, int(window)), nx=True)
+        pipe.incr(key)
+        return pipe.execute()[1]
+
+    def delete(self, *keys):
+        if keys:
+            self._client.delete(*keys)
+
+
+##### limiter #####
+
+def scope_key(value):
+    """ ids as one canonical string, so /accounts/<ID> and a body's account_id share a bucket"""
+    if value is None:
+        return None
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return str(value)
+
+
+class RateLimiter:
+
+    def __init__(self, store, limits: dict, pin_max_failures: int, pin_failure_window: float):
+        self.store = store
+        # scope -> (rate per second, burst); a scope with rate 0 isn't limited
+        self.limits = limits
+        self.pin_max_failures = pin_max_failures
+        self.pin_failure_window = pin_failure_window
+
+    def check(self, scopes: dict):
+        """ take a token per scope ({scope: key}, None keys skipped); raise RateLimited"""
+        for scope, key in scopes.items():
+            rate, burst = self.limits.get(scope, (0, 0))
+            if key is None or rate <= 0:
+                continue
+            wait = self.store.take(f"rl:{scope}:{key}", rate, burst)
+            if wait > 0:
+                RATE_LIMITED.inc(scope=scope)
+                raise RateLimited(retry_after=max(1, int(wait + 0.999)))
+
+    def pin_failed(self, account) -> bool:
+        """ count a wrong PIN against an account; True when that was one too many and it should be held"""
+        account = scope_key(account)
+        failures = self.store.incr(f"pin:{account}", self.pin_failure_window)
+        if failures < self.pin_max_failures:
+            return False
+        # the hold takes over from here; once it's released the account starts with a clean count
+        self.store.delete(f"pin:{account}")
+        PIN_LOCKOUTS.inc()
+        log.warning("account %s held after %d incorrect PINs", account, failures)
+        return True
+
+    def pin_succeeded(self, account):
+        self.store.delete(f"pin:{scope_key(account)}")
+
+
+def make_rate_limiter(config) -> RateLimiter:
+    """Build the limiter described by the app config"""
+    backend = config['RATE_LIMIT_BACKEND']
+    if backend == 'local':
+        store = LocalLimiterStore()
+    elif backend == 'redis':
+        store = RedisLimiterStore(config['RATE_LIMIT_REDIS_URL'])
+    else:
+        raise ValueError(f"unknown RATE_LIMIT_BACKEND {backend!r}")
+    return RateLimiter(store, {
+        'ip': (config['RATE_LIMIT_IP_RATE'], config['RATE_LIMIT_IP_BURST']),
+        'customer': (config['RATE_LIMIT_CUSTOMER_RATE'], config['RATE_LIMIT_CUSTOMER_BURST']),
+        'account': (config['RATE_LIMIT_ACCOUNT_RATE'], config['RATE_LIMIT_ACCOUNT_BURST']),
+    }, config['PIN_MAX_FAILURES'], config['PIN_FAILURE_WINDOW'])
+
+
+def rate_limited(account_arg: str = None, customer_arg: str = None, account_field: str = 'account_id'):
+    """ decorator: rate limit a view by client IP, customer and account before it runs.
+
+    The customer and account come from the named URL arguments, or else from `customer_id` and
+    `account_field` (the account money comes out of) in the JSON body. A body that isn't an object
+    (a batch file) is limited by IP alone.
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            body = request.get_json(silent=True)
+            body = body if isinstance(body, dict) else {}
+            customer = kwargs.get(customer_arg) if customer_arg else body.get('customer_id')
+            account = kwargs.get(account_arg) if account_arg else body.get(account_field)
+            current_app.extensions['ratelimit'].check({
+                'ip': request.remote_addr,
+                'customer': scope_key(customer),
+                'account': scope_key(account),
+            })
+            return view(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+##### CLI: flask ratelimit release #####
+
+cli = AppGroup('ratelimit', help="Rate limits and PIN lockouts.")
+
+
+@cli.command('release')
+@click.argument('account_id')
+def release_command(account_id):
+    """Take an account off hold."""
+    # the lookup cache lives in the app module; imported here since app imports this one
+    from app import invalidate_accounts
+    try:
+        account = db.session.get(Accounts, uuid.UUID(account_id))
+    except ValueError:
+        account = None
+    if account is None:
+        raise click.ClickException(f"no account {account_id}")
+    account.hold = False
+    db.session.commit()
+    invalidate_accounts([(account.id, account.customer_id)])
+    click.echo(f"account {account.id} released")
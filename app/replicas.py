@@ -0,0 +1,182 @@
+"""Read replicas for the read-only GET endpoints.
+
+Each URL in DATABASE_REPLICA_URLS becomes a SQLAlchemy bind (replica_0, replica_1, ...) with the
+same pool settings as the primary. Views decorated with @replica_reads run their queries on a
+replica; everything else, and any write or SELECT ... FOR UPDATE a decorated view happens to issue,
+stays on the primary. The routing is done by the session's get_bind (RoutingSession below), so the
+views and queries themselves don't change.
+
+Which replica: the one this process has the fewest connections checked out from (least
+connections), rotating between replicas that tie. A replica is only used while it is at most
+REPLICA_MAX_LAG seconds behind the primary; each one's lag is measured at most every
+REPLICA_CHECK_INTERVAL seconds, by whichever request needs it next. A replica that lags too far or
+can't be reached is skipped until a later check finds it healthy, and with none usable the read
+goes to the primary.
+
+Read-your-writes: a successful POST/PUT/PATCH/DELETE sets a short-lived cookie, and a client that
+sends it back is kept on the primary for REPLICA_MAX_LAG + REPLICA_CHECK_INTERVAL seconds, long
+enough for any replica still in use to have its write.
+
+The cached lookups (customer_show, account_show, ...) are deliberately not routed: filling the
+cache from a replica could put back the very row an invalidation just removed.
+"""
+import functools
+import logging
+import threading
+import time
+
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+from metrics import REPLICA_READS
+
+log = logging.getLogger('bank.replicas')
+
+PIN_COOKIE = 'bank_read_primary_until'
+
+# seconds behind the primary; a server that isn't a standby (e.g. a second local instance in
+# development) reports 0. Caught up with everything it has received counts as 0 too, since
+# pg_last_xact_replay_timestamp() stays at the last replayed commit when the primary is idle.
+LAG = """
+SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 'Infinity')
+       END
+"""
+
+
+class RoutingSession(SignallingSession):
+    """Sends reads to the replica the current request picked (g.db_replica), writes to the primary"""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('db_replica') if has_app_context() else None
+        if (replica is not None and not self._flushing and not isinstance(clause, UpdateBase)
+                and getattr(clause, '_for_update_arg', None) is None):
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class Replica:
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        # seconds behind the primary at the last check; None until the first one
+        self.lag = None
+        self.checked_at = None
+        self.picks = 0
+        self._checking = threading.Lock()
+
+    def connections(self) -> int:
+        return self.engine.pool.checkedout()
+
+    def measure(self) -> float:
+        with self.engine.connect() as connection:
+            return float(connection.exec_driver_sql(LAG).scalar())
+
+    def refresh(self, now: float):
+        """ re-measure the lag; a check already running in another thread is left to finish"""
+        if not self._checking.acquire(blocking=False):
+            return
+        try:
+            try:
+                self.lag = self.measure()
+            except Exception as e:
+                log.warning("replica %s unavailable: %s", self.name, e)
+                self.lag = float('inf')
+            self.checked_at = now
+        finally:
+            self._checking.release()
+
+
+class ReplicaSet:
+
+    def __init__(self, replicas: list, max_lag: float, check_interval: float, clock=time.monotonic):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def usable(self) -> list:
+        now = self._clock()
+        for replica in self.replicas:
+            if replica.checked_at is None or now - replica.checked_at >= self.check_interval:
+                replica.refresh(now)
+        return [r for r in self.replicas if r.lag is not None and r.lag <= self.max_lag]
+
+    def pick(self):
+        """ the usable replica with the fewest connections in use, or None to read from the primary"""
+        candidates = self.usable()
+        if not candidates:
+            return None
+        with self._lock:
+            replica = min(candidates, key=lambda r: (r.connections(), r.picks))
+            replica.picks += 1
+        return replica
+
+    def status(self) -> list:
+        """ each replica's lag at its last check (None if unknown or unreachable), without checking again"""
+        return [{
+            'name': r.name,
+            'lag': r.lag if r.lag is not None and r.lag != float('inf') else None,
+            'usable': r.lag is not None and r.lag <= self.max_lag,
+            'connections': r.connections(),
+        } for r in self.replicas]
+
+
+def make_replica_set(app, db):
+    """ the ReplicaSet for the replica binds in an app's config, or None when there are none"""
+    names = sorted(name for name in app.config.get('SQLALCHEMY_BINDS') or {} if name.startswith('replica_'))
+    if not names:
+        return None
+    return ReplicaSet([Replica(name, db.get_engine(app, bind=name)) for name in names],
+                      app.config['REPLICA_MAX_LAG'], app.config['REPLICA_CHECK_INTERVAL'])
+
+
+def pinned() -> bool:
+    """ whether this client wrote recently enough that it must read from the primary"""
+    try:
+        return float(request.cookies.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def replica_reads(view):
+    """ decorator: run a read-only view's queries on a replica when one is usable"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get('replicas')
+        if replicas is not None:
+            if pinned():
+                REPLICA_READS.inc(target='primary_pinned')
+            else:
+                replica = replicas.pick()
+                REPLICA_READS.inc(target=replica.name if replica else 'primary_fallback')
+                if replica is not None:
+                    g.db_replica = replica.engine
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _pin_after_write(response):
+    if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+        config = current_app.config
+        seconds = config['REPLICA_MAX_LAG'] + config['REPLICA_CHECK_INTERVAL']
+        response.set_cookie(PIN_COOKIE, f"{time.time() + seconds:.3f}", max_age=int(seconds + 1), httponly=True)
+    return response
+
+
+def init_app(app, db):
+    """Build the app's replica set, if it has replicas, and pin writers to the primary"""
+    app.extensions['replicas'] = make_replica_set(app, db)
+    if app.extensions['replicas'] is not None:
+        app.after_request(_pin_after_write)
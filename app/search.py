@@ -0,0 +1,99 @@
+"""Search over customer names and transaction notes (GET /search).
+
+Both are matched on trigrams (the pg_trgm extension). A GIN index holds the trigrams of every
+customer's full name and of every note, so Postgres finds the rows that contain the query (which
+covers prefixes) or that are close enough to it to be a typo away (`q <% text`: word_similarity at
+or above pg_trgm.word_similarity_threshold, 0.6 unless the database says otherwise) from the index
+alone. Matches are ranked with the ones that start with the query first, then by word_similarity,
+and come back a page at a time with limit/offset: ranking has to score every match anyway, so a
+keyset cursor wouldn't save anything, and paging stops at SEARCH_MAX_RESULTS.
+
+A common note ("Deposit") can match a good part of the ledger, so only the most recent
+SEARCH_MAX_RESULTS matching transactions are ranked. from/to, customer_id and account_id narrow
+that down, and a date range only reads the partitions it covers.
+
+A query needs at least MIN_LENGTH characters, as anything shorter has no trigram of its own to look up.
+"""
+from urllib.parse import urlencode
+
+from flask import Response, request
+
+from models import db, Customers, Transactions
+from serializers import CUSTOMER, TRANSACTION, dumps
+
+KINDS = ('customers', 'transactions')
+MIN_LENGTH = 3
+MAX_LENGTH = 128
+
+# the expression ix_customers_name_trgm indexes, written out the same way
+FULL_NAME = db.literal_column("(customers.first_name || ' ' || customers.last_name)")
+
+
+def escape_like(value: str) -> str:
+    """ value with the LIKE wildcards (and the escape character) escaped"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def matches(text, q: str):
+    """ text contains q, or comes close enough to it with a typo or two"""
+    return db.or_(text.ilike(f"%{escape_like(q)}%"), db.literal(q).op('<%')(text))
+
+
+def ranking(text, q: str) -> list:
+    """ ORDER BY terms: whatever starts with q first, then the closest matches"""
+    return [text.ilike(f"{escape_like(q)}%").desc(), db.desc('score')]
+
+
+def score(text, q: str):
+    return db.func.word_similarity(q, text).label('score')
+
+
+def customers(q: str, fields: list, limit: int, offset: int) -> list:
+    """ a page of the customers whose name matches q, best first"""
+    query = (db.select(*CUSTOMER.columns(fields), score(FULL_NAME, q))
+             .where(matches(FULL_NAME, q))
+             .order_by(*ranking(FULL_NAME, q), Customers.last_name, Customers.first_name, Customers.id)
+             .limit(limit).offset(offset))
+    return results(db.session.execute(query).all(), CUSTOMER, fields)
+
+
+def transactions(q: str, fields: list, limit: int, offset: int, max_results: int,
+                 start=None, end=None, customer_id=None, account_id=None) -> list:
+    """ a page of the transactions whose note matches q, best first, out of the `max_results` most
+    recent matches"""
+    conditions = [matches(Transactions.note, q)]
+    if start is not None:
+        conditions.append(Transactions.created_at >= start)
+    if end is not None:
+        conditions.append(Transactions.created_at < end)
+    if customer_id is not None:
+        conditions.append(Transactions.customer_id == customer_id)
+    if account_id is not None:
+        conditions.append(db.or_(Transactions.debit_id == account_id, Transactions.credit_id == account_id))
+    recent = (db.select(Transactions.id, Transactions.created_at).where(*conditions)
+              .order_by(Transactions.created_at.desc()).limit(max_results).subquery())
+    query = (db.select(*TRANSACTION.columns(fields), score(Transactions.note, q))
+             .join_from(Transactions, recent, db.and_(Transactions.id == recent.c.id,
+                                                      Transactions.created_at == recent.c.created_at))
+             .order_by(*ranking(Transactions.note, q), Transactions.created_at.desc(), Transactions.id.desc())
+             .limit(limit).offset(offset))
+    return results(db.session.execute(query).all(), TRANSACTION, fields)
+
+
+def results(rows, schema, fields) -> list:
+    """ the rows as the schema's dicts, each with its score"""
+    items = schema.convert(rows, fields)
+    for item, row in zip(items, rows):
+        item['score'] = round(row[-1], 3)
+    return items
+
+
+def search_response(items: list, limit: int, offset: int, max_results: int) -> Response:
+    """ the page as a JSON array, with a Link header to the next one while there may be more"""
+    response = Response(dumps(items), mimetype='application/json')
+    next_offset = offset + limit
+    if len(items) == limit and next_offset < max_results:
+        args = request.args.to_dict()
+        args.update(limit=limit, offset=next_offset)
+        response.headers['Link'] = f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+    return response
@@ -0,0 +1,204 @@
+"""Balance snapshots, statements and ledger reconciliation.
+
+Accounts.balance is updated in place, so the only history of a balance is the ledger. Replaying
+the whole ledger for every statement gets slower as it grows, so `flask snapshots take` (run it
+from cron, e.g. nightly) copies every account's balance into balance_snapshots. A statement then
+starts from the nearest snapshot and only scans the ledger between that snapshot and the
+statement's start date.
+
+A ledger row moves `amount` out of its debit_id account and into its credit_id account, so an
+account's balance at time T is the sum of its credits minus the sum of its debits created before T.
+
+Snapshots are taken a chunk of accounts at a time: the chunk is locked FOR SHARE, which waits for
+in-flight movements on those accounts to commit (they stamp created_at while holding the row
+lock), and only then is as_of read. Every ledger row created before as_of is therefore in the
+copied balance and every later one isn't.
+
+`flask snapshots reconcile` checks each new snapshot against the ledger incrementally: a snapshot
+should equal the previous (already reconciled) snapshot plus the ledger movement between the two,
+so each check only scans one snapshot period. The first snapshot of an account is checked against
+its full history once.
+"""
+import logging
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+
+from models import db, Accounts, BalanceSnapshots, Transactions
+
+log = logging.getLogger('bank.snapshots')
+
+
+def ledger_delta(account_id, start, end):
+    """ SQL expression for an account's net ledger movement over [start, end) (credits minus debits).
+
+    Arguments can be values or column expressions; a NULL/None start means from the beginning.
+    """
+    start = db.func.coalesce(start, db.cast('-infinity', db.DateTime))
+
+    def total(side):
+        # one indexed range scan per side: (debit_id, created_at) and (credit_id, created_at)
+        return (db.select(db.func.coalesce(db.func.sum(Transactions.amount), 0))
+                .where(side == account_id, Transactions.created_at >= start, Transactions.created_at < end)
+                .scalar_subquery())
+
+    return total(Transactions.credit_id) - total(Transactions.debit_id)
+
+
+def snapshot_value():
+    """ the balance a snapshot vouches for: the ledger's figure once reconciliation has disagreed"""
+    return db.case((BalanceSnapshots.reconciled.is_(False), BalanceSnapshots.ledger_balance),
+                   else_=BalanceSnapshots.balance)
+
+
+##### statements #####
+
+def balance_at(account_id, at: datetime):
+    """ an account's balance at `at`, from the nearest snapshot plus the ledger movement in between.
+
+    Returns (balance, snapshot as_of or None).
+    """
+    before = db.session.execute(
+        db.select(BalanceSnapshots.as_of, snapshot_value().label('balance'))
+        .where(BalanceSnapshots.account_id == account_id, BalanceSnapshots.as_of <= at)
+        .order_by(BalanceSnapshots.as_of.desc()).limit(1)).first()
+    if before is not None:
+        delta = db.session.execute(db.select(ledger_delta(account_id, before.as_of, at))).scalar()
+        return before.balance + delta, before.as_of
+
+    # no snapshot that early: walk back from the first one taken after `at`, if any
+    after = db.session.execute(
+        db.select(BalanceSnapshots.as_of, snapshot_value().label('balance'))
+        .where(BalanceSnapshots.account_id == account_id, BalanceSnapshots.as_of > at)
+        .order_by(BalanceSnapshots.as_of.asc()).limit(1)).first()
+    if after is not None:
+        delta = db.session.execute(db.select(ledger_delta(account_id, at, after.as_of))).scalar()
+        return after.balance - delta, after.as_of
+
+    return db.session.execute(db.select(ledger_delta(account_id, None, at))).scalar(), None
+
+
+def statement(account_id, start: datetime, end: datetime) -> dict:
+    """ opening balance at `start`, every ledger row in [start, end) with a running balance, closing balance"""
+    opening, snapshot_as_of = balance_at(account_id, start)
+    rows = (Transactions.query
+            .filter(db.or_(Transactions.debit_id == account_id, Transactions.credit_id == account_id),
+                    Transactions.created_at >= start, Transactions.created_at < end)
+            .order_by(Transactions.created_at.asc(), Transactions.id.asc()))
+
+    balance = opening
+    entries = []
+    for t in rows:
+        change = t.amount if t.credit_id == account_id else -t.amount
+        balance += change
+        entry = t.serialize()
+        entry['change'] = float(change)
+        entry['balance'] = float(balance)
+        entries.append(entry)
+
+    return {
+        'account_id': str(account_id),
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'opening_balance': float(opening),
+        'closing_balance': float(balance),
+        'snapshot_as_of': snapshot_as_of.isoformat() if snapshot_as_of else None,
+        'transactions': entries,
+    }
+
+
+##### jobs #####
+
+def take_snapshots(chunk_size: int, after=None) -> int:
+    """ snapshot every account (with id > after), committing a chunk at a time; returns the count.
+
+    Safe to stop and rerun: pass the last account id it reported as `after` to carry on.
+    """
+    taken = 0
+    while True:
+        query = db.select(Accounts.id, Accounts.balance).order_by(Accounts.id).limit(chunk_size)
+        if after is not None:
+            query = query.where(Accounts.id > after)
+        chunk = db.session.execute(query.with_for_update(read=True)).all()
+        if not chunk:
+            db.session.rollback()
+            return taken
+        as_of = datetime.utcnow()
+        db.session.execute(
+            insert(BalanceSnapshots).on_conflict_do_nothing(),
+            [{'account_id': row.id, 'as_of': as_of, 'balance': row.balance} for row in chunk])
+        db.session.commit()
+        taken += len(chunk)
+        after = chunk[-1].id
+        log.info("snapshotted %d accounts, through %s", taken, after)
+
+
+def reconcile_snapshots(chunk_size: int) -> list:
+    """ check unreconciled snapshots against the ledger, oldest first per account; returns the mismatches"""
+    previous = aliased(BalanceSnapshots)
+    prev = (db.select(previous.as_of, previous.reconciled,
+                      db.func.coalesce(previous.ledger_balance, previous.balance).label('balance'))
+            .where(previous.account_id == BalanceSnapshots.account_id, previous.as_of < BalanceSnapshots.as_of)
+            .order_by(previous.as_of.desc()).limit(1)
+            .lateral('prev'))
+    # a snapshot is ready once the one before it (if any) has been reconciled
+    todo = (db.select(BalanceSnapshots.account_id, BalanceSnapshots.as_of,
+                      (db.func.coalesce(prev.c.balance, 0)
+                       + ledger_delta(BalanceSnapshots.account_id, prev.c.as_of, BalanceSnapshots.as_of)).label('expected'))
+            .select_from(BalanceSnapshots).outerjoin(prev, db.true())
+            .where(BalanceSnapshots.reconciled.is_(None),
+                   db.or_(prev.c.as_of.is_(None), prev.c.reconciled.isnot(None)))
+            .order_by(BalanceSnapshots.account_id, BalanceSnapshots.as_of)
+            .limit(chunk_size)
+            .cte('todo'))
+    check = (db.update(BalanceSnapshots)
+             .where(BalanceSnapshots.account_id == todo.c.account_id, BalanceSnapshots.as_of == todo.c.as_of)
+             .values(reconciled=BalanceSnapshots.balance == todo.c.expected, ledger_balance=todo.c.expected)
+             .returning(BalanceSnapshots.account_id, BalanceSnapshots.as_of, BalanceSnapshots.balance,
+                        BalanceSnapshots.ledger_balance, BalanceSnapshots.reconciled)
+             .execution_options(synchronize_session=False))
+
+    mismatches = []
+    checked = 0
+    while True:
+        rows = db.session.execute(check).all()
+        db.session.commit()
+        if not rows:
+            log.info("reconciled %d snapshots, %d mismatches", checked, len(mismatches))
+            return mismatches
+        checked += len(rows)
+        for row in rows:
+            if not row.reconciled:
+                log.warning("snapshot of %s at %s says %s, ledger says %s",
+                            row.account_id, row.as_of.isoformat(), row.balance, row.ledger_balance)
+                mismatches.append(row)
+
+
+##### CLI: flask snapshots take|reconcile #####
+
+cli = AppGroup('snapshots', help="Balance snapshots and ledger reconciliation.")
+
+
+@cli.command('take')
+@click.option('--chunk-size', type=int, default=None, help="accounts per transaction (default SNAPSHOT_CHUNK_SIZE)")
+@click.option('--after', default=None, help="resume after this account id")
+def take_command(chunk_size, after):
+    """Snapshot every account's balance."""
+    taken = take_snapshots(chunk_size or current_app.config['SNAPSHOT_CHUNK_SIZE'], after)
+    click.echo(f"snapshotted {taken} accounts")
+
+
+@cli.command('reconcile')
+@click.option('--chunk-size', type=int, default=None, help="snapshots per transaction (default SNAPSHOT_CHUNK_SIZE)")
+def reconcile_command(chunk_size):
+    """Check new snapshots against the ledger; exits 1 if any disagree."""
+    mismatches = reconcile_snapshots(chunk_size or current_app.config['SNAPSHOT_CHUNK_SIZE'])
+    for row in mismatches:
+        click.echo(f"MISMATCH {row.account_id} at {row.as_of.isoformat()}: snapshot {row.balance}, ledger {row.ledger_balance}")
+    if mismatches:
+        raise SystemExit(1)
+    click.echo("snapshots agree with the ledger")
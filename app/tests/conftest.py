@@ -0,0 +1,71 @@
+"""Fixtures for the API tests.
+
+They need a Postgres database of their own, named by TEST_DATABASE_URL (its tables are dropped and
+created again); without it the tests are skipped:
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost:5432/bank_test python -m pytest app/tests
+"""
+import os
+import sys
+
+import pytest
+
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+if TEST_DATABASE_URL:
+    # read by config.py when it's imported
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+    os.environ.setdefault('SQLALCHEMY_ECHO', '0')
+    os.environ.setdefault('PRICE_PROVIDER', 'stub')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+OPERATOR_TOKEN = 'test-operator'
+
+
+@pytest.fixture(scope='session')
+def app():
+    if not TEST_DATABASE_URL:
+        pytest.skip("set TEST_DATABASE_URL to run the API tests")
+    import app as bank
+    app = bank.create_app()
+    app.config.update(TESTING=True, OPERATOR_TOKENS=[OPERATOR_TOKEN],
+                      RATE_LIMIT_IP_RATE=0, RATE_LIMIT_CUSTOMER_RATE=0, RATE_LIMIT_ACCOUNT_RATE=0)
+    with app.app_context():
+        # customers and portfolios reference each other, which drop_all() can't untangle
+        bank.db.session.execute(bank.db.text("DROP SCHEMA public CASCADE; CREATE SCHEMA public"))
+        bank.db.session.commit()
+        bank.db.create_all()
+    return app
+
+
+@pytest.fixture
+def db(app):
+    from models import db
+    with app.app_context():
+        db.session.execute(db.text("TRUNCATE " + ", ".join(table.name for table in db.metadata.tables.values()) + " CASCADE"))
+        db.session.commit()
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
+
+
+@pytest.fixture
+def make_account(db):
+    """ make_account(balance, pin=1234) -> a checking account of a new customer"""
+    from models import Accounts, AccountTypes, Customers
+    if db.session.get(AccountTypes, 1) is None:
+        db.session.add(AccountTypes(id=1, type='checking', interest_rate=0, min_balance=0))
+
+    def make(balance, pin=1234, hold=False):
+        customer = Customers(first_name='Test', last_name='Customer', pin=pin, password='x')
+        db.session.add(customer)
+        db.session.flush()
+        account = Accounts(balance=balance, acct_type_id=1, customer_id=customer.id, hold=hold)
+        db.session.add(account)
+        db.session.commit()
+        return account
+    return make
+
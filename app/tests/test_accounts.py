@@ -0,0 +1,28 @@
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def opening(make_account):
+    funding = make_account(0)
+    return {'balance': '25.00', 'acct_type_id': 1, 'customer_id': str(funding.customer_id), 'debit_id': str(uuid.uuid4())}
+
+
+def test_account_create(client, opening):
+    response = client.post('/accounts', json=opening)
+    assert response.status_code == 201
+    assert response.get_json()['balance'] == 25
+
+
+@pytest.mark.parametrize('missing', ['balance', 'acct_type_id', 'customer_id', 'debit_id'])
+def test_account_create_needs_every_field(client, opening, missing):
+    del opening[missing]
+    assert client.post('/accounts', json=opening).status_code == 400
+
+
+@pytest.mark.parametrize('balance', ['-1', 'lots', None, 'NaN'])
+def test_account_create_rejects_a_bad_balance(client, opening, balance):
+    response = client.post('/accounts', json=dict(opening, balance=balance))
+    assert response.status_code == 400
+    assert response.get_json()['description'].startswith('balance')
@@ -0,0 +1,33 @@
+import json
+import uuid
+
+from models import LedgerEvents, Transactions
+
+
+def test_reloading_transactions_without_created_at_skips_them(app, db, make_account, tmp_path):
+    account = make_account(0)
+    path = tmp_path / 'history.ndjson'
+    path.write_text(''.join(json.dumps({'id': str(uuid.uuid4()), 'amount': '5.00', 'note': 'history',
+                                        'credit_id': str(account.id), 'customer_id': str(account.customer_id)}) + '\n'
+                            for _ in range(4)))
+    cli = app.test_cli_runner()
+
+    for _ in range(2):
+        result = cli.invoke(args=['bulk', 'load', 'transactions', str(path)])
+        assert result.exception is None, result.output
+
+    assert db.session.query(Transactions).count() == 4
+    assert db.session.query(LedgerEvents).count() == 4
+
+
+def test_opening_entries_carry_their_outbox_event_time(app, db, make_account, tmp_path):
+    owner = make_account(0)
+    path = tmp_path / 'accounts.ndjson'
+    path.write_text(json.dumps({'balance': '40.00', 'acct_type_id': 1, 'customer_id': str(owner.customer_id)}) + '\n')
+
+    result = app.test_cli_runner().invoke(args=['bulk', 'load', 'accounts', str(path)])
+    assert result.exception is None, result.output
+
+    opening = db.session.query(Transactions).one()
+    assert opening.amount == 40
+    assert db.session.query(LedgerEvents).one().created_at == opening.created_at
@@ -0,0 +1,17 @@
+SECRETS = {'pin', 'password'}
+
+
+def test_customer_responses_leave_out_pin_and_password(client):
+    created = client.post('/customers', json={'first_name': 'Ada', 'last_name': 'Lovelace', 'pin': 1234, 'password': 'pw'})
+    assert created.status_code == 201
+    customer = created.get_json()
+    assert not SECRETS & customer.keys()
+
+    path = f"/customers/{customer['id']}"
+    assert not SECRETS & client.get(path).get_json().keys()
+    updated = client.put(path, json={'last_name': 'King'})
+    assert updated.get_json()['last_name'] == 'King'
+    assert not SECRETS & updated.get_json().keys()
+    assert not SECRETS & client.get('/customers').get_json()[0].keys()
+    # still there for a client that names them
+    assert client.get('/customers?fields=id,pin').get_json()[0]['pin'] == 1234
@@ -0,0 +1,20 @@
+import pytest
+
+
+@pytest.mark.parametrize('path', [
+    '/customers/notauuid/transactions',
+    '/accounts/notauuid/transactions',
+    '/customers/notauuid/portfolios',
+    '/customers/notauuid/positions',
+    '/customers/notauuid/tickers',
+    '/portfolios/notauuid/positions',
+])
+def test_malformed_ids_are_bad_requests(client, path):
+    response = client.get(path)
+    assert response.status_code == 400
+    assert response.get_json()['description'].endswith("is not a valid id")
+
+
+def test_unknown_position_is_not_found(client):
+    assert client.get('/positions/00000000-0000-7000-8000-000000000000/tickers').status_code == 404
+    assert client.get('/positions/notauuid/tickers').status_code == 400
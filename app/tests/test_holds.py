@@ -0,0 +1,18 @@
+from conftest import OPERATOR_TOKEN
+from models import Accounts
+
+
+def test_held_account_takes_no_pin_requests_but_is_still_credited(client, db, make_account):
+    held = make_account(100, pin=1234, hold=True)
+    pin = {'customer_id': str(held.customer_id), 'pin': 1234, 'amount': 5}
+
+    # the right PIN is refused too, deposits included, so it can't be guessed on a held account
+    assert client.post(f'/accounts/{held.id}/deposit', json=pin).status_code == 423
+    assert client.post(f'/accounts/{held.id}/withdrawal', json=pin).status_code == 423
+
+    report = client.post('/batches', json=[{'credit_id': str(held.id), 'amount': 5}, {'debit_id': str(held.id), 'amount': 5}],
+                         headers={'Authorization': f'Bearer {OPERATOR_TOKEN}'}).get_json()
+    assert [line['status'] for line in report['results']] == ['posted', 'rejected']
+    assert report['results'][1]['code'] == 423
+    db.session.expire_all()
+    assert db.session.get(Accounts, held.id).balance == 105
@@ -0,0 +1,23 @@
+from datetime import date, datetime
+
+from interest import accrue_interest
+from models import Accounts, AccountTypes, Customers, LedgerEvents, Transactions
+
+
+def test_interest_is_stamped_when_it_is_credited(db):
+    db.session.add(AccountTypes(id=2, type='savings', interest_rate=0.365, min_balance=0))
+    customer = Customers(first_name='Test', last_name='Saver', pin=1234, password='x')
+    db.session.add(customer)
+    db.session.flush()
+    db.session.add(Accounts(balance=1000, acct_type_id=2, customer_id=customer.id))
+    db.session.commit()
+
+    before = datetime.utcnow()
+    accrue_interest(date(2026, 1, 1), chunk_size=100)
+    after = datetime.utcnow()
+
+    row = db.session.query(Transactions).one()
+    assert row.amount == 1
+    # in UTC, between the start and end of the run, and the outbox event carries the same time
+    assert before <= row.created_at <= after
+    assert db.session.query(LedgerEvents).one().created_at == row.created_at
@@ -0,0 +1,65 @@
+import json
+
+from conftest import OPERATOR_TOKEN
+from models import Accounts, Transactions
+
+OPERATOR = {'Authorization': f'Bearer {OPERATOR_TOKEN}'}
+
+
+def ndjson(*lines) -> str:
+    return ''.join(json.dumps(line) + '\n' for line in lines)
+
+
+def balance(db, account):
+    db.session.expire_all()
+    return db.session.get(Accounts, account.id).balance
+
+
+def test_ndjson_transfers_with_idempotency_key_post_every_line(client, db, make_account):
+    payer, payee = make_account(100), make_account(0)
+    body = ndjson(*[{'debit_id': str(payer.id), 'credit_id': str(payee.id), 'amount': 10}] * 3)
+    headers = dict(OPERATOR, **{'Idempotency-Key': 'upload-1'})
+
+    response = client.post('/transfers', data=body, content_type='application/x-ndjson', headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['posted'] == 3
+    assert balance(db, payer) == 70 and balance(db, payee) == 30
+
+    # the retry gets the same report back without posting the lines again
+    retry = client.post('/transfers', data=body, content_type='application/x-ndjson', headers=headers)
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json() == response.get_json()
+    assert balance(db, payer) == 70
+    assert db.session.query(Transactions).count() == 3
+
+
+def test_rejected_transfer_is_replayed(client, db, make_account):
+    payer, payee = make_account(10), make_account(0)
+    body = {'debit_id': str(payer.id), 'credit_id': str(payee.id), 'amount': 50,
+            'customer_id': str(payer.customer_id), 'pin': 1234}
+
+    first = client.post('/transfers', json=body, headers={'Idempotency-Key': 'overdraft'})
+    assert first.status_code == 400
+    retry = client.post('/transfers', json=body, headers={'Idempotency-Key': 'overdraft'})
+    assert retry.status_code == 400
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+
+
+def test_batch_with_idempotency_key_posts_its_lines(client, db, make_account):
+    payroll, employee = make_account(100), make_account(0)
+    body = ndjson({'debit_id': str(payroll.id), 'amount': 25}, {'credit_id': str(employee.id), 'amount': 25})
+    headers = dict(OPERATOR, **{'Idempotency-Key': 'payroll-1'})
+
+    response = client.post('/batches', data=body, content_type='application/x-ndjson', headers=headers)
+    assert response.get_json()['posted'] == 2
+    retry = client.post('/batches', data=body, content_type='application/x-ndjson', headers=headers)
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert retry.get_json()['posted'] == 2
+    assert balance(db, payroll) == 75 and balance(db, employee) == 25
+
+
+def test_bulk_postings_need_an_operator(client, make_account):
+    payer, payee = make_account(100), make_account(0)
+    line = {'debit_id': str(payer.id), 'credit_id': str(payee.id), 'amount': 1}
+    assert client.post('/batches', json=[line]).status_code == 403
+    assert client.post('/transfers', json=[line]).status_code == 403
@@ -0,0 +1,107 @@
+"""Stored prices for valuations.
+
+`flask prices revalue` (run it daily, after the market data for the previous session is out) prices
+every ticker held in any portfolio once, through the PriceService (concurrent, coalesced), and
+upserts the closes into price_history under the valuation date. Buys record the price they paid
+too. The valuation endpoints read price_history and never call out, and since the history is kept
+they can also value a portfolio as of any earlier date.
+"""
+import logging
+from datetime import date, datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.dialects.postgresql import insert
+
+from models import db, PriceHistory, Positions, Tickers
+
+log = logging.getLogger('bank.valuation')
+
+
+def valuation_day() -> date:
+    """ the day prices are stored under by default: yesterday, the last complete session"""
+    return date.today() - timedelta(days=1)
+
+
+def store_closes(closes: dict, day: date, overwrite: bool = True):
+    """ upsert {ticker: close} into price_history for `day` (in the caller's transaction)"""
+    if not closes:
+        return
+    now = datetime.utcnow()
+    stmt = insert(PriceHistory).values([
+        {'ticker': ticker, 'day': day, 'close': close, 'fetched_at': now} for ticker, close in closes.items()])
+    if overwrite:
+        stmt = stmt.on_conflict_do_update(index_elements=[PriceHistory.ticker, PriceHistory.day],
+                                          set_={'close': stmt.excluded.close, 'fetched_at': stmt.excluded.fetched_at})
+    else:
+        stmt = stmt.on_conflict_do_nothing()
+    db.session.execute(stmt)
+
+
+def stored_closes(tickers, day: date = None) -> dict:
+    """ the latest stored close on or before `day` for each ticker: {ticker: (close, price day)}.
+
+    One query (DISTINCT ON over the (ticker, day) primary key); tickers never priced are left out.
+    """
+    tickers = list(dict.fromkeys(tickers))
+    if not tickers:
+        return {}
+    rows = db.session.execute(
+        db.select(PriceHistory.ticker, PriceHistory.close, PriceHistory.day)
+        .where(PriceHistory.ticker.in_(tickers), PriceHistory.day <= (day or date.today()))
+        .order_by(PriceHistory.ticker, PriceHistory.day.desc())
+        .distinct(PriceHistory.ticker)).all()
+    return {row.ticker: (row.close, row.day) for row in rows}
+
+
+def value_history(portfolio_id, start: date, end: date) -> list:
+    """ [(day, market value)] for every day in [start, end], pricing the portfolio's current holdings
+    at the latest stored close on or before each day (days before any price is stored are left out)"""
+    days = db.select(db.func.generate_series(start, end, db.text("interval '1 day'")).label('day')).subquery('days')
+    holdings = (db.select(Tickers.ticker, Positions.quantity)
+                .join(Positions, Positions.ticker_id == Tickers.id)
+                .where(Positions.portfolio_id == portfolio_id)
+                .subquery('holdings'))
+    close = (db.select(PriceHistory.close)
+             .where(PriceHistory.ticker == holdings.c.ticker, PriceHistory.day <= db.cast(days.c.day, db.Date))
+             .order_by(PriceHistory.day.desc()).limit(1)
+             .lateral('close'))
+    rows = db.session.execute(
+        db.select(db.cast(days.c.day, db.Date).label('day'), db.func.sum(holdings.c.quantity * close.c.close).label('value'))
+        .select_from(days).join(holdings, db.true()).join(close, db.true())
+        .group_by(days.c.day).order_by(days.c.day)).all()
+    return [(row.day, row.value) for row in rows]
+
+
+def revalue(price_service, day: date) -> dict:
+    """ price every held ticker once for `day` and store the closes; returns {ticker: error} for failures"""
+    tickers = db.session.execute(
+        db.select(Tickers.ticker).where(Tickers.positions.any(Positions.quantity > 0))).scalars().all()
+    results = price_service.close_prices(tickers, day, return_exceptions=True)
+    failed = {ticker: result for ticker, result in results.items() if isinstance(result, Exception)}
+    store_closes({ticker: close for ticker, close in results.items() if ticker not in failed}, day)
+    db.session.commit()
+    for ticker, error in failed.items():
+        log.warning("no close for %s on %s: %s", ticker, day, error)
+    log.info("stored %d closes for %s, %d failed", len(results) - len(failed), day, len(failed))
+    return failed
+
+
+##### CLI: flask prices revalue #####
+
+cli = AppGroup('prices', help="Stored prices for valuations.")
+
+
+@cli.command('revalue')
+@click.option('--date', 'day', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help="valuation date (default yesterday)")
+def revalue_command(day):
+    """Fetch and store the close of every held ticker; exits 1 if any couldn't be priced."""
+    day = day.date() if day else valuation_day()
+    failed = revalue(current_app.extensions['prices'], day)
+    for ticker, error in failed.items():
+        click.echo(f"FAILED {ticker}: {error}")
+    if failed:
+        raise SystemExit(1)
+    click.echo(f"prices stored for {day}")